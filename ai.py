@@ -0,0 +1,341 @@
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from common import DIRS, THINK_TIME_SECONDS, WIN_LENGTH, Board
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình máy chơi cờ
+# ============================================
+BOT_NAMES = ("CaroBot",)          # Người chơi ảo server tạo sẵn lúc khởi động (xem server.BotClient)
+AI_THINK_SECONDS = 2.0            # Ngân sách suy nghĩ mỗi nước (luôn thấp hơn THINK_TIME_SECONDS)
+AI_WORKERS = 2                    # Số tiến trình tìm kiếm chạy song song (mỗi trận với bot dùng 1)
+AI_MAX_DEPTH = 10                 # Độ sâu tối đa của iterative deepening
+AI_BRANCH = 12                    # Chỉ xét 12 nước tốt nhất (theo điểm tấn công + phòng thủ) mỗi nút
+AI_VCF_DEPTH = 12                 # Số nước "tứ" liên tiếp tối đa khi dò thắng cưỡng bức
+AI_NEIGHBORHOOD = 2               # Nước ứng viên: ô trống cách quân đã có tối đa 2 ô
+AI_TT_SIZE = 1 << 18              # Số thế cờ tối đa giữ trong bảng chuyển vị (xóa sạch khi đầy)
+
+WIN_SCORE = 10_000_000
+# Điểm của 1 cửa sổ 5 ô chỉ chứa quân của 1 bên, theo số quân (0..4)
+WINDOW_SCORE = (0, 1, 12, 160, 2400)
+# Điểm sắp xếp nước đi: đặt vào cửa sổ có k quân mình (tấn công) / k quân địch (chặn)
+ATTACK_PRIORITY = (1, 8, 60, 900, 1_000_000)
+DEFENSE_PRIORITY = (0, 6, 50, 700, 100_000)
+TEMPO = 60                        # Lợi thế của bên đang được đi
+
+
+class SearchTimeout(Exception):
+    """Hết ngân sách thời gian giữa chừng 1 vòng lặp sâu dần"""
+
+
+# ============================================
+# HÌNH HỌC BÀN CỜ - tính 1 lần cho mỗi kích thước
+# ============================================
+
+@lru_cache(maxsize=None)
+def _windows(size: int) -> Tuple[Tuple[Tuple[int, ...], ...], Tuple[Tuple[int, ...], ...], Tuple[Tuple[int, ...], ...]]:
+    """
+    Mọi cửa sổ WIN_LENGTH ô liên tiếp trên bàn (ô đánh số y * size + x)
+    Returns:
+        (cells của từng cửa sổ, các cửa sổ chứa từng ô, các ô lân cận của từng ô)
+    """
+    windows: List[Tuple[int, ...]] = []
+    for dx, dy in DIRS:
+        for y in range(size):
+            for x in range(size):
+                ex, ey = x + dx * (WIN_LENGTH - 1), y + dy * (WIN_LENGTH - 1)
+                if 0 <= ex < size and 0 <= ey < size:
+                    windows.append(tuple((y + dy * k) * size + x + dx * k for k in range(WIN_LENGTH)))
+    by_cell: List[List[int]] = [[] for _ in range(size * size)]
+    for w, cells in enumerate(windows):
+        for c in cells:
+            by_cell[c].append(w)
+    r = AI_NEIGHBORHOOD
+    near = []
+    for c in range(size * size):
+        y, x = divmod(c, size)
+        near.append(tuple(ny * size + nx
+                          for ny in range(max(0, y - r), min(size, y + r + 1))
+                          for nx in range(max(0, x - r), min(size, x + r + 1))
+                          if (nx, ny) != (x, y)))
+    return tuple(windows), tuple(tuple(ws) for ws in by_cell), tuple(near)
+
+
+def _window_value(mine: int, theirs: int) -> int:
+    if theirs == 0:
+        return WINDOW_SCORE[mine] if mine < WIN_LENGTH else WIN_SCORE
+    if mine == 0:
+        return -(WINDOW_SCORE[theirs] if theirs < WIN_LENGTH else WIN_SCORE)
+    return 0
+
+
+# VALUE[x][o]: điểm (theo phía X) của 1 cửa sổ có x quân X và o quân O
+VALUE = tuple(tuple(_window_value(x, o) for o in range(WIN_LENGTH + 1)) for x in range(WIN_LENGTH + 1))
+
+
+# ============================================
+# BÀN CỜ TÌM KIẾM - Board + bộ đếm theo cửa sổ cập nhật dần
+# ============================================
+
+class Engine:
+    """
+    Trạng thái tìm kiếm dựng trên common.Board
+    - Mỗi cửa sổ 5 ô giữ số quân X/O; đặt/bỏ 1 quân chỉ cập nhật <= 20 cửa sổ chứa ô đó
+      → điểm thế cờ, phát hiện 5 quân và các mối đe dọa (cửa sổ 4 quân) đều là O(1)
+    - near[c]: số quân trong vùng lân cận của ô c → nước ứng viên chỉ là ô trống có near > 0
+    - Bảng chuyển vị khóa theo Board.zobrist (cập nhật O(1) mỗi lần đặt/bỏ quân)
+    """
+
+    def __init__(self, board: Board):
+        self.size = board.size
+        self.windows, self.cell_windows, self.neighbors = _windows(board.size)
+        n = self.size * self.size
+        self.cells = [0] * n                     # 0 trống, 1 X, 2 O
+        self.wx = [0] * len(self.windows)
+        self.wo = [0] * len(self.windows)
+        self.near = [0] * n
+        self.score = 0                            # Tổng điểm các cửa sổ, theo phía X
+        self.tt: Dict[int, Tuple[int, int, int, int]] = {}
+        self.nodes = 0
+        self.deadline = float("inf")
+        # Bàn riêng của máy (không đụng tới bàn của trận), dựng lại qua play() để có đủ bộ đếm
+        self.board = Board(board.size)
+        stones = [(y * self.size + x, board.get(x, y)) for y in range(self.size) for x in range(self.size)
+                  if not board.is_empty(x, y)]
+        for c, symbol in stones:
+            self.play(c, 1 if symbol == "X" else 2)
+
+    # ---------- Đặt / bỏ quân ----------
+
+    def play(self, c: int, side: int) -> None:
+        """Đặt quân của side (1 X, 2 O) vào ô c"""
+        y, x = divmod(c, self.size)
+        self.board.place(x, y, "X" if side == 1 else "O")
+        self.cells[c] = side
+        mine = self.wx if side == 1 else self.wo
+        wx, wo = self.wx, self.wo
+        delta = 0
+        for w in self.cell_windows[c]:
+            before = VALUE[wx[w]][wo[w]]
+            mine[w] += 1
+            delta += VALUE[wx[w]][wo[w]] - before
+        self.score += delta
+        near = self.near
+        for nb in self.neighbors[c]:
+            near[nb] += 1
+
+    def undo(self, c: int, side: int) -> None:
+        y, x = divmod(c, self.size)
+        self.board.remove(x, y)
+        self.cells[c] = 0
+        mine = self.wx if side == 1 else self.wo
+        wx, wo = self.wx, self.wo
+        delta = 0
+        for w in self.cell_windows[c]:
+            before = VALUE[wx[w]][wo[w]]
+            mine[w] -= 1
+            delta += VALUE[wx[w]][wo[w]] - before
+        self.score += delta
+        near = self.near
+        for nb in self.neighbors[c]:
+            near[nb] -= 1
+
+    def evaluate(self, side: int) -> int:
+        """Điểm thế cờ theo phía bên đang được đi"""
+        return (self.score if side == 1 else -self.score) + TEMPO
+
+    # ---------- Sinh và sắp xếp nước đi ----------
+
+    def candidates(self, side: int) -> List[Tuple[int, int]]:
+        """
+        Các ô trống gần quân đã có, kèm điểm ưu tiên (tấn công + chặn), xếp giảm dần
+        Điểm >= ATTACK_PRIORITY[4]: thắng ngay; >= DEFENSE_PRIORITY[4]: phải chặn
+        """
+        cells, near = self.cells, self.near
+        mine, theirs = (self.wx, self.wo) if side == 1 else (self.wo, self.wx)
+        cell_windows = self.cell_windows
+        scored = []
+        for c in range(len(cells)):
+            if cells[c] or not near[c]:
+                continue
+            p = 0
+            for w in cell_windows[c]:
+                m, t = mine[w], theirs[w]
+                if t == 0:
+                    p += ATTACK_PRIORITY[m]
+                elif m == 0:
+                    p += DEFENSE_PRIORITY[t]
+            scored.append((p, c))
+        scored.sort(reverse=True)
+        return scored
+
+    def threats(self, side: int) -> List[int]:
+        """Các ô mà side đặt vào là thắng ngay (cửa sổ đã có 4 quân, ô còn lại trống)"""
+        mine, theirs = (self.wx, self.wo) if side == 1 else (self.wo, self.wx)
+        found = []
+        for w, cells in enumerate(self.windows):
+            if mine[w] == WIN_LENGTH - 1 and theirs[w] == 0:
+                found.extend(c for c in cells if not self.cells[c] and c not in found)
+        return found
+
+    # ---------- Tìm thắng cưỡng bức (threat-space: chỉ đi nước tạo "tứ") ----------
+
+    def vcf(self, side: int, depth: int = AI_VCF_DEPTH) -> Optional[int]:
+        """
+        Victory by Continuous Fours: chuỗi nước liên tục tạo 4 quân, đối thủ buộc phải chặn
+        đúng 1 ô, cuối cùng có 2 ô thắng cùng lúc (không chặn nổi). Trả về nước đầu tiên hoặc None
+        Chỉ gọi khi side đang được đi và đối thủ chưa có ô thắng ngay
+        """
+        if depth <= 0:
+            return None
+        self._tick()
+        other = 3 - side
+        mine, theirs = (self.wx, self.wo) if side == 1 else (self.wo, self.wx)
+        fours = set()
+        for w in range(len(self.windows)):
+            if mine[w] == WIN_LENGTH - 2 and theirs[w] == 0:
+                fours.update(c for c in self.windows[w] if not self.cells[c])
+        for c in fours:
+            self.play(c, side)
+            try:
+                wins = self.threats(side)
+                if len(wins) >= 2:
+                    return c
+                if len(wins) == 1 and not self.threats(other):
+                    block = wins[0]
+                    self.play(block, other)
+                    try:
+                        # Nước chặn tạo ra 4 quân cho đối thủ → chuỗi tứ bị đứt
+                        if not self.threats(other) and self.vcf(side, depth - 1) is not None:
+                            return c
+                    finally:
+                        self.undo(block, other)
+            finally:
+                self.undo(c, side)
+        return None
+
+    # ---------- Alpha-beta + bảng chuyển vị ----------
+
+    def _tick(self) -> None:
+        self.nodes += 1
+        if not self.nodes & 255 and time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+    def negamax(self, depth: int, alpha: int, beta: int, side: int) -> Tuple[int, int]:
+        """Trả về (điểm theo phía side, nước tốt nhất; -1 nếu là nút lá)"""
+        self._tick()
+        if depth == 0:
+            return self.evaluate(side), -1
+
+        key = self.board.zobrist
+        entry = self.tt.get(key)
+        tt_move = -1
+        if entry is not None:
+            e_depth, e_value, e_flag, tt_move = entry
+            if e_depth >= depth:
+                if e_flag == 0 or (e_flag < 0 and e_value <= alpha) or (e_flag > 0 and e_value >= beta):
+                    return e_value, tt_move
+
+        moves = self.candidates(side)
+        if not moves:
+            return 0, -1  # Hết ô: hòa
+        if moves[0][0] >= ATTACK_PRIORITY[4]:
+            return WIN_SCORE, moves[0][1]
+        if moves[0][0] >= DEFENSE_PRIORITY[4]:
+            # Đối thủ đang có 4 quân: chỉ còn các nước chặn
+            moves = [m for m in moves if m[0] >= DEFENSE_PRIORITY[4]]
+        else:
+            moves = moves[:AI_BRANCH]
+        order = [c for _, c in moves]
+        if tt_move in order:
+            order.remove(tt_move)
+            order.insert(0, tt_move)
+
+        alpha0 = alpha
+        best, best_move = -WIN_SCORE - 1, order[0]
+        other = 3 - side
+        for c in order:
+            self.play(c, side)
+            try:
+                value = -self.negamax(depth - 1, -beta, -alpha, other)[0]
+            finally:
+                self.undo(c, side)
+            if value > best:
+                best, best_move = value, c
+            if best > alpha:
+                alpha = best
+            if alpha >= beta:
+                break
+
+        if len(self.tt) >= AI_TT_SIZE:
+            self.tt.clear()
+        flag = -1 if best <= alpha0 else 1 if best >= beta else 0
+        self.tt[key] = (depth, best, flag, best_move)
+        return best, best_move
+
+    def search(self, side: int, budget: float) -> Dict:
+        """
+        Iterative deepening trong ngân sách `budget` giây: luôn có sẵn nước của độ sâu
+        cuối cùng đã xong; vòng sâu hơn bị ngắt giữa chừng thì bỏ kết quả của vòng đó
+        """
+        start = time.monotonic()
+        self.deadline = start + budget
+        self.nodes = 0
+        result = {"move": -1, "score": 0, "depth": 0, "reason": "search"}
+
+        moves = self.candidates(side)
+        if not moves:
+            c = (self.size // 2) * self.size + self.size // 2
+            if not self.cells[c]:
+                result.update(move=c, reason="opening")
+            else:
+                result.update(move=next(i for i, v in enumerate(self.cells) if not v), reason="fallback")
+            return self._done(result, start)
+        if moves[0][0] >= ATTACK_PRIORITY[4]:
+            result.update(move=moves[0][1], score=WIN_SCORE, reason="win")
+            return self._done(result, start)
+        result["move"] = moves[0][1]
+
+        try:
+            if moves[0][0] < DEFENSE_PRIORITY[4]:
+                c = self.vcf(side)
+                if c is not None:
+                    result.update(move=c, score=WIN_SCORE, reason="vcf")
+                    return self._done(result, start)
+            for depth in range(1, AI_MAX_DEPTH + 1):
+                score, move = self.negamax(depth, -WIN_SCORE - 1, WIN_SCORE + 1, side)
+                result.update(move=move, score=score, depth=depth)
+                # Đã thấy thắng/thua chắc chắn, hoặc vòng sau chắc chắn không kịp
+                if abs(score) >= WIN_SCORE or time.monotonic() - start > budget / 3:
+                    break
+        except SearchTimeout:
+            pass
+        return self._done(result, start)
+
+    def _done(self, result: Dict, start: float) -> Dict:
+        y, x = divmod(result["move"], self.size)
+        result.update(x=x, y=y, nodes=self.nodes, ms=round((time.monotonic() - start) * 1000, 1))
+        return result
+
+
+# ============================================
+# ĐIỂM VÀO CHO PROCESS POOL (đối số/kết quả chỉ là số → pickle rẻ)
+# ============================================
+
+def search_move(size: int, x_bits: int, o_bits: int, symbol: str,
+                budget: float = AI_THINK_SECONDS) -> Dict:
+    """
+    Chọn nước cho `symbol` trên bàn có các bitmask (common.Board.x_bits / o_bits)
+    Chạy trong tiến trình con (server gọi qua ProcessPoolExecutor); trả về
+    {"x", "y", "score", "depth", "nodes", "ms", "reason"}
+    """
+    board = Board.from_bits(x_bits, o_bits, size)
+    budget = min(budget, THINK_TIME_SECONDS / 2)
+    return Engine(board).search(1 if symbol == "X" else 2, budget)
+
+
+def best_move(board: Board, symbol: str, budget: float = AI_THINK_SECONDS) -> Tuple[int, int]:
+    """Gọi trực tiếp (không qua process pool): trả về (x, y)"""
+    r = search_move(board.size, board.x_bits, board.o_bits, symbol, budget)
+    return r["x"], r["y"]
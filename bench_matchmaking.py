@@ -0,0 +1,106 @@
+"""
+Benchmark: thông lượng ghép trận của MatchQueue (matchmaking.py) với 100k người chơi.
+
+Chạy trong 1 tiến trình, không mạng, đồng hồ giả lập (không phải đợi thật) - đo đúng
+chi phí của cấu trúc dữ liệu mà server gọi trên event loop. 2 kịch bản:
+- normal: Elo phân bố chuẩn quanh 1200 như thực tế → gần như ai vào cũng được ghép ngay
+- sparse: Elo rải đều trên khoảng rất rộng → hàng chờ phình lên gần 100k người,
+  đo chi phí join() khi hàng đã đầy và chi phí mỗi lượt sweep() khi ngưỡng nới dần
+
+Chạy: python bench_matchmaking.py --players 100000
+"""
+import argparse
+import json
+import random
+import time
+from typing import Dict, List
+
+from matchmaking import BASE_TOLERANCE, MAX_TOLERANCE, SWEEP_INTERVAL, WIDEN_PER_SECOND, MatchQueue
+from load_test import percentiles
+
+ARRIVAL_GAP = 0.0001  # Khoảng cách (giây, đồng hồ giả lập) giữa 2 người vào hàng: 10k người/giây
+
+
+def ratings_for(scenario: str, n: int, rng: random.Random) -> List[float]:
+    if scenario == "normal":
+        return [rng.gauss(1200, 250) for _ in range(n)]
+    # Khoảng cách trung bình giữa 2 người kề nhau ~ MAX_TOLERANCE / 2 → phần lớn phải chờ nới ngưỡng
+    return [rng.uniform(0, n * MAX_TOLERANCE / 2) for _ in range(n)]
+
+
+def bench(scenario: str, players: int, seed: int) -> Dict:
+    rng = random.Random(seed)
+    ratings = ratings_for(scenario, players, rng)
+    q = MatchQueue()
+    now = 0.0
+    paired = 0
+    join_us: List[float] = []
+    max_waiting = 0
+    sweeps: List[float] = []
+    sweep_pairs = 0
+
+    def sweep():
+        nonlocal sweep_pairs
+        t = time.perf_counter()
+        sweep_pairs += len(q.sweep(now))
+        sweeps.append((time.perf_counter() - t) * 1000)
+
+    # Người chơi vào hàng liên tục, server quét mỗi SWEEP_INTERVAL như thật
+    next_sweep = SWEEP_INTERVAL
+    t0 = time.perf_counter()
+    for i, rating in enumerate(ratings):
+        now += ARRIVAL_GAP
+        if now >= next_sweep:
+            sweep()
+            next_sweep += SWEEP_INTERVAL
+        t = time.perf_counter()
+        if q.join(f"p{i}", rating, now):
+            paired += 1
+        join_us.append((time.perf_counter() - t) * 1e6)
+        max_waiting = max(max_waiting, len(q))
+    join_elapsed = time.perf_counter() - t0
+
+    # Không còn ai vào thêm: quét tiếp cho đến khi ngưỡng của người vào sau cùng chạm trần
+    for _ in range(int((MAX_TOLERANCE - BASE_TOLERANCE) / WIDEN_PER_SECOND) + 2):
+        now += SWEEP_INTERVAL
+        sweep()
+
+    return {
+        "scenario": scenario,
+        "players": players,
+        "joins_per_s": round(players / join_elapsed),
+        "join_us": percentiles(join_us),
+        "paired_on_join": paired,
+        "max_waiting": max_waiting,
+        "sweeps": len(sweeps),
+        "sweep_ms_max": round(max(sweeps), 2),
+        "paired_by_sweep": sweep_pairs,
+        "left_waiting": len(q),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark hàng chờ ghép trận")
+    parser.add_argument("--players", type=int, default=100_000)
+    parser.add_argument("--scenario", nargs="+", default=["normal", "sparse"], choices=["normal", "sparse"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_out", help="ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'scenario':>8} {'joins/s':>10} {'join p50/p99 (us)':>18} {'pairs@join':>11} "
+          f"{'max wait':>9} {'sweep max (ms)':>15} {'pairs@sweep':>12}")
+    for scenario in args.scenario:
+        r = bench(scenario, args.players, args.seed)
+        results.append(r)
+        lat = f"{r['join_us']['p50']:.1f}/{r['join_us']['p99']:.1f}"
+        print(f"{r['scenario']:>8} {r['joins_per_s']:>10} {lat:>18} {r['paired_on_join']:>11} "
+              f"{r['max_waiting']:>9} {r['sweep_ms_max']:>15} {r['paired_by_sweep']:>12}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump({"results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark: chi phí rate limit (ratelimit.py) dưới tải tấn công.
+
+Chạy trong 1 tiến trình, không mạng, đồng hồ giả lập - đo đúng phần server làm
+cho mỗi tin nhắn tới trên event loop. 3 phần:
+- cost: ns/tin của peek_type + check() (tin được qua / tin bị chặn) so với
+  json.loads của cùng tin → tin bị chặn rẻ hơn giải mã bao nhiêu lần
+- flood: 1 kết nối gửi đều ở nhiều tốc độ khác nhau (cả tin loại lạ ngẫu nhiên)
+  → số tin qua/bỏ/báo lỗi, sau bao lâu thì bị ngắt
+- memory: tracemalloc cho N kết nối đã tạo đủ mọi thùng theo loại → byte/kết nối
+
+Chạy: python bench_ratelimit.py --clients 100000
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+from typing import Dict, List
+
+from common import MSG_JSON, peek_type
+from ratelimit import ALLOW, CLIENT_BURST, CLIENT_RATE, DISCONNECT, TYPE_LIMITS, WARN, ClientLimiter, TokenBucket
+
+CHAT = json.dumps({"type": "chat", "text": "gg " * 160}).encode("utf-8") + b"\n"  # ~500 ký tự (chat dài nhất)
+FLOOD_RATES = (5, 9.5, 15, 50, 1000, 100_000)  # tin/giây
+FLOOD_SECONDS = 60.0
+
+
+def new_limiter(now: float) -> ClientLimiter:
+    """Kết nối mới theo đồng hồ giả lập (mặc định ClientLimiter dùng time.monotonic)"""
+    return ClientLimiter(TokenBucket.full(CLIENT_RATE, CLIENT_BURST, now))
+
+
+def bench_cost(n: int) -> Dict:
+    """ns/tin: tin được qua (mỗi tin cách nhau đủ lâu để thùng đầy lại) và tin bị chặn (thùng đã rỗng)"""
+    lim = new_limiter(0.0)
+    t = time.perf_counter()
+    for i in range(n):
+        lim.check(peek_type(MSG_JSON, CHAT), float(i))
+    allowed_ns = (time.perf_counter() - t) / n * 1e9
+
+    # Thời gian đứng yên → không nạp thêm token, điểm phạt chỉ tăng (bỏ qua DISCONNECT để đo đều)
+    lim = new_limiter(0.0)
+    t = time.perf_counter()
+    for _ in range(n):
+        lim.check(peek_type(MSG_JSON, CHAT), 0.0)
+    dropped_ns = (time.perf_counter() - t) / n * 1e9
+
+    t = time.perf_counter()
+    for _ in range(n):
+        json.loads(CHAT.decode("utf-8"))
+    decode_ns = (time.perf_counter() - t) / n * 1e9
+    return {
+        "allowed_ns": round(allowed_ns),
+        "dropped_ns": round(dropped_ns),
+        "json_decode_ns": round(decode_ns),
+        "decode_vs_dropped": round(decode_ns / dropped_ns, 1),
+    }
+
+
+def bench_flood(rate: float, seed: int) -> Dict:
+    """1 kết nối gửi đều `rate` tin/giây trong FLOOD_SECONDS: 10% chat, 70% move, 20% loại rác ngẫu nhiên"""
+    rng = random.Random(seed)
+    lim = new_limiter(0.0)
+    counts = {ALLOW: 0, WARN: 0, DISCONNECT: 0, "drop": 0}
+    kicked_at = None
+    n = int(rate * FLOOD_SECONDS)
+    for i in range(n):
+        now = i / rate
+        r = rng.random()
+        msg_type = "chat" if r < 0.1 else "move" if r < 0.8 else f"junk{rng.randrange(1 << 30)}"
+        verdict = lim.check(msg_type, now)
+        counts[verdict] += 1
+        if verdict == DISCONNECT:
+            kicked_at = now
+            break
+    return {
+        "rate": rate,
+        "sent": sum(counts.values()),
+        "allowed": counts[ALLOW],
+        "dropped": counts["drop"],
+        "warned": counts[WARN],
+        "kicked_after_s": None if kicked_at is None else round(kicked_at, 3),
+        "type_buckets": len(lim.types),
+    }
+
+
+def bench_memory(clients: int) -> Dict:
+    """Byte/kết nối khi mỗi kết nối đã dùng đủ mọi loại tin có giới hạn riêng"""
+    tracemalloc.start()
+    base = tracemalloc.take_snapshot()
+    limiters: List[ClientLimiter] = []
+    for i in range(clients):
+        lim = new_limiter(float(i))
+        for t in TYPE_LIMITS:
+            lim.check(t, float(i))
+        limiters.append(lim)
+    used = sum(s.size_diff for s in tracemalloc.take_snapshot().compare_to(base, "filename"))
+    tracemalloc.stop()
+    return {"clients": clients, "bytes_per_client": round(used / clients), "total_mb": round(used / 2**20, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rate limit")
+    parser.add_argument("--clients", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", dest="json_out", help="ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    cost = bench_cost(args.clients)
+    print(f"allowed {cost['allowed_ns']} ns/msg, dropped {cost['dropped_ns']} ns/msg, "
+          f"json decode {cost['json_decode_ns']} ns/msg ({cost['decode_vs_dropped']}x dropped)")
+
+    print(f"\nflood {FLOOD_SECONDS:.0f}s (limit {CLIENT_RATE:g}/s per connection)")
+    print(f"{'rate/s':>8} {'sent':>8} {'allowed':>8} {'dropped':>8} {'warned':>7} {'kicked@s':>9} {'buckets':>8}")
+    floods = []
+    for rate in FLOOD_RATES:
+        r = bench_flood(rate, args.seed)
+        floods.append(r)
+        kicked = "-" if r["kicked_after_s"] is None else r["kicked_after_s"]
+        print(f"{r['rate']:>8g} {r['sent']:>8} {r['allowed']:>8} {r['dropped']:>8} {r['warned']:>7} "
+              f"{kicked:>9} {r['type_buckets']:>8}")
+
+    mem = bench_memory(args.clients)
+    print(f"\nmemory: {mem['bytes_per_client']} B/connection, {mem['total_mb']} MB for {mem['clients']} connections")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump({"cost": cost, "flood": floods, "memory": mem}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Benchmark: số nước đi/giây của server sharding (sharding.py) theo số worker.
+
+Mỗi cặp người chơi login → challenge → accept rồi đánh 1 ván hòa dựng sẵn
+(225 nước, không ai có 5 quân) để không bị HIGHLIGHT_DELAY làm chậm, hết ván lại
+thách đấu tiếp cho đến hết thời gian đo. Mỗi người chơi tự giãn nhịp gửi để không
+dính rate limit của server, nên cần đủ nhiều cặp để server bão hòa. Client chạy
+trong nhiều tiến trình để không tự trở thành nút thắt cổ chai.
+
+Chạy: python bench_sharding.py --workers 1 2 4 --pairs 1000 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+from common import BOARD_SIZE, GameClient
+from ratelimit import CLIENT_RATE
+
+HOST = "127.0.0.1"
+SEND_INTERVAL = 1.0 / CLIENT_RATE * 1.05  # Nhịp gửi tối thiểu để không bị rate limit
+
+
+def draw_game() -> List[Tuple[int, int]]:
+    """
+    Ván hòa 225 nước: X ở các ô ((x // 2) + y) chẵn, O ở các ô còn lại
+    → mọi hướng chỉ có tối đa 2 quân liên tiếp, không bao giờ có người thắng
+    """
+    xs = [(x, y) for y in range(BOARD_SIZE) for x in range(BOARD_SIZE) if ((x // 2) + y) % 2 == 0]
+    os_ = [(x, y) for y in range(BOARD_SIZE) for x in range(BOARD_SIZE) if ((x // 2) + y) % 2 == 1]
+    moves = []
+    for i in range(len(xs)):
+        moves.append(xs[i])
+        if i < len(os_):
+            moves.append(os_[i])
+    return moves
+
+
+class Player(GameClient):
+    def __init__(self, name: str, binary: bool):
+        super().__init__(name, binary, min_interval=SEND_INTERVAL)
+
+    async def connect(self, port: int):
+        await self.login(HOST, port)
+
+
+async def play_pair(idx: int, port: int, binary: bool, stop_at: float, moves: List[Tuple[int, int]]) -> int:
+    """1 cặp đánh liên tục đến stop_at, trả về số nước đi được server xác nhận"""
+    px, po = Player(f"bx{os.getpid()}_{idx}", binary), Player(f"bo{os.getpid()}_{idx}", binary)
+    await px.connect(port)
+    await po.connect(port)
+    played = 0
+
+    async def run(player: Player, first: int) -> None:
+        nonlocal played
+        i = first
+        while True:
+            msg = await player.wait_for("your_turn", "match_end")
+            if msg["type"] == "match_end":
+                return
+            x, y = moves[i]
+            i += 2
+            await player.send({"type": "move", "x": x, "y": y})
+            played += 1
+
+    async def games() -> None:
+        while True:
+            await px.send({"type": "challenge", "opponent": po.name})
+            await po.wait_for("invite")
+            await po.send({"type": "accept", "opponent": px.name})
+            await asyncio.gather(run(px, 0), run(po, 1))
+
+    try:
+        # Hết giờ đo → dừng giữa ván, chỉ tính những nước đã đánh
+        await asyncio.wait_for(games(), stop_at - time.monotonic())
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        for p in (px, po):
+            await p.close()
+    return played
+
+
+def client_process(port: int, first: int, count: int, binary: bool, stop_at: float, out) -> None:
+    async def main():
+        moves = draw_game()
+        results = await asyncio.gather(
+            *(play_pair(first + i, port, binary, stop_at, moves) for i in range(count)),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        return sum(r for r in results if isinstance(r, int)), len(errors)
+    out.put(asyncio.run(main()))
+
+
+def wait_port(port: int, timeout: float = 15.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not open port {port}")
+
+
+def bench(workers: int, pairs: int, duration: float, client_procs: int, binary: bool, port: int) -> dict:
+    tmp_dir = tempfile.mkdtemp(prefix="caro-bench-")
+    db = os.path.join(tmp_dir, "bench.db")  # + -wal/-shm + nhật ký *.sN.journal của từng worker
+    server = subprocess.Popen(
+        [sys.executable, "sharding.py", "--workers", str(workers), "--host", HOST,
+         "--port", str(port), "--db", db],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_port(port)
+        time.sleep(0.5 + 0.2 * workers)  # đợi mọi worker cùng nghe port
+
+        out = multiprocessing.Queue()
+        start = time.monotonic()
+        stop_at = start + duration
+        per_proc = [pairs // client_procs + (1 if i < pairs % client_procs else 0) for i in range(client_procs)]
+        procs, first = [], 0
+        for n in per_proc:
+            p = multiprocessing.Process(target=client_process, args=(port, first, n, binary, stop_at, out))
+            p.start()
+            procs.append(p)
+            first += n
+        results = [out.get() for _ in procs]
+        elapsed = time.monotonic() - start
+        for p in procs:
+            p.join()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    moves = sum(r[0] for r in results)
+    return {
+        "workers": workers,
+        "pairs": pairs,
+        "duration_s": round(elapsed, 2),
+        "moves": moves,
+        "moves_per_s": round(moves / elapsed, 1),
+        "client_errors": sum(r[1] for r in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sharding: moves/s theo số worker")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--pairs", type=int, default=1000, help="số cặp người chơi đồng thời")
+    parser.add_argument("--duration", type=float, default=10.0, help="thời gian đo mỗi cấu hình (giây)")
+    parser.add_argument("--client-procs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--binary", action="store_true", help="client dùng giao thức nhị phân")
+    parser.add_argument("--port", type=int, default=7790)
+    parser.add_argument("--json", dest="json_out", help="ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'workers':>8} {'moves/s':>10} {'moves':>10} {'errors':>7}")
+    for n in args.workers:
+        r = bench(n, args.pairs, args.duration, args.client_procs, args.binary, args.port)
+        results.append(r)
+        print(f"{r['workers']:>8} {r['moves_per_s']:>10} {r['moves']:>10} {r['client_errors']:>7}")
+
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
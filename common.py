@@ -2,7 +2,13 @@ from __future__ import annotations
 import asyncio
 import json
 import codecs
-from typing import Any, Dict, Tuple, List, Optional
+import random
+import re
+import struct
+import sys
+from array import array
+from functools import lru_cache
+from typing import Any, Dict, Iterator, Tuple, List, Optional, Union
 
 # ==========================
 # HẰNG SỐ CƠ BẢN CHO TRÒ CHƠI
@@ -12,6 +18,8 @@ THINK_TIME_SECONDS = 30                 # Giới hạn thời gian cho mỗi lư
 WIN_LENGTH = 5                          # Số quân liên tiếp cần để thắng
 COORDS = "ABCDEFGHIJKLMNO"              # Ký hiệu các cột A → O (15 cột)
 DIRS = [(1, 0), (0, 1), (1, 1), (1, -1)]  # 4 hướng kiểm tra: ngang, dọc, chéo chính, chéo phụ
+EMPTY = "."                             # Ký hiệu ô trống
+ZOBRIST_SEED = 0xC4A0_2024              # Seed cố định: mọi tiến trình/lần chạy ra cùng 1 mã Zobrist
 
 # ==========================
 # GỬI VÀ NHẬN DỮ LIỆU JSON QUA SOCKET
@@ -20,6 +28,13 @@ DIRS = [(1, 0), (0, 1), (1, 1), (1, -1)]  # 4 hướng kiểm tra: ngang, dọc,
 # Cache UTF-8 decoder để tăng hiệu suất
 _decoder = codecs.getincrementaldecoder('utf-8')()
 
+
+class ConnectionClosed(ConnectionError):
+    """
+    Bên kia đóng kết nối đàng hoàng (EOF đúng ranh giới tin nhắn) = tự thoát
+    Khác với ConnectionError thường (reset, đứt giữa tin nhắn) = rớt mạng
+    """
+
 async def send_json(writer: asyncio.StreamWriter, obj: Dict[str, Any]) -> None:
     """
     Gửi một object Python (dict) sang client/server qua kết nối TCP.
@@ -64,6 +79,374 @@ async def recv_json(reader: asyncio.StreamReader) -> Dict[str, Any]:
     return json.loads(text)
 
 
+# ==========================
+# GIAO THỨC NHỊ PHÂN (TÙY CHỌN)
+# ==========================
+# Client gửi {"type": "login", ..., "proto": PROTO_BINARY}; nếu server trả
+# login_ok có "proto": PROTO_BINARY thì sau login_ok cả 2 bên chuyển sang khung nhị phân:
+#   [độ dài 4 byte][loại 1 byte][payload]   (độ dài = 1 + len(payload))
+# Các tin nhắn nước đi (nhiều nhất) được pack bằng struct, còn lại gửi JSON trong khung.
+
+PROTO_JSON = "json"
+PROTO_BINARY = "bin1"
+SUPPORTED_PROTOS = (PROTO_JSON, PROTO_BINARY)
+
+MAX_FRAME_SIZE = 1 << 20                # Khung lớn nhất 1MB (chống client gửi rác)
+
+MSG_JSON = 0                            # Payload là JSON UTF-8
+MSG_MOVE = 1                            # client → server: x, y
+MSG_MOVE_OK = 2                         # server → client: x, y, symbol
+MSG_OPPONENT_MOVE = 3                   # server → client: x, y, symbol
+MSG_YOUR_TURN = 4                       # server → client: deadline (giây)
+
+_FRAME_HEADER = struct.Struct(">IB")
+_XY = struct.Struct(">BB")
+_XY_SYMBOL = struct.Struct(">BBc")
+_DEADLINE = struct.Struct(">f")
+
+_BINARY_TYPES = {"move": MSG_MOVE, "move_ok": MSG_MOVE_OK,
+                 "opponent_move": MSG_OPPONENT_MOVE, "your_turn": MSG_YOUR_TURN}
+_TYPE_NAMES = {v: k for k, v in _BINARY_TYPES.items()}
+
+
+def _frame(kind: int, payload: bytes) -> bytes:
+    return _FRAME_HEADER.pack(len(payload) + 1, kind) + payload
+
+
+def encode_frame(obj: Dict[str, Any]) -> bytes:
+    """
+    Đóng gói 1 message thành khung nhị phân.
+    Chỉ pack struct khi message đúng dạng chuẩn (không có trường lạ),
+    còn lại (hoặc dữ liệu bất thường) thì nhét JSON vào khung MSG_JSON.
+    """
+    kind = _BINARY_TYPES.get(obj.get("type"))
+    try:
+        if kind == MSG_MOVE and len(obj) == 3:
+            return _frame(kind, _XY.pack(obj["x"], obj["y"]))
+        if kind in (MSG_MOVE_OK, MSG_OPPONENT_MOVE) and len(obj) == 4:
+            return _frame(kind, _XY_SYMBOL.pack(obj["x"], obj["y"], obj["symbol"].encode("ascii")))
+        if kind == MSG_YOUR_TURN and len(obj) == 2:
+            return _frame(kind, _DEADLINE.pack(obj["deadline"]))
+    except (KeyError, TypeError, AttributeError, UnicodeEncodeError, struct.error):
+        pass
+    return _frame(MSG_JSON, json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+
+def decode_frame(kind: int, payload: bytes) -> Dict[str, Any]:
+    """
+    Giải mã payload của 1 khung nhị phân thành dict (cùng dạng với JSON)
+
+    Raises:
+        ValueError: loại khung không hợp lệ hoặc payload sai kích thước
+    """
+    try:
+        if kind == MSG_JSON:
+            return json.loads(payload.decode("utf-8"))
+        if kind == MSG_MOVE:
+            x, y = _XY.unpack(payload)
+            return {"type": "move", "x": x, "y": y}
+        if kind in (MSG_MOVE_OK, MSG_OPPONENT_MOVE):
+            x, y, sym = _XY_SYMBOL.unpack(payload)
+            return {"type": _TYPE_NAMES[kind], "x": x, "y": y, "symbol": sym.decode("ascii")}
+        if kind == MSG_YOUR_TURN:
+            (deadline,) = _DEADLINE.unpack(payload)
+            return {"type": "your_turn", "deadline": deadline}
+    except struct.error as e:
+        raise ValueError(f"Khung nhị phân sai kích thước: {e}") from e
+    raise ValueError(f"Loại khung không hợp lệ: {kind}")
+
+
+def encode_message(obj: Dict[str, Any], binary: bool = False) -> bytes:
+    """Mã hóa message theo giao thức đã thỏa thuận (JSON + '\n' hoặc khung nhị phân)"""
+    if binary:
+        return encode_frame(obj)
+    return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+async def send_frame(writer: asyncio.StreamWriter, obj: Dict[str, Any]) -> None:
+    """Giống send_json() nhưng gửi khung nhị phân"""
+    if writer.is_closing():
+        raise ConnectionError("Writer đã đóng")
+    writer.write(encode_frame(obj))
+    await writer.drain()
+
+
+async def recv_frame(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    """
+    Đọc đúng 1 khung nhị phân (readexactly - không phải dò tìm '\n' trong buffer)
+
+    Raises:
+        ConnectionError: Nếu kết nối bị đóng
+        ValueError: Khung không hợp lệ
+    """
+    try:
+        length, kind = _FRAME_HEADER.unpack(await reader.readexactly(_FRAME_HEADER.size))
+        if not 1 <= length <= MAX_FRAME_SIZE:
+            raise ValueError(f"Độ dài khung không hợp lệ: {length}")
+        payload = await reader.readexactly(length - 1)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError("Kết nối đã bị đóng") from e
+    return decode_frame(kind, payload)
+
+
+async def send_msg(writer: asyncio.StreamWriter, obj: Dict[str, Any], binary: bool = False) -> None:
+    """Gửi theo giao thức của kết nối: send_frame() nếu binary, ngược lại send_json()"""
+    if binary:
+        await send_frame(writer, obj)
+    else:
+        await send_json(writer, obj)
+
+
+async def recv_msg(reader: asyncio.StreamReader, binary: bool = False) -> Dict[str, Any]:
+    """Nhận theo giao thức của kết nối: recv_frame() nếu binary, ngược lại recv_json()"""
+    if binary:
+        return await recv_frame(reader)
+    return await recv_json(reader)
+
+
+# Tìm "type": "..." trong bytes thô (chuỗi JSON có \" bên trong không khớp được mẫu này)
+_TYPE_FIELD = re.compile(rb'"type"\s*:\s*"([A-Za-z_]{1,32})"')
+
+
+async def recv_raw(reader: asyncio.StreamReader, binary: bool = False) -> Tuple[int, bytes]:
+    """
+    Đọc 1 tin nhắn nhưng CHƯA giải mã: trả về (loại khung, payload)
+    Dòng JSON trả về (MSG_JSON, dòng) → giải mã sau bằng decode_frame() khi đã qua rate limit
+
+    Raises:
+        ConnectionClosed: Bên kia đóng kết nối đúng ranh giới tin nhắn (tự thoát)
+        ConnectionError: Kết nối bị reset / đứt giữa chừng 1 tin nhắn
+        ValueError: Khung/dòng không hợp lệ (quá dài...)
+    """
+    if not binary:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionClosed("Kết nối đã bị đóng")
+        if not line.endswith(b"\n"):
+            raise ConnectionError("Kết nối bị đứt giữa tin nhắn")
+        return MSG_JSON, line
+    try:
+        header = await reader.readexactly(_FRAME_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            raise ConnectionClosed("Kết nối đã bị đóng") from e
+        raise ConnectionError("Kết nối bị đứt giữa tin nhắn") from e
+    length, kind = _FRAME_HEADER.unpack(header)
+    if not 1 <= length <= MAX_FRAME_SIZE:
+        raise ValueError(f"Độ dài khung không hợp lệ: {length}")
+    try:
+        return kind, await reader.readexactly(length - 1)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError("Kết nối bị đứt giữa tin nhắn") from e
+
+
+def peek_type(kind: int, payload: bytes) -> Optional[str]:
+    """
+    Đoán loại tin nhắn từ bytes thô, không parse JSON (chỉ quét regex)
+    Trường "type" đầu tiên tìm thấy - client tử tế luôn khớp với kết quả giải mã thật
+    """
+    if kind != MSG_JSON:
+        return _TYPE_NAMES.get(kind)
+    m = _TYPE_FIELD.search(payload)
+    return m.group(1).decode("ascii") if m else None
+
+
+# ==========================
+# MÃ HÓA NHẬT KÝ NƯỚC ĐI (LƯU LỊCH SỬ)
+# ==========================
+# Thay cho json.dumps(moves) (~40 byte/nước): header 8 byte, rồi 1 byte chỉ số ô
+# (y * size + x) cho mỗi nước, rồi 2 byte/nước khoảng cách thời gian (giây) so với nước trước.
+# Ký hiệu không cần lưu: X luôn đi trước và 2 bên luân phiên.
+MOVES_VERSION = 1
+_MOVES_HEADER = struct.Struct("<BBHI")  # phiên bản, cỡ bàn, số nước, ts của nước đầu
+_MAX_DELTA = 0xFFFF
+
+
+def encode_moves(moves: List[Dict[str, Any]], size: int = BOARD_SIZE) -> bytes:
+    """
+    Đóng gói danh sách nước đi [{"x", "y", "symbol", "ts"}, ...] thành bytes (~3 byte/nước)
+    Khoảng cách thời gian âm (đồng hồ lùi) được ghi là 0, quá 65535 giây thì bị cắt
+
+    Raises:
+        ValueError: tọa độ ngoài bàn, ký hiệu không luân phiên X/O, bàn quá lớn (> 16x16)
+    """
+    if size * size > 256:
+        raise ValueError(f"Bàn {size}x{size} không vừa 1 byte/ô")
+    n = len(moves)
+    cells = bytearray(n)
+    deltas = array("H", bytes(2 * n))
+    base = prev = int(moves[0]["ts"]) if moves else 0
+    for i, mv in enumerate(moves):
+        x, y = mv["x"], mv["y"]
+        if not (0 <= x < size and 0 <= y < size):
+            raise ValueError(f"Tọa độ ngoài phạm vi: ({x}, {y})")
+        if mv["symbol"] != ("X" if i % 2 == 0 else "O"):
+            raise ValueError(f"Nước thứ {i} không đúng lượt: {mv['symbol']}")
+        cells[i] = y * size + x
+        delta = min(max(int(mv["ts"]) - prev, 0), _MAX_DELTA)
+        deltas[i] = delta
+        prev += delta
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    return _MOVES_HEADER.pack(MOVES_VERSION, size, n, base) + bytes(cells) + deltas.tobytes()
+
+
+def _moves_header(data: bytes) -> Tuple[int, int, int]:
+    try:
+        version, size, n, base = _MOVES_HEADER.unpack_from(data)
+    except struct.error as e:
+        raise ValueError(f"Nhật ký nước đi quá ngắn: {e}") from e
+    if version != MOVES_VERSION:
+        raise ValueError(f"Phiên bản nhật ký nước đi không hỗ trợ: {version}")
+    if len(data) != _MOVES_HEADER.size + 3 * n:
+        raise ValueError("Nhật ký nước đi sai kích thước")
+    return size, n, base
+
+
+def decode_moves(data: bytes) -> List[Dict[str, Any]]:
+    """
+    Ngược lại của encode_moves(): trả về đúng dạng [{"x", "y", "symbol", "ts"}, ...]
+
+    Raises:
+        ValueError: dữ liệu hỏng hoặc sai phiên bản
+    """
+    size, n, ts = _moves_header(data)
+    start = _MOVES_HEADER.size
+    deltas = array("H")
+    deltas.frombytes(data[start + n:])
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    moves = []
+    for i, (cell, delta) in enumerate(zip(data[start:start + n], deltas)):
+        ts += delta
+        y, x = divmod(cell, size)
+        moves.append({"x": x, "y": y, "symbol": "X" if i % 2 == 0 else "O", "ts": ts})
+    return moves
+
+
+def move_cells(data: bytes) -> Tuple[int, bytes]:
+    """
+    Đường nhanh cho việc quét hàng loạt: (cỡ bàn, chỉ số ô theo thứ tự đi) - không tạo dict nào
+    Nước thứ i nằm ở ô divmod(cells[i], size) = (y, x), là X nếu i chẵn
+    """
+    size, n, _ = _moves_header(data)
+    start = _MOVES_HEADER.size
+    return size, data[start:start + n]
+
+
+# ==========================
+# PHIÊN KẾT NỐI PHÍA CLIENT (test, benchmark, load test)
+# ==========================
+
+class GameClient:
+    """
+    1 người chơi nói chuyện với server qua asyncio
+    - login(): đăng nhập + thỏa thuận giao thức (login_ok luôn là JSON)
+    - send()/recv(): theo giao thức đã chốt; min_interval giãn nhịp gửi
+      để không dính rate limit của server; recv() tự trả lời ping của server
+    - resume(): rớt mạng giữa trận thì kết nối lại bằng mã phiên (session) nhận lúc login
+    - sent/received: đếm số tin đã gửi/nhận
+    """
+
+    def __init__(self, name: str, binary: bool = False, min_interval: float = 0.0):
+        self.name = name
+        self.binary = binary
+        self.min_interval = min_interval
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.users_seq: Optional[int] = None
+        self.session: Optional[str] = None
+        self.last_send = 0.0
+        self.sent = 0
+        self.received = 0
+
+    async def login(self, host: str, port: int) -> Dict[str, Any]:
+        """
+        Kết nối và đăng nhập, trả về login_ok
+
+        Raises:
+            ConnectionError: Server từ chối (tên trùng, không hợp lệ...) hoặc mất kết nối
+        """
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        login = {"type": "login", "name": self.name}
+        if self.binary:
+            login["proto"] = PROTO_BINARY
+        await send_json(self.writer, login)
+        response = await recv_json(self.reader)
+        if response.get("type") != "login_ok":
+            await self.close()
+            raise ConnectionError(response.get("msg", "Login failed"))
+        return self._handshake_done(response)
+
+    async def resume(self, host: str, port: int) -> Dict[str, Any]:
+        """
+        Kết nối lại và gắn vào phiên cũ (trận đang đánh vẫn còn), trả về resume_ok
+        Server gửi tiếp match_state (+ your_turn nếu đang đến lượt) ngay sau đó
+
+        Raises:
+            ConnectionError: Phiên đã hết hạn hoặc mất kết nối
+        """
+        binary = self.binary
+        await self.close()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        resume = {"type": "resume", "session": self.session}
+        if binary:
+            resume["proto"] = PROTO_BINARY
+        await send_json(self.writer, resume)
+        response = await recv_json(self.reader)
+        if response.get("type") != "resume_ok":
+            await self.close()
+            raise ConnectionError(response.get("msg", "Resume failed"))
+        return self._handshake_done(response)
+
+    def _handshake_done(self, response: Dict[str, Any]) -> Dict[str, Any]:
+        # Server không hỗ trợ nhị phân → tiếp tục dùng JSON
+        self.binary = response.get("proto") == PROTO_BINARY
+        self.users_seq = response.get("seq")
+        self.session = response.get("session")
+        return response
+
+    async def send(self, obj: Dict[str, Any]) -> None:
+        if self.min_interval:
+            loop = asyncio.get_running_loop()
+            wait = self.last_send + self.min_interval - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.last_send = loop.time()
+        await send_msg(self.writer, obj, self.binary)
+        self.sent += 1
+
+    async def recv(self) -> Dict[str, Any]:
+        while True:
+            msg = await recv_msg(self.reader, self.binary)
+            self.received += 1
+            t = msg.get("type")
+            if t == "session":
+                self.session = msg.get("session")  # Đổi shard → mã phiên mới
+            elif t == "ping":
+                # Server hỏi kết nối im lặng còn sống không → trả lời luôn, người gọi không cần biết
+                await send_msg(self.writer, {"type": "pong"}, self.binary)
+            else:
+                return msg
+
+    async def wait_for(self, *types: str) -> Dict[str, Any]:
+        """Bỏ qua mọi tin khác cho đến khi gặp 1 trong các loại `types`"""
+        while True:
+            msg = await self.recv()
+            if msg.get("type") in types:
+                return msg
+
+    async def close(self) -> None:
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        self.reader = None
+        self.writer = None
+
+
 # ==========================
 # XỬ LÝ TỌA ĐỘ
 # ==========================
@@ -111,16 +494,318 @@ def format_coord(x: int, y: int) -> str:
     return f"({x},{y})"
 
 
+# ==========================
+# BÀN CỜ DẠNG BITBOARD
+# ==========================
+
+def _run_steps(shift: int, length: int = WIN_LENGTH) -> Tuple[int, ...]:
+    """
+    Các độ dịch cần AND liên tiếp để còn lại đúng các bit bắt đầu một chuỗi
+    `length` quân theo hướng `shift`. Dùng kỹ thuật nhân đôi nên chỉ cần
+    ~log2(length) phép dịch (WIN_LENGTH=5 → 3 phép).
+    """
+    steps, n = [], 1
+    while n * 2 <= length:
+        steps.append(shift * n)
+        n *= 2
+    if n < length:
+        steps.append(shift * (length - n))
+    return tuple(steps)
+
+
+@lru_cache(maxsize=None)
+def _board_geometry(size: int) -> Tuple[Tuple[Tuple[int, ...], Tuple[int, ...]], ...]:
+    """
+    Tính sẵn (1 lần cho mỗi kích thước, dùng chung cho mọi Board) hằng số bitboard.
+
+    Returns:
+        Mỗi hướng trong DIRS một cặp (steps, windows):
+        - steps: các độ dịch bit cho _run_steps
+        - windows[bit]: mask các ô cách ô `bit` tối đa WIN_LENGTH-1 bước theo
+          hướng đó (dùng cho check_win cục bộ)
+    """
+    stride = size + 1
+    geometry = []
+    for dx, dy in DIRS:
+        masks = [0] * (stride * size)
+        for y in range(size):
+            for x in range(size):
+                m = 0
+                for k in range(-(WIN_LENGTH - 1), WIN_LENGTH):
+                    nx, ny = x + k * dx, y + k * dy
+                    if 0 <= nx < size and 0 <= ny < size:
+                        m |= 1 << (ny * stride + nx)
+                masks[y * stride + x] = m
+        geometry.append((_run_steps(abs(dy * stride + dx)), tuple(masks)))
+    return tuple(geometry)
+
+
+@lru_cache(maxsize=None)
+def zobrist_keys(size: int) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """
+    Bảng số ngẫu nhiên 64 bit cho (ô, quân), đánh số ô theo bit của Board (y * (size + 1) + x)
+    Sinh từ ZOBRIST_SEED nên ổn định giữa các tiến trình và lần chạy (lưu xuống database được)
+    """
+    rng = random.Random(ZOBRIST_SEED ^ size)
+    n = (size + 1) * size
+    return tuple(rng.getrandbits(64) for _ in range(n)), tuple(rng.getrandbits(64) for _ in range(n))
+
+
+def zobrist_hashes(size: int, cells: bytes) -> List[int]:
+    """
+    Mã Zobrist sau từng nước của 1 nhật ký nước đi (cells từ move_cells(), X đi trước)
+    Không dựng Board → dùng cho quét lịch sử hàng loạt (trùng thế cờ, khai cuộc lặp lại...)
+    """
+    x_keys, o_keys = zobrist_keys(size)
+    stride = size + 1
+    h = 0
+    out = []
+    for i, cell in enumerate(cells):
+        y, x = divmod(cell, size)
+        h ^= (x_keys if i % 2 == 0 else o_keys)[y * stride + x]
+        out.append(h)
+    return out
+
+
+class Board:
+    """
+    Bàn cờ dạng bitboard - thay cho ma trận List[List[str]].
+
+    - Mỗi người chơi có 1 bitmask (số nguyên Python): ô (x, y) ứng với bit
+      y * (size + 1) + x. Cột đệm cuối mỗi hàng luôn trống để phép dịch bit
+      không "tràn" sang hàng bên cạnh.
+    - Đếm số quân tăng dần mỗi lần đặt → kiểm tra hòa O(1).
+    - zobrist: mã băm 64 bit của thế cờ, XOR thêm/bớt 1 số mỗi lần đặt/bỏ quân (O(1));
+      cùng tập quân thì cùng mã, bất kể thứ tự đi. Lượt đi suy ra từ số quân nên không cần băm
+    - Vẫn hỗ trợ đọc board[y][x], len(board), duyệt từng hàng để code cũ dùng được (chỉ đọc).
+    """
+    __slots__ = ("size", "stride", "x_bits", "o_bits", "x_count", "o_count", "zobrist", "_geo", "_zkeys")
+
+    def __init__(self, size: int = BOARD_SIZE):
+        self.size = size
+        self.stride = size + 1
+        self._geo = _board_geometry(size)
+        self._zkeys = zobrist_keys(size)
+        self.x_bits = 0
+        self.o_bits = 0
+        self.x_count = 0
+        self.o_count = 0
+        self.zobrist = 0
+
+    # ---------- Truy cập ô ----------
+
+    def _bit(self, x: int, y: int) -> int:
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            raise IndexError(f"Tọa độ ngoài phạm vi: ({x}, {y})")
+        return 1 << (y * self.stride + x)
+
+    def bits_of(self, symbol: str) -> int:
+        """Bitmask các ô của người chơi `symbol`"""
+        if symbol == "X":
+            return self.x_bits
+        if symbol == "O":
+            return self.o_bits
+        raise ValueError(f"Ký hiệu không hợp lệ: {symbol!r}")
+
+    def get(self, x: int, y: int) -> str:
+        """Trả về 'X', 'O' hoặc '.' tại ô (x, y)"""
+        bit = self._bit(x, y)
+        if self.x_bits & bit:
+            return "X"
+        if self.o_bits & bit:
+            return "O"
+        return EMPTY
+
+    def is_empty(self, x: int, y: int) -> bool:
+        return not ((self.x_bits | self.o_bits) & self._bit(x, y))
+
+    def place(self, x: int, y: int, symbol: str) -> None:
+        """
+        Đặt quân `symbol` vào ô (x, y).
+
+        Raises:
+            IndexError: tọa độ ngoài bàn cờ
+            ValueError: ô đã có quân hoặc ký hiệu không hợp lệ
+        """
+        bit = self._bit(x, y)
+        if (self.x_bits | self.o_bits) & bit:
+            raise ValueError(f"Ô ({x}, {y}) đã có quân")
+        if symbol == "X":
+            self.x_bits |= bit
+            self.x_count += 1
+            self.zobrist ^= self._zkeys[0][y * self.stride + x]
+        elif symbol == "O":
+            self.o_bits |= bit
+            self.o_count += 1
+            self.zobrist ^= self._zkeys[1][y * self.stride + x]
+        else:
+            raise ValueError(f"Ký hiệu không hợp lệ: {symbol!r}")
+
+    def remove(self, x: int, y: int) -> None:
+        """
+        Bỏ quân ở ô (x, y) - ngược lại của place() (máy tìm nước đi thử rồi lùi lại)
+
+        Raises:
+            IndexError: tọa độ ngoài bàn cờ
+            ValueError: ô đang trống
+        """
+        bit = self._bit(x, y)
+        if self.x_bits & bit:
+            self.x_bits &= ~bit
+            self.x_count -= 1
+            self.zobrist ^= self._zkeys[0][y * self.stride + x]
+        elif self.o_bits & bit:
+            self.o_bits &= ~bit
+            self.o_count -= 1
+            self.zobrist ^= self._zkeys[1][y * self.stride + x]
+        else:
+            raise ValueError(f"Ô ({x}, {y}) đang trống")
+
+    # ---------- Trạng thái bàn cờ ----------
+
+    @property
+    def move_count(self) -> int:
+        return self.x_count + self.o_count
+
+    def is_full(self) -> bool:
+        """Hết ô trống (hòa) - O(1) nhờ bộ đếm"""
+        return self.x_count + self.o_count == self.size * self.size
+
+    def has_five(self, symbol: str) -> bool:
+        """Người chơi `symbol` có chuỗi >= WIN_LENGTH quân ở bất kỳ đâu trên bàn không"""
+        bits = self.bits_of(symbol)
+        for steps, _ in self._geo:
+            m = bits
+            for st in steps:
+                m &= m >> st
+            if m:
+                return True
+        return False
+
+    def check_win(self, x: int, y: int, symbol: str) -> bool:
+        """
+        Có chuỗi >= WIN_LENGTH quân đi qua ô (x, y) không.
+        Chỉ xét "cửa sổ" 2*WIN_LENGTH-1 ô quanh (x, y) trên mỗi hướng, nên
+        mọi chuỗi tìm được chắc chắn chứa (x, y).
+        """
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            raise IndexError(f"Tọa độ ngoài phạm vi: ({x}, {y})")
+        idx = y * self.stride + x
+        bits = (self.x_bits if symbol == "X" else self.o_bits) | (1 << idx)
+        for steps, windows in self._geo:
+            m = bits & windows[idx]
+            for st in steps:
+                m &= m >> st
+            if m:
+                return True
+        return False
+
+    def win_line(self, x: int, y: int, symbol: str) -> List[Tuple[int, int]]:
+        """
+        Danh sách ô của đường thắng dài nhất đi qua (x, y), [] nếu chưa thắng.
+        Chỉ duyệt từng ô khi bitboard đã xác nhận có đường thắng.
+        """
+        bit = self._bit(x, y)
+        bits = self.bits_of(symbol) | bit
+        idx = bit.bit_length() - 1
+        n, stride = self.size, self.stride
+        best_line: List[Tuple[int, int]] = []
+
+        for (dx, dy), (steps, windows) in zip(DIRS, self._geo):
+            m = bits & windows[idx]
+            for st in steps:
+                m &= m >> st
+            if not m:
+                continue
+            line = [(x, y)]
+            for direction in (-1, 1):
+                nx, ny = x + dx * direction, y + dy * direction
+                while 0 <= nx < n and 0 <= ny < n and bits >> (ny * stride + nx) & 1:
+                    if direction == -1:
+                        line.insert(0, (nx, ny))
+                    else:
+                        line.append((nx, ny))
+                    nx += dx * direction
+                    ny += dy * direction
+            if len(line) > len(best_line):
+                best_line = line
+        return best_line
+
+    # ---------- Chuyển đổi ----------
+
+    def copy(self) -> "Board":
+        b = Board.__new__(Board)
+        b.size, b.stride = self.size, self.stride
+        b.x_bits, b.o_bits = self.x_bits, self.o_bits
+        b.x_count, b.o_count = self.x_count, self.o_count
+        b.zobrist = self.zobrist
+        b._geo, b._zkeys = self._geo, self._zkeys
+        return b
+
+    @classmethod
+    def from_bits(cls, x_bits: int, o_bits: int, size: int = BOARD_SIZE) -> "Board":
+        """Dựng lại bàn từ 2 bitmask (x_bits/o_bits của 1 Board khác, ví dụ gửi qua tiến trình con)"""
+        b = cls(size)
+        if x_bits & o_bits or (x_bits | o_bits) >> (b.stride * size):
+            raise ValueError("Bitmask không hợp lệ")
+        b.x_bits, b.o_bits = x_bits, o_bits
+        b.x_count, b.o_count = bin(x_bits).count("1"), bin(o_bits).count("1")
+        x_keys, o_keys = b._zkeys
+        for bits, keys in ((x_bits, x_keys), (o_bits, o_keys)):
+            while bits:
+                low = bits & -bits
+                b.zobrist ^= keys[low.bit_length() - 1]
+                bits ^= low
+        return b
+
+    def to_rows(self) -> List[List[str]]:
+        """Chuyển về dạng ma trận List[List[str]] như cũ"""
+        return [self.row(y) for y in range(self.size)]
+
+    @classmethod
+    def from_rows(cls, rows: List[List[str]]) -> "Board":
+        """Tạo bitboard từ ma trận List[List[str]]"""
+        b = cls(len(rows))
+        for y, row in enumerate(rows):
+            for x, cell in enumerate(row):
+                if cell in ("X", "O"):
+                    b.place(x, y, cell)
+        return b
+
+    def row(self, y: int) -> List[str]:
+        base = y * self.stride
+        xb, ob = self.x_bits >> base, self.o_bits >> base
+        return ["X" if xb >> x & 1 else "O" if ob >> x & 1 else EMPTY for x in range(self.size)]
+
+    # Tương thích với code cũ đọc board[y][x], len(board), for row in board.
+    # CHỈ ĐỌC: hàng trả về là tuple nên board[y][x] = symbol báo TypeError thay vì lặng lẽ
+    # ghi vào 1 bản sao - muốn đặt/bỏ quân thì dùng place()/remove()
+    def __getitem__(self, y: int) -> Tuple[str, ...]:
+        if not 0 <= y < self.size:
+            raise IndexError(y)
+        return tuple(self.row(y))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[Tuple[str, ...]]:
+        for y in range(self.size):
+            yield tuple(self.row(y))
+
+
+BoardLike = Union[Board, List[List[str]]]
+
+
 # ==========================
 # KIỂM TRA THẮNG/THUA
 # ==========================
 
-def check_win(board: List[List[str]], x: int, y: int, symbol: str) -> bool:
+def check_win(board: BoardLike, x: int, y: int, symbol: str) -> bool:
     """
     Kiểm tra xem người chơi có thắng không sau khi đánh tại (x, y).
     
     Args:
-        board: Ma trận bàn cờ
+        board: Bàn cờ (Board hoặc ma trận List[List[str]])
         x: Tọa độ cột vừa đánh
         y: Tọa độ hàng vừa đánh
         symbol: Ký hiệu của người chơi ('X' hoặc 'O')
@@ -129,6 +814,9 @@ def check_win(board: List[List[str]], x: int, y: int, symbol: str) -> bool:
         True nếu có ít nhất WIN_LENGTH quân liên tiếp
         False nếu chưa thắng
     """
+    if isinstance(board, Board):
+        return board.check_win(x, y, symbol)
+    
     n = len(board)
     
     # Duyệt qua 4 hướng: ngang, dọc, chéo chính, chéo phụ
@@ -157,13 +845,13 @@ def check_win(board: List[List[str]], x: int, y: int, symbol: str) -> bool:
     return False
 
 
-def find_win_line(board: List[List[str]], x: int, y: int, symbol: str) -> List[Tuple[int, int]]:
+def find_win_line(board: BoardLike, x: int, y: int, symbol: str) -> List[Tuple[int, int]]:
     """
     Tìm danh sách các ô tạo thành đường thắng (>=WIN_LENGTH quân liên tiếp)
     có chứa vị trí (x, y) của người chơi.
     
     Args:
-        board: Ma trận bàn cờ
+        board: Bàn cờ (Board hoặc ma trận List[List[str]])
         x: Tọa độ cột vừa đánh
         y: Tọa độ hàng vừa đánh
         symbol: Ký hiệu của người chơi ('X' hoặc 'O')
@@ -172,6 +860,9 @@ def find_win_line(board: List[List[str]], x: int, y: int, symbol: str) -> List[T
         Danh sách tọa độ [(x1, y1), (x2, y2), ...] của đường thắng
         Danh sách rỗng [] nếu không có đường thắng
     """
+    if isinstance(board, Board):
+        return board.win_line(x, y, symbol)
+    
     n = len(board)
     best_line: List[Tuple[int, int]] = []
     
@@ -206,33 +897,39 @@ def find_win_line(board: List[List[str]], x: int, y: int, symbol: str) -> List[T
     return best_line if len(best_line) >= WIN_LENGTH else []
 
 
-def is_board_full(board: List[List[str]]) -> bool:
+def is_board_full(board: BoardLike) -> bool:
     """
     Kiểm tra xem bàn cờ đã đầy chưa (hòa).
     
     Args:
-        board: Ma trận bàn cờ
+        board: Bàn cờ (Board hoặc ma trận List[List[str]])
         
     Returns:
         True nếu không còn ô trống
         False nếu còn ô trống
     """
+    if isinstance(board, Board):
+        return board.is_full()
+    
     for row in board:
         if '.' in row:
             return False
     return True
 
 
-def count_moves(board: List[List[str]]) -> int:
+def count_moves(board: BoardLike) -> int:
     """
     Đếm số nước đã đánh trên bàn cờ.
     
     Args:
-        board: Ma trận bàn cờ
+        board: Bàn cờ (Board hoặc ma trận List[List[str]])
         
     Returns:
         Số lượng ô đã có quân (X hoặc O)
     """
+    if isinstance(board, Board):
+        return board.move_count
+    
     count = 0
     for row in board:
         for cell in row:
@@ -245,12 +942,12 @@ def count_moves(board: List[List[str]]) -> int:
 # VALIDATION
 # ==========================
 
-def validate_move(board: List[List[str]], x: int, y: int) -> tuple[bool, str]:
+def validate_move(board: BoardLike, x: int, y: int) -> tuple[bool, str]:
     """
     Kiểm tra tính hợp lệ của một nước đi.
     
     Args:
-        board: Ma trận bàn cờ
+        board: Bàn cờ (Board hoặc ma trận List[List[str]])
         x: Tọa độ cột
         y: Tọa độ hàng
         
@@ -265,7 +962,8 @@ def validate_move(board: List[List[str]], x: int, y: int) -> tuple[bool, str]:
         return False, f"Tọa độ ngoài phạm vi (0-{n-1})"
     
     # Kiểm tra ô có trống không
-    if board[y][x] != '.':
+    occupied = not board.is_empty(x, y) if isinstance(board, Board) else board[y][x] != '.'
+    if occupied:
         return False, "Ô này đã có quân"
     
     return True, "OK"
@@ -275,12 +973,12 @@ def validate_move(board: List[List[str]], x: int, y: int) -> tuple[bool, str]:
 # TIỆN ÍCH HIỂN THỊ
 # ==========================
 
-def print_board(board: List[List[str]]) -> None:
+def print_board(board: BoardLike) -> None:
     """
     In bàn cờ ra console (dùng cho CLI client).
     
     Args:
-        board: Ma trận bàn cờ
+        board: Bàn cờ (Board hoặc ma trận List[List[str]])
     """
     n = len(board)
     
@@ -297,12 +995,12 @@ def print_board(board: List[List[str]]) -> None:
     print("  +" + "-" * (n * 2 - 1) + "+")
 
 
-def board_to_string(board: List[List[str]]) -> str:
+def board_to_string(board: BoardLike) -> str:
     """
     Chuyển bàn cờ thành chuỗi để lưu hoặc truyền đi.
     
     Args:
-        board: Ma trận bàn cờ
+        board: Bàn cờ (Board hoặc ma trận List[List[str]])
         
     Returns:
         Chuỗi đại diện cho bàn cờ
@@ -16,6 +16,7 @@ BOARD_SIZE = 15
 RESIZE_DEBOUNCE_MS = 100   # Tăng lên 100ms để tránh lag khi resize
 UPDATE_QUEUE_MS = 50       # Giảm xuống 50ms để responsive hơn
 RECONNECT_DELAY = 2.0
+RESUME_ATTEMPTS = 5        # Rớt mạng giữa trận: thử resume tối đa 5 lần liên tiếp
 HEARTBEAT_INTERVAL = 5.0   # Ping server mỗi 5s để check connection
 
 class GuiClient:
@@ -43,6 +44,10 @@ class GuiClient:
         self.resize_debounce = None
         self.is_closing = False
         self.last_move_time = 0  # Track để tránh double-click
+        self.users = []  # Tên theo đúng thứ tự các dòng trong users_listbox
+        self.users_seq = None  # Số thứ tự danh sách online đã áp dụng (None = chưa có snapshot)
+        self.session = None  # Mã phiên server cấp lúc login, dùng để resume khi rớt mạng
+        self.resumed = False
 
         # ============================================
         # TRẠNG THÁI BÀN CỜ
@@ -494,17 +499,33 @@ class GuiClient:
             self.reader = None
 
     async def async_main(self):
-        """Hàm chính của async thread"""
+        """Hàm chính của async thread: đăng nhập, rớt mạng giữa trận thì thử resume phiên"""
+        first = {'type': 'login', 'name': self.name}
+        attempts = 0
+        while True:
+            dropped = await self.run_connection(first)
+            attempts = 0 if self.resumed else attempts + 1
+            if not dropped or self.is_closing or not self.in_match or not self.session \
+                    or attempts > RESUME_ATTEMPTS:
+                break
+            # Server giữ trận + đồng hồ một lúc chờ mình quay lại → nối lại bằng mã phiên
+            self.queue.put((self.set_status, ('🔄 Connection lost, reconnecting...',)))
+            await asyncio.sleep(RECONNECT_DELAY)
+            first = {'type': 'resume', 'session': self.session}
+        self.queue.put((self.handle_disconnect, ()))
+
+    async def run_connection(self, first):
+        """1 kết nối: gửi login/resume rồi đọc đến khi đóng; True nếu bị rớt (không phải tự ngắt)"""
+        self.resumed = False
         try:
             self.reader, self.writer = await asyncio.open_connection(HOST, PORT)
             self.queue.put((self.update_connection_indicator, (True,)))
         except Exception as e:
             self.queue.put((self.set_status, (f'Connect failed: {e}',)))
-            self.queue.put((self.handle_disconnect, ()))
-            return
+            return first['type'] == 'resume'
 
-        # Gửi login
-        await self.send_json_async({'type': 'login', 'name': self.name})
+        await self.send_json_async(first)
+        heartbeat = asyncio.create_task(self.heartbeat())
 
         try:
             while True:
@@ -513,15 +534,30 @@ class GuiClient:
                     break
                 
                 msg = json.loads(line.decode('utf-8').strip())
+                t = msg.get('type')
+                if t == 'ping':
+                    # Server hỏi còn sống không → trả lời ngay từ thread mạng
+                    await self.send_json_async({'type': 'pong'})
+                    continue
+                if t == 'pong':
+                    continue
+                if t in ('login_ok', 'resume_ok', 'session'):
+                    # Giữ mã phiên ở thread mạng để còn resume khi rớt
+                    self.session = msg.get('session')
+                    self.resumed = self.resumed or t == 'resume_ok'
                 self.queue.put((self.handle_msg, (msg,)))
+            return True
                 
         except asyncio.CancelledError:
             print("[INFO] Connection cancelled")
+            return False
         except Exception as e:
             if not self.is_closing:
                 print(f"[ERROR] Connection error: {e}")
+            return True
         finally:
-            self.queue.put((self.handle_disconnect, ()))
+            heartbeat.cancel()
+            self.queue.put((self.update_connection_indicator, (False,)))
             if self.writer:
                 try:
                     self.writer.close()
@@ -531,6 +567,15 @@ class GuiClient:
                 self.writer = None
             self.reader = None
 
+    async def heartbeat(self):
+        """Ping server mỗi HEARTBEAT_INTERVAL để server không coi kết nối là đã chết"""
+        try:
+            while self.writer and not self.writer.is_closing():
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+                await self.send_json_async({'type': 'ping'})
+        except asyncio.CancelledError:
+            pass
+
     async def send_json_async(self, obj):
         """Gửi JSON lên server"""
         if not self.writer or self.writer.is_closing():
@@ -643,6 +688,8 @@ class GuiClient:
         self.challenge_btn['state'] = 'disabled'
         self.name_entry.config(state='normal')
         self.users_listbox.delete(0, tk.END)
+        self.users = []
+        self.users_seq = None
         self.clear_board()
         self.disable_board()
         self.stop_countdown()
@@ -659,14 +706,48 @@ class GuiClient:
             self.connect_btn['state'] = 'disabled'
             self.disconnect_btn['state'] = 'normal'
             self.challenge_btn['state'] = 'normal'
+            self.users_seq = msg.get('seq')
             self.update_users(msg.get('users', []))
             self.append_chat('╔════════════════════════╗\n', "system")
             self.append_chat('║  Connected to server  ║\n', "system")
             self.append_chat('╚════════════════════════╝\n', "system")
 
+        elif t == 'resume_ok':
+            self.set_status(f'✅ Reconnected as {self.name}')
+            self.users_seq = msg.get('seq')
+            self.update_users(msg.get('users', []))
+            self.append_chat('🔄 Reconnected - match resumed\n', "system")
+
+        elif t == 'match_state':
+            # Trạng thái trận sau khi resume: ô theo thứ tự đi (y * size + x), X đi trước
+            self.in_match = True
+            self.you = msg.get('you')
+            self.opponent = msg.get('opponent')
+            self.turn = None
+            self.clear_board()
+            self.disable_board()
+            size = msg.get('size', BOARD_SIZE)
+            for i, cell in enumerate(msg.get('moves', [])):
+                y, x = divmod(cell, size)
+                self.set_cell(x, y, "X" if i % 2 == 0 else "O")
+                self.last_move = (x, y)
+            self.draw_highlights()
+            self.set_status(f'⚔️ Playing vs {self.opponent} (You: {self.you})')
+
+        elif t == 'opponent_disconnected':
+            self.append_chat(f'📡 {self.opponent} lost connection, waiting up to {msg.get("grace", 0):g}s...\n', "system")
+
+        elif t == 'opponent_reconnected':
+            self.append_chat(f'📡 {self.opponent} reconnected\n', "system")
+
         elif t == 'user_list':
+            # Snapshot đầy đủ (server gửi lại khi mình yêu cầu user_sync)
+            self.users_seq = msg.get('seq')
             self.update_users(msg.get('users', []))
 
+        elif t == 'user_delta':
+            self.handle_user_delta(msg)
+
         elif t == 'challenge_sent':
             to = msg.get('to')
             self.append_chat(f'⏳ Waiting for {to} to accept...\n', "system")
@@ -864,6 +945,35 @@ class GuiClient:
         if new_index is not None:
             self.users_listbox.selection_set(new_index)
             self.users_listbox.see(new_index)
+        self.users = list(users)
+
+    def handle_user_delta(self, msg):
+        """
+        Áp dụng phần thay đổi danh sách online theo số thứ tự
+        - Tin cũ/trùng (seq <= đã có) → bỏ qua
+        - Nhảy số (mất tin) → xin lại snapshot bằng user_sync
+        """
+        seq = msg.get('seq')
+        if self.users_seq is None or seq is None or seq <= self.users_seq:
+            return
+        if seq != self.users_seq + 1:
+            self.users_seq = None  # Bỏ qua delta cho đến khi có snapshot mới
+            self.send_json({'type': 'user_sync'})
+            return
+        self.users_seq = seq
+        self.apply_user_delta(msg.get('joined', []), msg.get('left', []))
+
+    def apply_user_delta(self, joined, left):
+        """Chỉ thêm/xóa đúng các dòng thay đổi, không dựng lại cả Listbox (giữ nguyên selection)"""
+        for u in left:
+            if u in self.users:
+                i = self.users.index(u)
+                del self.users[i]
+                self.users_listbox.delete(i)
+        for u in joined:
+            if u not in self.users:
+                self.users.append(u)
+                self.users_listbox.insert(tk.END, u)
 
 
 def main():
@@ -2,9 +2,14 @@ import tkinter as tk                # Thư viện giao diện GUI chính
 from tkinter import messagebox      # Dùng để hiển thị hộp thoại thông báo
 import threading                    # Dùng để chạy server trong thread riêng
 import asyncio                      # Dùng để chạy server bất đồng bộ (async)
+import queue                        # Hàng đợi nhận thay đổi trạng thái từ thread server
+from bisect import bisect_left      # Tìm vị trí dòng trong Listbox (khóa đã sắp xếp)
 from server import CaroServer          
 from match_viewer import MatchViewer
 
+UI_POLL_MS = 200    # Nhịp đọc hàng đợi thay đổi (server đã gộp thay đổi mỗi 250ms)
+
+
 class GuiServer:
     def __init__(self, root: tk.Tk):
         # Lưu lại cửa sổ gốc Tkinter
@@ -21,6 +26,15 @@ class GuiServer:
         self.server_loop: asyncio.AbstractEventLoop | None = None   # Event loop của asyncio, dùng để chạy server.
         self.server_thread: threading.Thread | None = None          # Thread chạy server, không làm treo giao diện Tkinter.
 
+        # Trạng thái server nhận qua hàng đợi (snapshot + thay đổi), KHÔNG đọc thẳng
+        # server.clients / server.matches vì thread server đang sửa chúng
+        self.state_events: queue.Queue | None = None
+        self.state_seq = -1
+        self.client_keys: list[str] = []    # Khóa đã sắp xếp, trùng thứ tự dòng trong Listbox
+        self.client_rows: dict = {}
+        self.match_keys: list[str] = []
+        self.match_rows: dict = {}
+
 
         # ====================== GIAO DIỆN PHÍA TRÊN =======================
 
@@ -98,8 +112,8 @@ class GuiServer:
             command=self.open_match_viewer      # Mở viewer trận đấu
         ).pack(pady=5)
 
-        # Thiết lập cập nhật UI mỗi 300ms
-        self.root.after(300, self.update_ui)
+        # Thiết lập đọc thay đổi mỗi UI_POLL_MS
+        self.root.after(UI_POLL_MS, self.update_ui)
 
     # ===================================================
     # START SERVER
@@ -132,10 +146,16 @@ class GuiServer:
         except Exception as e:
             print(f"[WARN] Failed to get local IP: {e}")
 
+        server = self.server
+        self.state_events = events = queue.Queue()     # Mỗi lần chạy 1 hàng đợi mới, không lẫn tin cũ
+        self.state_seq = -1
+
         def run_server():
             try:
                 self.server_loop = asyncio.new_event_loop()                 # Tạo event loop mới
                 asyncio.set_event_loop(self.server_loop)                    # Gán loop này làm loop chính
+                # Đăng ký nhận trạng thái ngay khi loop bắt đầu chạy (trên thread của loop)
+                self.server_loop.call_soon(server.subscribe_state, events.put)
                 self.server_loop.run_until_complete(self.server.start())    # Chạy server
             except asyncio.CancelledError:
                 pass
@@ -154,6 +174,10 @@ class GuiServer:
                         self.server_loop.close()
                 except Exception as e:
                     print("[Server Loop Close Error]", e)
+                
+                # Ghi nốt lịch sử trận đấu còn trong hàng đợi (an toàn nếu stop() đã làm rồi)
+                server.history.stop()
+                server.journal.stop()
 
         # Tạo thread chạy server
         self.server_thread = threading.Thread(target=run_server, daemon=True)
@@ -193,6 +217,7 @@ class GuiServer:
         self.server_thread = None
         self.server_loop = None
         self.server = None
+        self.state_events = None
 
         # Reset giao diện
         self.btn_start["state"] = "normal"
@@ -203,40 +228,93 @@ class GuiServer:
         self.lbl_host["text"] = "Host: ---"
 
         # Xóa danh sách client và trận đấu
-        self.clients_list.delete(0, tk.END)
-        self.matches_list.delete(0, tk.END)
-        self.lbl_clients_count["text"] = "Total: 0 users"
+        self.load_snapshot({}, {})
 
     # ===================================================
-    # UI UPDATE LOOP (KEEP SELECTION)
+    # UI UPDATE LOOP - ÁP DỤNG THAY ĐỔI TỪ SERVER
     # ===================================================
     def update_ui(self):
-        if self.server:
-
-            # ============ Update Clients ============
-            self.clients_list.delete(0, tk.END)
-            for name in list(self.server.clients.keys()):
-                self.clients_list.insert(tk.END, name)
-            self.lbl_clients_count["text"] = f"Total: {len(self.server.clients)} users"
-
-            # ============ Update Matches ============
-            old_selection = self.matches_list.curselection()
-            selected_index = old_selection[0] if old_selection else None
-
-            self.matches_list.delete(0, tk.END)
-            for m in self.server.matches.values():
-                self.matches_list.insert(
-                    tk.END,
-                    f"{m.id} | {m.player_x} (X) vs {m.player_o} (O) | turn: {m.turn}"
-                )
+        events = self.state_events
+        if events is not None:
+            while True:
+                try:
+                    event = events.get_nowait()
+                except queue.Empty:
+                    break
+                self.apply_state_event(event)
+
+        # Lặp lại sau UI_POLL_MS
+        self.root.after(UI_POLL_MS, self.update_ui)
+
+    def apply_state_event(self, event):
+        if event["type"] == "state_snapshot":
+            self.state_seq = event["seq"]
+            self.load_snapshot(event["clients"], event["matches"])
+            return
 
-            # Khôi phục item đang được chọn
-            if selected_index is not None and selected_index < self.matches_list.size():
-                self.matches_list.select_set(selected_index)
-                self.matches_list.activate(selected_index)
+        # state_changes: bỏ gói cũ hơn snapshot đang có
+        if event["seq"] <= self.state_seq:
+            return
+        self.state_seq = event["seq"]
+        for kind, key, row in event["changes"]:
+            if kind == "client":
+                self.update_row(self.clients_list, self.client_keys, self.client_rows,
+                                key, row, self.format_client)
+            elif kind == "match":
+                self.update_row(self.matches_list, self.match_keys, self.match_rows,
+                                key, row, self.format_match)
+        self.lbl_clients_count["text"] = f"Total: {len(self.client_keys)} users"
+
+    def load_snapshot(self, clients, matches):
+        """Vẽ lại toàn bộ 2 danh sách (chỉ lúc nhận snapshot hoặc dừng server)"""
+        self.client_rows = dict(clients)
+        self.client_keys = sorted(clients)
+        self.clients_list.delete(0, tk.END)
+        if self.client_keys:
+            self.clients_list.insert(tk.END, *(self.format_client(clients[k]) for k in self.client_keys))
+        self.lbl_clients_count["text"] = f"Total: {len(self.client_keys)} users"
 
-        # Lặp lại sau 300ms
-        self.root.after(300, self.update_ui)
+        self.match_rows = dict(matches)
+        self.match_keys = sorted(matches)
+        self.matches_list.delete(0, tk.END)
+        if self.match_keys:
+            self.matches_list.insert(tk.END, *(self.format_match(matches[k]) for k in self.match_keys))
+
+    @staticmethod
+    def update_row(listbox, keys, rows, key, row, fmt):
+        """
+        Sửa đúng 1 dòng của Listbox theo khóa (keys giữ thứ tự đã sắp xếp → tìm bằng bisect)
+        - row=None: xóa dòng; khóa mới: chèn đúng chỗ; dòng đổi nội dung: thay tại chỗ, giữ lựa chọn
+        Listbox tự dời lựa chọn của các dòng khác khi chèn/xóa
+        """
+        i = bisect_left(keys, key)
+        exists = i < len(keys) and keys[i] == key
+        if row is None:
+            if exists:
+                del keys[i]
+                del rows[key]
+                listbox.delete(i)
+        elif not exists:
+            keys.insert(i, key)
+            rows[key] = row
+            listbox.insert(i, fmt(row))
+        elif rows[key] != row:
+            rows[key] = row
+            selected = listbox.selection_includes(i)
+            listbox.delete(i)
+            listbox.insert(i, fmt(row))
+            if selected:
+                listbox.selection_set(i)
+
+    @staticmethod
+    def format_client(row):
+        return row
+
+    @staticmethod
+    def format_match(row):
+        match_id, player_x, player_o, turn, state = row
+        status = f"turn: {turn}" if state == "playing" else state
+        return f"{match_id} | {player_x} (X) vs {player_o} (O) | {status}"
 
 
     # ====================================================================
@@ -248,12 +326,10 @@ class GuiServer:
             messagebox.showinfo("Info", "Select a match")
             return
 
-        match_text = self.matches_list.get(sel[0])
-        match_id = match_text.split(" | ")[0]
-
-        if match_id not in self.server.matches:
+        if not self.server or sel[0] >= len(self.match_keys):
             messagebox.showerror("Error", "Match not found")
             return
+        match_id = self.match_keys[sel[0]]
         
         # Mở cửa sổ xem trận
         win = tk.Toplevel(self.root)
@@ -0,0 +1,341 @@
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from logs import get_logger
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình nhật ký trận đang đánh
+# ============================================
+JOURNAL_SUFFIX = ".journal"        # game_history.db → game_history.journal
+JOURNAL_QUEUE_SIZE = 100_000       # Tối đa 100k sự kiện chờ ghi (bounded queue)
+JOURNAL_BATCH_SIZE = 2000          # Gom tối đa 2000 sự kiện / 1 lần fsync
+JOURNAL_SYNC_WAIT = 0.02           # Đợi thêm 20ms để gom batch trước khi fsync
+JOURNAL_COMPACT_BYTES = 4 << 20    # File vượt 4MB ...
+JOURNAL_COMPACT_RATIO = 4          # ... và lớn gấp 4 lần phần của các trận còn đang đánh → viết lại
+
+# Loại sự kiện (trường "e")
+EV_START = "start"      # id, x, o, ts (= lúc bắt đầu trận)
+EV_MOVE = "move"        # id, c (chỉ số ô y * size + x), ts
+EV_SESSION = "session"  # id, n (tên), k (mã phiên) - để resume được sau khi khởi động lại
+EV_FINISH = "finish"    # id, ts
+EV_MARK = "mark"        # ts - mốc "server còn sống lúc này" (khi dừng và khi nén file)
+
+# Mỗi bản ghi: [độ dài payload 4 byte][crc32 4 byte][payload JSON]
+_RECORD = struct.Struct("<II")
+_STOP = object()  # Sentinel báo thread ghi dừng lại
+
+log = get_logger("journal")
+
+
+def journal_path_for(db_path: str, shard: Optional[int] = None) -> str:
+    """File nhật ký đặt cạnh database lịch sử (mỗi shard 1 file riêng)"""
+    base = os.path.splitext(db_path)[0]
+    return f"{base}.s{shard}{JOURNAL_SUFFIX}" if shard is not None else base + JOURNAL_SUFFIX
+
+
+def encode_event(ev: Dict[str, Any]) -> bytes:
+    payload = json.dumps(ev, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return _RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_events(path: str) -> Tuple[List[Tuple[Dict[str, Any], bytes]], int]:
+    """
+    Đọc toàn bộ nhật ký: ([(sự kiện, bytes gốc)], số byte hợp lệ)
+    Dừng ở bản ghi hỏng đầu tiên (server chết giữa lúc ghi) - phần sau đó bị bỏ
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return [], 0
+    events = []
+    pos = 0
+    while pos + _RECORD.size <= len(data):
+        length, crc = _RECORD.unpack_from(data, pos)
+        end = pos + _RECORD.size + length
+        payload = data[pos + _RECORD.size:end]
+        if end > len(data) or zlib.crc32(payload) != crc:
+            break
+        try:
+            ev = json.loads(payload)
+        except ValueError:
+            break
+        events.append((ev, data[pos:end]))
+        pos = end
+    return events, pos
+
+
+@dataclass(slots=True)
+class RecoveredMatch:
+    """1 trận còn đang đánh dở lúc server dừng, dựng lại từ nhật ký"""
+    id: str
+    player_x: str
+    player_o: str
+    started_at: float                                             # time.time lúc bắt đầu
+    moves: List[Tuple[int, float]] = field(default_factory=list)  # (chỉ số ô, time.time)
+    sessions: Dict[str, str] = field(default_factory=dict)       # tên → mã phiên mới nhất
+    turn_started: float = 0.0                                     # time.time lúc lượt hiện tại bắt đầu
+
+
+class MatchJournal:
+    """
+    Nhật ký chỉ-ghi-thêm các sự kiện của trận đang đánh (bắt đầu, nước đi, kết thúc)
+    - Server chỉ việc append() vào hàng đợi; thread nền gom cả batch rồi write + 1 lần fsync
+      (group commit). Nước đi đã gửi cho người chơi nhưng chưa fsync có thể mất nếu máy sập
+      trong khoảng JOURNAL_SYNC_WAIT; stop() luôn ghi + fsync hết
+    - Thread ghi giữ bản sao bytes của các trận còn sống; file phình quá so với phần còn sống
+      thì chính thread đó viết lại file (tmp + fsync + os.replace) giữa 2 batch → event loop
+      không bao giờ phải đợi nén file
+    - open() đọc lại file lúc khởi động, trả về các trận đánh dở để server dựng lại
+    - append() không bao giờ chặn event loop: hàng đợi đầy, hoặc thread ghi đã chết vì lỗi
+      đĩa (failed), thì bỏ sự kiện + đếm dropped - trận vẫn đánh tiếp, chỉ không dựng lại được
+    """
+
+    def __init__(self, path: str, queue_size: int = JOURNAL_QUEUE_SIZE,
+                 batch_size: int = JOURNAL_BATCH_SIZE, sync_wait: float = JOURNAL_SYNC_WAIT,
+                 compact_bytes: int = JOURNAL_COMPACT_BYTES):
+        self.path = path
+        self.batch_size = batch_size
+        self.sync_wait = sync_wait
+        self.compact_bytes = compact_bytes
+        self.queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self.thread: Optional[threading.Thread] = None
+        self.file = None
+        self._stopped = False
+        self.failed = False  # Thread ghi đã dừng vì lỗi (hết chỗ, lỗi I/O...) → mọi sự kiện sau đó bị bỏ
+
+        # Bytes của các trận còn sống (chỉ thread ghi đụng vào sau khi open())
+        self.live: Dict[str, List[bytes]] = {}
+        self.live_bytes = 0
+        self.size = 0
+
+        # Số liệu thống kê
+        self.appended = 0
+        self.synced = 0
+        self.syncs = 0
+        self.compactions = 0
+        self.stalls = 0
+        self.dropped = 0
+        self.max_sync_ms = 0.0
+
+    # ---------- API cho server ----------
+
+    def open(self) -> Tuple[List[RecoveredMatch], float]:
+        """
+        Đọc nhật ký cũ (cắt bỏ đuôi hỏng), bật thread ghi
+        Trả về (các trận đánh dở, mốc time.time cuối cùng server còn ghi được)
+        """
+        events, good = read_events(self.path)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > good:
+            log.warning("journal_truncated", path=self.path, bytes=os.path.getsize(self.path) - good)
+            with open(self.path, "r+b") as f:
+                f.truncate(good)
+        active: Dict[str, RecoveredMatch] = {}
+        last_ts = 0.0
+        for ev, raw in events:
+            self._index(ev, raw)
+            last_ts = max(last_ts, ev.get("ts", 0.0))
+            kind, mid = ev.get("e"), ev.get("id")
+            if kind == EV_START:
+                active[mid] = RecoveredMatch(mid, ev["x"], ev["o"], ev["ts"], turn_started=ev["ts"])
+            elif kind == EV_FINISH:
+                active.pop(mid, None)
+            elif mid in active:
+                rm = active[mid]
+                if kind == EV_MOVE:
+                    rm.moves.append((ev["c"], ev["ts"]))
+                    rm.turn_started = ev["ts"]
+                elif kind == EV_SESSION:
+                    rm.sessions[ev["n"]] = ev["k"]
+        self.size = good
+        self.file = open(self.path, "ab")
+        self.thread = threading.Thread(target=self._run, name="match-journal", daemon=True)
+        self.thread.start()
+        log.info("journal_opened", path=self.path, events=len(events), active=len(active))
+        return list(active.values()), last_ts
+
+    def append(self, ev: Dict[str, Any]) -> None:
+        """Đưa 1 sự kiện vào hàng đợi ghi (không chờ); đầy hoặc thread ghi đã hỏng thì bỏ"""
+        if self._stopped or self.thread is None:
+            return
+        if self.failed:
+            return self._drop("writer_failed")
+        try:
+            self.queue.put_nowait(ev)
+        except queue.Full:
+            self.stalls += 1
+            return self._drop("queue_full")
+        self.appended += 1
+
+    def _drop(self, reason: str) -> None:
+        self.dropped += 1
+        if self.dropped & (self.dropped - 1) == 0:  # Log ở lần 1, 2, 4, 8... để không ngập log
+            log.warning("journal_event_dropped", path=self.path, reason=reason, dropped=self.dropped)
+
+    def match_started(self, match_id: str, player_x: str, player_o: str, started_at: float) -> None:
+        self.append({"e": EV_START, "id": match_id, "x": player_x, "o": player_o, "ts": started_at})
+
+    def move(self, match_id: str, cell: int, ts: float) -> None:
+        self.append({"e": EV_MOVE, "id": match_id, "c": cell, "ts": ts})
+
+    def session(self, match_id: str, name: str, token: str) -> None:
+        self.append({"e": EV_SESSION, "id": match_id, "n": name, "k": token, "ts": time.time()})
+
+    def match_finished(self, match_id: str) -> None:
+        self.append({"e": EV_FINISH, "id": match_id, "ts": time.time()})
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Đợi đến khi mọi sự kiện đã append trước đó được fsync (False nếu thread ghi đã hỏng)"""
+        if not self.thread or not self.thread.is_alive():
+            return not self.failed
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout) and not self.failed
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Ghi mốc dừng + fsync nốt hàng đợi rồi đóng file (gọi nhiều lần không sao)"""
+        if self._stopped:
+            return
+        self.append({"e": EV_MARK, "ts": time.time()})
+        self._stopped = True
+        if self.thread and self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join(timeout)
+        log.info("journal_stopped", synced=self.synced, syncs=self.syncs, compactions=self.compactions,
+                 live_matches=len(self.live), dropped=self.dropped, failed=self.failed)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "appended": self.appended,
+            "synced": self.synced,
+            "syncs": self.syncs,
+            "compactions": self.compactions,
+            "stalls": self.stalls,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "size": self.size,
+            "live_bytes": self.live_bytes,
+            "max_sync_ms": round(self.max_sync_ms, 3),
+        }
+
+    # ---------- Thread ghi ----------
+
+    def _index(self, ev: Dict[str, Any], raw: bytes) -> None:
+        """Cập nhật bản sao bytes của các trận còn sống (để nén file)"""
+        kind, mid = ev.get("e"), ev.get("id")
+        if kind == EV_FINISH:
+            recs = self.live.pop(mid, None)
+            if recs:
+                self.live_bytes -= sum(len(r) for r in recs)
+        elif kind == EV_START or (mid in self.live and kind in (EV_MOVE, EV_SESSION)):
+            self.live.setdefault(mid, []).append(raw)
+            self.live_bytes += len(raw)
+
+    def _run(self) -> None:
+        waiters: List[threading.Event] = []
+        try:
+            running = True
+            while running:
+                item = self.queue.get()
+                batch, waiters, running = self._collect(item)
+                if batch:
+                    self._sync(batch)
+                    if self.size > self.compact_bytes and self.size > JOURNAL_COMPACT_RATIO * self.live_bytes:
+                        self._compact()
+                for ev in waiters:
+                    ev.set()
+                waiters = []
+        except Exception as e:
+            # Đánh dấu hỏng TRƯỚC khi dọn hàng đợi → append() từ giờ bỏ luôn, không ai đợi thread chết
+            self.failed = True
+            log.error("journal_failed", path=self.path, error=str(e))
+        finally:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            if self.failed:
+                self._discard_pending(waiters)
+
+    def _discard_pending(self, waiters: List[threading.Event]) -> None:
+        """Thread ghi hỏng: bỏ mọi sự kiện còn trong hàng đợi, đánh thức người đang flush()"""
+        for ev in waiters:
+            ev.set()
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is not _STOP:
+                self.dropped += 1
+
+    def _collect(self, first: Any) -> Tuple[List[Dict[str, Any]], List[threading.Event], bool]:
+        """Gom batch: lấy thêm sự kiện cho đến khi đủ batch_size hoặc hết sync_wait"""
+        batch: List[Dict[str, Any]] = []
+        waiters: List[threading.Event] = []
+        item = first
+        deadline = time.monotonic() + self.sync_wait
+        while True:
+            if item is _STOP:
+                return batch, waiters, False
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+                return batch, waiters, True
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                return batch, waiters, True
+            remaining = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                return batch, waiters, True
+
+    def _sync(self, batch: List[Dict[str, Any]]) -> None:
+        """Ghi cả batch bằng 1 lần write + 1 lần fsync"""
+        t0 = time.perf_counter()
+        raws = [encode_event(ev) for ev in batch]
+        data = b"".join(raws)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(data)
+        for ev, raw in zip(batch, raws):
+            self._index(ev, raw)
+        self.synced += len(batch)
+        self.syncs += 1
+        self.max_sync_ms = max(self.max_sync_ms, (time.perf_counter() - t0) * 1000)
+
+    def _compact(self) -> None:
+        """Viết lại file chỉ gồm các trận còn sống (+ 1 mốc thời gian), thay file cũ nguyên tử"""
+        t0 = time.perf_counter()
+        old_size = self.size
+        tmp = self.path + ".tmp"
+        mark = encode_event({"e": EV_MARK, "ts": time.time()})
+        with open(tmp, "wb") as f:
+            for recs in self.live.values():
+                f.write(b"".join(recs))
+            f.write(mark)
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmp, self.path)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)  # Đổi tên cũng phải xuống đĩa
+        finally:
+            os.close(dir_fd)
+        self.file = open(self.path, "ab")
+        self.size = self.live_bytes + len(mark)
+        self.compactions += 1
+        log.info("journal_compacted", path=self.path, before=old_size, after=self.size,
+                 live_matches=len(self.live), ms=round((time.perf_counter() - t0) * 1000, 1))
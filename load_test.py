@@ -0,0 +1,303 @@
+"""
+Load test: giả lập hàng nghìn người chơi đánh với 1 CaroServer chạy cục bộ.
+
+Mỗi cặp người chơi login → challenge → accept rồi đánh liên tục (ngẫu nhiên
+hoặc theo kịch bản hòa dựng sẵn) cho đến hết thời gian đo. Người chơi dùng
+chung GameClient với test_automation.py và tự giãn nhịp gửi để không dính rate
+limit. Đo:
+- độ trễ login, độ trễ khứ hồi 1 nước đi (gửi move → nhận move_ok): p50/p90/p99
+- số tin nhắn/giây (gửi + nhận phía client)
+- CPU và RSS của tiến trình server (đọc /proc, chỉ có trên Linux)
+
+Kết quả ghi ra file JSON để so sánh giữa các lần chạy.
+
+Chạy: python load_test.py --players 2000 --duration 30 --out load_results.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from common import BOARD_SIZE, GameClient
+from bench_sharding import HOST, SEND_INTERVAL, draw_game, wait_port
+
+# Server chạy ở tiến trình riêng để đo CPU/RSS không lẫn với client
+SERVER_CMD = ("import asyncio, sys, server; "
+              "asyncio.run(server.CaroServer(sys.argv[1], int(sys.argv[2]), sys.argv[3]).start())")
+SAMPLE_INTERVAL = 0.5  # Chu kỳ lấy mẫu CPU/RSS của server (giây)
+
+
+# ============================================
+# ĐO CPU/RSS CỦA SERVER QUA /proc
+# ============================================
+
+class ProcSampler:
+    """Thread nền đọc /proc/<pid> mỗi SAMPLE_INTERVAL: % CPU giữa 2 lần đọc và RSS"""
+
+    def __init__(self, pid: int, interval: float = SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_pct: List[float] = []
+        self.rss_kb: List[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="proc-sampler", daemon=True)
+        self._ticks = os.sysconf("SC_CLK_TCK")
+
+    def _cpu_seconds(self) -> float:
+        with open(f"/proc/{self.pid}/stat") as f:
+            # Bỏ phần "(comm)" vì tên tiến trình có thể chứa dấu cách
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self._ticks  # utime + stime
+
+    def _rss(self) -> int:
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+        return 0
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        try:
+            last_cpu, last_t = self._cpu_seconds(), time.monotonic()
+            while not self._stop.wait(self.interval):
+                cpu, t = self._cpu_seconds(), time.monotonic()
+                self.cpu_pct.append(100.0 * (cpu - last_cpu) / (t - last_t))
+                self.rss_kb.append(self._rss())
+                last_cpu, last_t = cpu, t
+        except (FileNotFoundError, ProcessLookupError):
+            pass  # Server đã thoát
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "cpu_avg_pct": round(sum(self.cpu_pct) / len(self.cpu_pct), 1) if self.cpu_pct else None,
+            "cpu_max_pct": round(max(self.cpu_pct), 1) if self.cpu_pct else None,
+            "rss_peak_mb": round(max(self.rss_kb) / 1024, 1) if self.rss_kb else None,
+            "rss_end_mb": round(self.rss_kb[-1] / 1024, 1) if self.rss_kb else None,
+        }
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p90/p99/max (ms) theo kiểu nearest-rank"""
+    if not values:
+        return {"count": 0, "p50": None, "p90": None, "p99": None, "max": None}
+    v = sorted(values)
+    pick = lambda q: round(v[min(len(v) - 1, int(q * len(v)))], 3)
+    return {"count": len(v), "p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99), "max": round(v[-1], 3)}
+
+
+# ============================================
+# NGƯỜI CHƠI GIẢ LẬP
+# ============================================
+
+class Stats:
+    """Số liệu gom trong 1 tiến trình client"""
+
+    def __init__(self):
+        self.login_ms: List[float] = []
+        self.rtt_ms: List[float] = []
+        self.games = 0
+        self.moves = 0
+        self.messages = 0
+        self.errors = 0
+
+
+async def play(player: GameClient, stats: Stats, script: Optional[list], rng: random.Random) -> None:
+    """Đánh 1 ván từ match_start đến match_end; nước đi ngẫu nhiên hoặc theo kịch bản"""
+    occupied = set()
+    sent_at = None
+    while True:
+        msg = await player.wait_for("your_turn", "move_ok", "opponent_move", "match_end")
+        t = msg["type"]
+        if t == "match_end":
+            return
+        if t == "move_ok":
+            if sent_at is not None:
+                stats.rtt_ms.append((time.perf_counter() - sent_at) * 1000)
+                sent_at = None
+                stats.moves += 1
+            occupied.add((msg["x"], msg["y"]))
+        elif t == "opponent_move":
+            occupied.add((msg["x"], msg["y"]))
+        else:  # your_turn
+            if script is not None and len(occupied) < len(script) and script[len(occupied)] not in occupied:
+                x, y = script[len(occupied)]
+            else:
+                empty = [(x, y) for y in range(BOARD_SIZE) for x in range(BOARD_SIZE) if (x, y) not in occupied]
+                x, y = rng.choice(empty)
+            # Giãn nhịp trước khi bấm giờ: chỉ đo thời gian server xử lý + mạng
+            wait = player.last_send + player.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            sent_at = time.perf_counter()
+            await player.send({"type": "move", "x": x, "y": y})
+
+
+async def play_pair(idx: int, args, stop_at: float, stats: Stats, delay: float) -> None:
+    """1 cặp: đợi đến lượt vào (dàn đều login), rồi thách đấu và đánh liên tục đến stop_at"""
+    await asyncio.sleep(delay)
+    rng = random.Random(args.seed * 1_000_003 + idx)
+    script = draw_game() if args.mode == "scripted" else None
+    tag = f"{os.getpid()}_{idx}"
+    px = GameClient(f"lx{tag}", args.binary, min_interval=args.think)
+    po = GameClient(f"lo{tag}", args.binary, min_interval=args.think)
+
+    async def games() -> None:
+        for p in (px, po):
+            t0 = time.perf_counter()
+            await p.login(args.host, args.port)
+            stats.login_ms.append((time.perf_counter() - t0) * 1000)
+        while True:
+            await px.send({"type": "challenge", "opponent": po.name})
+            await po.wait_for("invite")
+            await po.send({"type": "accept", "opponent": px.name})
+            await asyncio.gather(play(px, stats, script, rng), play(po, stats, script, rng))
+            stats.games += 1
+
+    try:
+        await asyncio.wait_for(games(), max(0.0, stop_at - time.monotonic()))
+    except asyncio.TimeoutError:
+        pass  # Hết giờ đo → dừng giữa ván
+    except Exception:
+        stats.errors += 1
+    finally:
+        stats.messages += px.sent + px.received + po.sent + po.received
+        await px.close()
+        await po.close()
+
+
+def client_process(first: int, count: int, total_pairs: int, args, stop_at: float, out) -> None:
+    async def main():
+        stats = Stats()
+        await asyncio.gather(*(
+            play_pair(first + i, args, stop_at, stats, args.ramp * (first + i) / total_pairs)
+            for i in range(count)
+        ))
+        return stats.__dict__
+    out.put(asyncio.run(main()))
+
+
+# ============================================
+# CHẠY 1 LẦN ĐO
+# ============================================
+
+def run(args) -> Dict:
+    server = None
+    db = None
+    if not args.attach:
+        db = tempfile.mktemp(suffix=".db")
+        server = subprocess.Popen(
+            [sys.executable, "-c", SERVER_CMD, args.host, str(args.port), db],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    sampler = None
+    try:
+        wait_port(args.port)
+        pid = server.pid if server else args.server_pid
+        if pid and os.path.exists(f"/proc/{pid}"):
+            sampler = ProcSampler(pid)
+            sampler.start()
+
+        pairs = args.players // 2
+        procs_n = max(1, min(args.client_procs, pairs))
+        out = multiprocessing.Queue()
+        start = time.monotonic()
+        stop_at = start + args.ramp + args.duration
+        procs, first = [], 0
+        for i in range(procs_n):
+            n = pairs // procs_n + (1 if i < pairs % procs_n else 0)
+            p = multiprocessing.Process(target=client_process, args=(first, n, pairs, args, stop_at, out))
+            p.start()
+            procs.append(p)
+            first += n
+        results = [out.get() for _ in procs]
+        elapsed = time.monotonic() - start
+        for p in procs:
+            p.join()
+    finally:
+        if sampler:
+            sampler.stop()
+        if server:
+            server.terminate()
+            server.wait()
+        if db:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db + suffix):
+                    os.remove(db + suffix)
+
+    merged = {k: [] if isinstance(v, list) else 0 for k, v in results[0].items()}
+    for r in results:
+        for k, v in r.items():
+            merged[k] += v
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "players": pairs * 2, "duration_s": args.duration, "ramp_s": args.ramp, "mode": args.mode,
+            "binary": args.binary, "think_s": args.think, "client_procs": procs_n, "seed": args.seed,
+            "cpu_count": os.cpu_count(),
+        },
+        "elapsed_s": round(elapsed, 2),
+        "logins": len(merged["login_ms"]),
+        "login_ms": percentiles(merged["login_ms"]),
+        "move_rtt_ms": percentiles(merged["rtt_ms"]),
+        "games": merged["games"],
+        "moves": merged["moves"],
+        "moves_per_s": round(merged["moves"] / elapsed, 1),
+        "messages": merged["messages"],
+        "messages_per_s": round(merged["messages"] / elapsed, 1),
+        "client_errors": merged["errors"],
+        "server": sampler.summary() if sampler else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test cho CaroServer")
+    parser.add_argument("--players", type=int, default=2000, help="số người chơi (chia thành cặp)")
+    parser.add_argument("--duration", type=float, default=30.0, help="thời gian đo sau khi login xong (giây)")
+    parser.add_argument("--ramp", type=float, default=5.0, help="dàn đều login trong khoảng này (giây)")
+    parser.add_argument("--mode", choices=("random", "scripted"), default="random",
+                        help="random: nước đi ngẫu nhiên; scripted: ván hòa dựng sẵn 225 nước")
+    parser.add_argument("--think", type=float, default=SEND_INTERVAL,
+                        help="khoảng cách tối thiểu giữa 2 lần gửi của 1 người chơi (giây)")
+    parser.add_argument("--binary", action="store_true", help="client dùng giao thức nhị phân")
+    parser.add_argument("--client-procs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=7797)
+    parser.add_argument("--attach", action="store_true", help="dùng server đang chạy sẵn thay vì tự khởi động")
+    parser.add_argument("--server-pid", type=int, help="pid server khi --attach (để đo CPU/RSS)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="load_results.json", help="file JSON kết quả")
+    args = parser.parse_args()
+
+    result = run(args)
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+
+    login, rtt, srv = result["login_ms"], result["move_rtt_ms"], result["server"] or {}
+    print(f"players={result['config']['players']} logins={result['logins']} games={result['games']} "
+          f"errors={result['client_errors']}")
+    print(f"login ms      p50={login['p50']} p99={login['p99']} max={login['max']}")
+    print(f"move rtt ms   p50={rtt['p50']} p99={rtt['p99']} max={rtt['max']}")
+    print(f"throughput    {result['moves_per_s']} moves/s, {result['messages_per_s']} msgs/s")
+    print(f"server        cpu avg={srv.get('cpu_avg_pct')}% max={srv.get('cpu_max_pct')}% "
+          f"rss peak={srv.get('rss_peak_mb')}MB")
+    print(f"[INFO] Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
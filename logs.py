@@ -0,0 +1,162 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Any, Dict, Optional, TextIO
+
+from metrics import REGISTRY
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình log
+# ============================================
+LOG_QUEUE_SIZE = 10000          # Hàng đợi đầy (stdout bị nghẽn) → bỏ bớt log, không chặn event loop
+LOGGER_ROOT = "caro"
+DEFAULT_SAMPLING = {"move": 100}  # Sự kiện dày đặc: chỉ ghi 1/N bản (mức INFO trở xuống)
+
+LOG_DROPPED = REGISTRY.counter("caro_log_dropped_total", "Số dòng log bị bỏ vì hàng đợi log đầy")
+
+_sampling: Dict[str, int] = dict(DEFAULT_SAMPLING)
+_sample_counts: Dict[str, int] = {}
+_listener: Optional[logging.handlers.QueueListener] = None
+_configured_pid: Optional[int] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """1 dòng JSON / sự kiện: {"ts", "level", "logger", "event", ...các trường}"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Dạng dễ đọc kiểu cũ: [INFO] event key=value ..."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None) or {}
+        text = " ".join([f"[{record.levelname}]", record.getMessage()] +
+                        [f"{k}={v}" for k, v in fields.items()])
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler không bao giờ chặn người gọi
+    - prepare() không format gì cả: việc format để thread ghi làm
+    - Hàng đợi đầy → bỏ dòng log, chỉ tăng bộ đếm
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class StructLogger:
+    """
+    Logger có cấu trúc: log.info("move", player="A", x=3, y=4)
+    - event: tên sự kiện cố định; các trường đi kèm dạng key=value
+    - Sự kiện có trong bảng sampling chỉ được ghi 1/N lần (trường "sampled" = N)
+    - Mức chưa bật → return ngay, không tạo LogRecord
+    """
+    __slots__ = ("_logger",)
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(f"{LOGGER_ROOT}.{name}")
+
+    def _log(self, level: int, event: str, fields: Dict[str, Any], exc_info: bool = False) -> None:
+        if not self._logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING:
+            every = _sampling.get(event)
+            if every and every > 1:
+                n = _sample_counts[event] = _sample_counts.get(event, 0) + 1
+                if n % every:
+                    return
+                fields["sampled"] = every
+        self._logger.log(level, event, extra={"fields": fields}, exc_info=exc_info)
+
+    def debug(self, event: str, **fields: Any) -> None:
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields: Any) -> None:
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields: Any) -> None:
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields: Any) -> None:
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event: str, **fields: Any) -> None:
+        """Như error() kèm traceback (gọi trong khối except)"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def get_logger(name: str) -> StructLogger:
+    return StructLogger(name)
+
+
+def configure_logging(level: str = "INFO", fmt: str = "json", stream: Optional[TextIO] = None,
+                      sampling: Optional[Dict[str, int]] = None, force: bool = False) -> None:
+    """
+    Bật log qua hàng đợi: người gọi chỉ put_nowait, 1 thread nền format và ghi ra stream
+    - Gọi nhiều lần không sao; tiến trình con (fork) tự cấu hình lại vì thread ghi không sống sót qua fork
+    - fmt: "json" (mặc định) hoặc "text"
+    - sampling: {tên sự kiện: N} thay cho DEFAULT_SAMPLING
+    """
+    global _listener, _configured_pid
+    if _configured_pid == os.getpid() and not force:
+        return
+    if _listener is not None and _configured_pid == os.getpid():
+        _listener.stop()
+
+    _sampling.clear()
+    _sampling.update(DEFAULT_SAMPLING if sampling is None else sampling)
+    _sample_counts.clear()
+
+    out = logging.StreamHandler(stream or sys.stdout)
+    out.setFormatter(TextFormatter() if fmt == "text" else JsonFormatter())
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(log_queue, out)
+    _listener.start()
+
+    root = logging.getLogger(LOGGER_ROOT)
+    root.handlers[:] = [_DroppingQueueHandler(log_queue)]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    root.propagate = False
+    _configured_pid = os.getpid()
+
+
+def shutdown_logging() -> None:
+    """Ghi nốt log còn trong hàng đợi rồi dừng thread ghi"""
+    global _listener, _configured_pid
+    if _listener is not None and _configured_pid == os.getpid():
+        try:
+            _listener.stop()
+        except queue.Full:
+            pass  # stdout nghẽn hẳn: bỏ log còn lại, không treo lúc thoát
+    _listener = None
+    _configured_pid = None
+
+
+atexit.register(shutdown_logging)
@@ -1,6 +1,10 @@
+import queue
 import tkinter as tk
 from gui_client import BOARD_SIZE
-from common import find_win_line
+
+# Nhịp đọc hàng đợi sự kiện: nhanh khi trận đang đánh, giãn dần khi không có gì mới
+POLL_FAST_MS = 30
+POLL_IDLE_MS = 500
 
 
 class MatchViewer:
@@ -62,74 +66,108 @@ class MatchViewer:
         self.offset_y = 0
         self.board_state = [["" for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)]
         self.highlighted = []       # Danh sách ô được highlight
+        self.turn = None
+        self.finished = False
+        self.poll_ms = POLL_FAST_MS
+        self.poll_id = None
 
-       # Bắt đầu vòng lặp refresh tự động
-        self.refresh()
+        # ==========================
+        # ĐĂNG KÝ NHẬN SỰ KIỆN TỪ SERVER
+        # ==========================
+        # Server (thread event loop) chỉ put vào hàng đợi; thread Tk tự lấy ra vẽ
+        self.events = queue.Queue()
+        self.subscribed = False
+        loop = getattr(server, "loop", None)
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(server.watch_match, match_id, self.events.put)
+            self.subscribed = True
+        else:
+            self.events.put({"type": "match_end", "winner": None, "reason": "not_found"})
+        self.root.bind("<Destroy>", self.on_close, add="+")
+
+        self.poll()
 
     # ====================================================
-    # AUTO REFRESH EACH 250ms
+    # NHẬN SỰ KIỆN TỪ SERVER
     # ====================================================
-    def refresh(self):
-        # Nếu trận đã kết thúc hoặc bị xóa
-        if self.match_id not in self.server.matches:
-            return 
-
-        m = self.server.matches[self.match_id]      # Lấy object trận từ server
-
-        # ==== Update players ====
-        self.label_players.config(
-            text=f"{m.player_x} (X)  vs  {m.player_o} (O)"
-        )
-
-        # ==== Update turn ====
-        turn_text = f"Turn: {m.turn}"
-        turn_color = "#FF3B30" if m.turn == "X" else "#00AEEF"
-        self.label_turn.config(text=turn_text, fg=turn_color)
-
-        # ==== Update board ====
-        for y in range(BOARD_SIZE):
-            for x in range(BOARD_SIZE):
-                val = m.board[y][x]
-                self.board_state[y][x] = "" if val == "." else val
+    def poll(self):
+        """Lấy hết sự kiện đang chờ và áp dụng; không có gì mới thì giãn nhịp đọc"""
+        self.poll_id = None
+        got = False
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            got = True
+            self.apply_event(event)
 
-        # ==== Lấy nước đi cuối ====
-        if m.moves:
-            self.last_move = (m.moves[-1]["x"], m.moves[-1]["y"])
-        else:
-            self.last_move = None
+        if self.finished:
+            return
+        self.poll_ms = POLL_FAST_MS if got else min(self.poll_ms * 2, POLL_IDLE_MS)
+        self.poll_id = self.root.after(self.poll_ms, self.poll)
 
-        # ==================================================================
-        #  TÌM NGƯỜI THẮNG TỰ ĐỘNG DỰA TRÊN find_win_line()
-        # ==================================================================
-        self.highlighted = [] 
+    def apply_event(self, event):
+        t = event.get("type")
 
-        # Quét toàn bộ bàn cờ tìm đường thắng
-        for y in range(BOARD_SIZE):
-            for x in range(BOARD_SIZE):
-                symbol = self.board_state[y][x]
-                if symbol in ("X", "O"):
-                    line = find_win_line(self.board_state, x, y, symbol)
-                    if len(line) >= 5:
-                        self.highlighted = line
-                        break
-            if self.highlighted:
-                break
-        
-        # ==================================================================
-        #  Nếu chưa thắng, highlight last move thôi
-        # ==================================================================
-        if not self.highlighted and self.last_move:
-            lx, ly = self.last_move
-            symbol = self.board_state[ly][lx]
-            if symbol:
-                self.highlighted = find_win_line(self.board_state, lx, ly, symbol)
-
-        # Vẽ lại toàn bộ
-        self.redraw()
-        
-        # Gọi lại refresh sau 250ms
-        self.root.after(250, self.refresh)
-        
+        if t == "snapshot":
+            # Trạng thái ban đầu: vẽ toàn bộ 1 lần
+            self.label_players.config(
+                text=f"{event['player_x']} (X)  vs  {event['player_o']} (O)"
+            )
+            self.board_state = [["" for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)]
+            for x, y, symbol in event["cells"]:
+                self.board_state[y][x] = symbol
+            self.last_move = event["last_move"]
+            self.highlighted = []
+            self.set_turn(event["turn"])
+            self.redraw()
+
+        elif t == "move":
+            # Chỉ vẽ thêm đúng 1 quân + dời ô đánh dấu nước cuối
+            x, y, symbol = event["x"], event["y"], event["symbol"]
+            self.board_state[y][x] = symbol
+            self.last_move = (x, y)
+            self.set_turn("O" if symbol == "X" else "X")
+            if self.cell_size > 0:
+                self.draw_piece(x, y, symbol, "#FF3B30" if symbol == "X" else "#0078D7")
+                self.draw_highlights()
+
+        elif t == "highlight":
+            self.highlighted = [tuple(c) for c in event["cells"]]
+            if self.cell_size > 0:
+                self.draw_highlights()
+
+        elif t == "match_end":
+            self.finished = True
+            self.subscribed = False
+            winner = event.get("winner")
+            reason = event.get("reason")
+            if reason == "not_found":
+                text = "Match is no longer running"
+            else:
+                text = f"Finished: {winner or 'draw'} ({reason})"
+            self.label_turn.config(text=text, fg="#FFD700")
+
+    def set_turn(self, turn):
+        self.turn = turn
+        turn_color = "#FF3B30" if turn == "X" else "#00AEEF"
+        self.label_turn.config(text=f"Turn: {turn}", fg=turn_color)
+
+    def on_close(self, evt=None):
+        """Đóng cửa sổ → hủy đăng ký để server không đẩy sự kiện vào hàng đợi bỏ đi"""
+        if evt is not None and evt.widget is not self.root:
+            return
+        if self.poll_id is not None:
+            try:
+                self.root.after_cancel(self.poll_id)
+            except tk.TclError:
+                pass
+            self.poll_id = None
+        loop = getattr(self.server, "loop", None)
+        if self.subscribed and loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.server.unwatch_match, self.match_id, self.events.put)
+        self.subscribed = False
 
     # ====================================================
     # VẼ LẠI BÀN CỜ KHI THAY ĐỔI KÍCH THƯỚC
@@ -153,7 +191,7 @@ class MatchViewer:
 
 
     # ========================================================================
-    # REDRAW = Xóa + vẽ lại bàn cờ
+    # REDRAW = Xóa + vẽ lại bàn cờ (chỉ khi nhận snapshot hoặc đổi kích thước)
     # ========================================================================
     def redraw(self):
         if self.cell_size <= 0:
@@ -207,13 +245,13 @@ class MatchViewer:
         # Vẽ hình tròn
         self.canvas.create_oval(
             cx - r, cy - r, cx + r, cy + r,
-            fill=color, outline=""
+            fill=color, outline="", tags=("piece",)
         )
         
         # Vẽ chữ X/O
         self.canvas.create_text(
             cx, cy, text=symbol, fill="white",
-            font=("Consolas", int(cs * 0.4), "bold")
+            font=("Consolas", int(cs * 0.4), "bold"), tags=("piece",)
         )
 
     
@@ -221,9 +259,11 @@ class MatchViewer:
     # VẼ Ô HIGHLIGHT (ĐƯỜNG THẮNG hoặc LAST_MOVE)
     # ========================================================================
     def draw_highlights(self):
+        """Xóa khung highlight cũ rồi vẽ lại (chỉ vài item, không đụng tới bàn cờ)"""
         cs = self.cell_size
         ox = self.offset_x
         oy = self.offset_y
+        self.canvas.delete("highlight")
 
         # Nếu có winner → chỉ highlight win_cells (màu vàng)
         if self.highlighted:
@@ -235,7 +275,7 @@ class MatchViewer:
 
                 self.canvas.create_rectangle(
                     x1, y1, x2, y2,
-                    outline="#FFD700", width=3
+                    outline="#FFD700", width=3, tags=("highlight",)
                 )
             return 
             
@@ -246,4 +286,4 @@ class MatchViewer:
             y1 = oy + y * cs
             x2 = x1 + cs
             y2 = y1 + cs
-            self.canvas.create_rectangle(x1, y1, x2, y2, outline="#00FF00", width=3)
+            self.canvas.create_rectangle(x1, y1, x2, y2, outline="#00FF00", width=3, tags=("highlight",))
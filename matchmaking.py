@@ -0,0 +1,161 @@
+import heapq
+import itertools
+import time
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình ghép trận tự động
+# ============================================
+BASE_TOLERANCE = 50       # Chênh lệch Elo chấp nhận ngay lúc vào hàng
+WIDEN_PER_SECOND = 10     # Mỗi giây chờ nới thêm 10 Elo
+MAX_TOLERANCE = 400       # Nới tối đa (chờ 35 giây)
+SWEEP_INTERVAL = 1.0      # Chu kỳ quét ghép những người đã chờ đủ lâu (giây)
+
+
+@dataclass(slots=True)
+class QueueEntry:
+    """1 người đang chờ ghép trận; key = (rating, seq) là vị trí trong danh sách đã sắp xếp"""
+    name: str
+    rating: float
+    joined_at: float   # time.monotonic lúc vào hàng
+    key: Tuple[float, int]
+
+
+def tolerance(entry: QueueEntry, now: float) -> float:
+    """Chênh lệch Elo chấp nhận được, nới dần theo thời gian chờ"""
+    return min(BASE_TOLERANCE + WIDEN_PER_SECOND * max(0.0, now - entry.joined_at), MAX_TOLERANCE)
+
+
+def eligible_at(a: QueueEntry, b: QueueEntry) -> Optional[float]:
+    """Thời điểm ngưỡng của người chờ lâu hơn nới tới mức chạm người kia (None = không bao giờ)"""
+    gap = abs(a.rating - b.rating)
+    if gap > MAX_TOLERANCE:
+        return None
+    return min(a.joined_at, b.joined_at) + max(0.0, gap - BASE_TOLERANCE) / WIDEN_PER_SECOND
+
+
+class MatchQueue:
+    """
+    Hàng chờ ghép trận theo Elo - không phụ thuộc asyncio/mạng (server và benchmark dùng chung)
+    - keys: (rating, seq) của người đang chờ, đã sắp xếp → người gần Elo nhất luôn là
+      người kề bên, tìm bằng bisect
+    - join(): ghép ngay với người kề bên gần nhất nếu trong ngưỡng → O(log n)
+    - Mỗi cặp kề nhau có 1 "giờ đủ điều kiện" (ngưỡng nới theo thời gian chờ) nằm trong heap;
+      sweep() chỉ lấy các cặp đã tới giờ thay vì duyệt cả hàng → O(k log n) với k cặp ghép được
+    - Cặp trong heap có thể đã cũ (1 người rời đi / có người chen vào giữa): bỏ qua lúc lấy ra,
+      còn chỗ trống để lại thì sinh ra 1 cặp kề nhau mới; heap phình quá so với hàng chờ
+      (người vào/ra liên tục) thì dựng lại từ đầu
+    """
+
+    def __init__(self):
+        self.keys: List[Tuple[float, int]] = []
+        self.by_key: Dict[Tuple[float, int], QueueEntry] = {}
+        self.entries: Dict[str, QueueEntry] = {}
+        self.due: List[Tuple[float, Tuple[float, int], Tuple[float, int]]] = []  # heap (giờ, key trái, key phải)
+        self._seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    # ---------- Danh sách đã sắp xếp ----------
+
+    def _neighbors(self, i: int) -> Tuple[Optional[QueueEntry], Optional[QueueEntry]]:
+        """Người kề trái/phải của vị trí chèn i"""
+        left = self.by_key[self.keys[i - 1]] if i > 0 else None
+        right = self.by_key[self.keys[i]] if i < len(self.keys) else None
+        return left, right
+
+    def _watch(self, a: Optional[QueueEntry], b: Optional[QueueEntry]) -> None:
+        """Hẹn giờ cho 1 cặp vừa trở thành kề nhau"""
+        if a is None or b is None:
+            return
+        t = eligible_at(a, b)
+        if t is not None:
+            heapq.heappush(self.due, (t, a.key, b.key))
+
+    def _add(self, e: QueueEntry) -> None:
+        i = bisect_left(self.keys, e.key)
+        left, right = self._neighbors(i)
+        self.keys.insert(i, e.key)
+        self.by_key[e.key] = e
+        self.entries[e.name] = e
+        self._watch(left, e)
+        self._watch(e, right)
+
+    def _remove(self, e: QueueEntry) -> None:
+        i = bisect_left(self.keys, e.key)
+        del self.keys[i]
+        del self.by_key[e.key]
+        del self.entries[e.name]
+        self._watch(*self._neighbors(i))
+
+    def _compact(self) -> None:
+        """Dựng lại heap chỉ từ các cặp đang kề nhau (bỏ hết cặp cũ tồn đọng) - O(số người chờ)"""
+        entries = [self.by_key[k] for k in self.keys]
+        self.due = []
+        for a, b in zip(entries, entries[1:]):
+            t = eligible_at(a, b)
+            if t is not None:
+                self.due.append((t, a.key, b.key))
+        heapq.heapify(self.due)
+
+    # ---------- API ----------
+
+    def leave(self, name: str) -> bool:
+        """Rời hàng chờ; False nếu không có trong hàng"""
+        e = self.entries.get(name)
+        if e is None:
+            return False
+        self._remove(e)
+        return True
+
+    def join(self, name: str, rating: float, now: Optional[float] = None) -> Optional[Tuple[QueueEntry, QueueEntry]]:
+        """
+        Vào hàng chờ; trả về (người chờ trước, người mới) nếu ghép được ngay
+        Đã ở trong hàng thì không làm gì (trả về None)
+        """
+        if name in self.entries:
+            return None
+        now = time.monotonic() if now is None else now
+        e = QueueEntry(name, rating, now, (rating, next(self._seq)))
+        best: Optional[QueueEntry] = None
+        best_gap = 0.0
+        for cand in self._neighbors(bisect_left(self.keys, e.key)):
+            if cand is None:
+                continue
+            gap = abs(cand.rating - rating)
+            # Người đã chờ lâu có ngưỡng rộng hơn → chấp nhận theo ngưỡng rộng hơn của 2 bên
+            if gap <= tolerance(cand, now) and (best is None or gap < best_gap):
+                best, best_gap = cand, gap
+        if best is None:
+            self._add(e)
+            return None
+        self._remove(best)
+        return best, e
+
+    def sweep(self, now: Optional[float] = None) -> List[Tuple[QueueEntry, QueueEntry]]:
+        """
+        Ghép các cặp kề nhau đã đủ điều kiện tới thời điểm now
+        Cặp trả về: (người vào hàng trước, người vào sau)
+        """
+        now = time.monotonic() if now is None else now
+        if len(self.due) > 4 * len(self.keys) + 64:
+            self._compact()
+        pairs = []
+        while self.due and self.due[0][0] <= now:
+            _, ka, kb = heapq.heappop(self.due)
+            a, b = self.by_key.get(ka), self.by_key.get(kb)
+            if a is None or b is None:
+                continue
+            i = bisect_left(self.keys, ka)
+            if i + 1 >= len(self.keys) or self.keys[i + 1] != kb:
+                continue  # Đã có người chen vào giữa
+            self._remove(a)
+            self._remove(b)
+            pairs.append((a, b) if a.joined_at <= b.joined_at else (b, a))
+        return pairs
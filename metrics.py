@@ -0,0 +1,222 @@
+import asyncio
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình metrics
+# ============================================
+METRICS_HOST = "127.0.0.1"  # Chỉ mở cho máy local
+METRICS_PORT = 9377
+# Mốc histogram độ trễ (giây): 50µs → 5s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    """
+    Gốc chung: tên, mô tả, nhãn
+    - Không có nhãn: dùng trực tiếp (counter.inc())
+    - Có nhãn: labels("move").inc() - con được cache, nên gọi labels() ở hot path chỉ tốn 1 lần tra dict
+    """
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], "_Metric"] = {}
+
+    def labels(self, *values: str) -> "_Metric":
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name}: cần {len(self.labelnames)} nhãn, nhận {len(values)}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self) -> "_Metric":
+        return type(self)(self.name, self.help)
+
+    def _series(self) -> List[Tuple[Tuple[str, ...], "_Metric"]]:
+        if self.labelnames:
+            return list(self._children.items())
+        return [((), self)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._series():
+            lines.extend(child._samples(self.name, self.labelnames, values))
+        return lines
+
+    def _samples(self, name: str, labelnames: Sequence[str], values: Sequence[str]) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Bộ đếm chỉ tăng (số tin nhắn, số byte, số lỗi...)"""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def _samples(self, name, labelnames, values):
+        return [f"{name}{_labels(labelnames, values)} {_fmt(self.value)}"]
+
+
+class Gauge(_Metric):
+    """
+    Giá trị lên xuống được (số người online, số trận...)
+    set_function(): chỉ tính lúc có người scrape → không tốn gì ở hot path
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0.0
+        self._fn: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set_function(self, fn: Callable[[], float]) -> None:
+        self._fn = fn
+
+    def _samples(self, name, labelnames, values):
+        value = self.value
+        if self._fn is not None:
+            try:
+                value = self._fn()
+            except Exception:
+                value = math.nan
+        return [f"{name}{_labels(labelnames, values)} {_fmt(value)}"]
+
+
+class Histogram(_Metric):
+    """
+    Phân bố độ trễ theo mốc cố định
+    observe() chỉ tăng 1 ô (bisect) + cộng tổng; dồn lũy kế khi render
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # ô cuối: > mốc lớn nhất
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _samples(self, name, labelnames, values):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += n
+            le = 'le="%s"' % _fmt(bound)
+            lines.append(f"{name}_bucket{_labels(labelnames, values, le)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labelnames, values)} {_fmt(self.sum)}")
+        lines.append(f"{name}_count{_labels(labelnames, values)} {self.count}")
+        return lines
+
+
+class Registry:
+    """Danh sách metrics của tiến trình, xuất ra định dạng text của Prometheus"""
+
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            # Import lại module (hoặc tạo lại server) → dùng lại metric cũ
+            if type(existing) is not type(metric):
+                raise ValueError(f"Metric {metric.name} đã đăng ký với kiểu khác")
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()  # Registry mặc định của tiến trình
+
+
+# ============================================
+# HTTP ENDPOINT /metrics
+# ============================================
+
+async def start_metrics_server(registry: Registry = REGISTRY, host: str = METRICS_HOST,
+                               port: int = METRICS_PORT) -> asyncio.AbstractServer:
+    """
+    Mở HTTP endpoint tối giản trên event loop hiện tại
+    GET bất kỳ đường dẫn nào → toàn bộ metrics (text/plain; version=0.0.4)
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5.0)
+            if request.startswith(b"GET "):
+                body = registry.render().encode("utf-8")
+                head = (b"HTTP/1.1 200 OK\r\n"
+                        b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n")
+            else:
+                body = b"method not allowed\n"
+                head = b"HTTP/1.1 405 Method Not Allowed\r\nContent-Type: text/plain\r\n"
+            writer.write(head + b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,79 @@
+"""
+Chuyển cột moves của game_history.db từ JSON cũ sang dạng nhị phân gọn (common.encode_moves).
+
+- Chỉ đụng tới các dòng còn là TEXT → chạy lại nhiều lần không sao, dừng giữa chừng cũng được
+- Mỗi batch là 1 transaction; duyệt theo rowid nên không phải quét lại từ đầu
+- Dòng không chuyển được (JSON hỏng, sai lượt...) giữ nguyên, chỉ đếm và báo lại
+- Đọc vẫn tương thích cả 2 dạng (persistence.load_moves) nên server có thể chạy trong lúc chuyển
+
+Chạy: python migrate_moves.py --db game_history.db --vacuum
+"""
+import argparse
+import json
+import sqlite3
+import time
+from typing import Dict
+
+from common import encode_moves
+from persistence import open_db
+
+MIGRATE_BATCH = 2000  # Số dòng mỗi transaction
+
+
+def migrate(db: sqlite3.Connection, batch_size: int = MIGRATE_BATCH, dry_run: bool = False) -> Dict[str, int]:
+    """Chuyển mọi dòng moves dạng TEXT sang bytes; trả về số liệu (dòng, byte trước/sau)"""
+    stats = {"rows": 0, "converted": 0, "failed": 0, "bytes_before": 0, "bytes_after": 0}
+    last = 0
+    while True:
+        rows = db.execute(
+            "SELECT rowid, moves FROM matches WHERE rowid > ? AND typeof(moves) = 'text' "
+            "ORDER BY rowid LIMIT ?", (last, batch_size)).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        updates = []
+        for rowid, text in rows:
+            stats["rows"] += 1
+            try:
+                blob = encode_moves(json.loads(text))
+            except (ValueError, KeyError, TypeError) as e:
+                stats["failed"] += 1
+                print(f"[SKIP] rowid={rowid}: {e}")
+                continue
+            stats["bytes_before"] += len(text.encode("utf-8"))
+            stats["bytes_after"] += len(blob)
+            updates.append((blob, rowid))
+        if updates and not dry_run:
+            with db:
+                db.executemany("UPDATE matches SET moves = ? WHERE rowid = ?", updates)
+        stats["converted"] += len(updates)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chuyển lịch sử nước đi sang dạng nhị phân gọn")
+    parser.add_argument("--db", default="game_history.db", help="file SQLite lưu lịch sử")
+    parser.add_argument("--batch", type=int, default=MIGRATE_BATCH, help="số dòng mỗi transaction")
+    parser.add_argument("--dry-run", action="store_true", help="chỉ đếm, không ghi")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM sau khi chuyển để trả lại dung lượng file")
+    args = parser.parse_args()
+
+    db = open_db(args.db)
+    try:
+        t0 = time.perf_counter()
+        stats = migrate(db, args.batch, args.dry_run)
+        elapsed = time.perf_counter() - t0
+        before, after = stats["bytes_before"], stats["bytes_after"]
+        print(f"Đã chuyển {stats['converted']}/{stats['rows']} trận trong {elapsed:.1f}s "
+              f"({stats['failed']} lỗi){' [dry-run]' if args.dry_run else ''}")
+        if before:
+            print(f"Cột moves: {before:,} → {after:,} byte ({before / max(after, 1):.1f}x nhỏ hơn)")
+        if args.vacuum and not args.dry_run and stats["converted"]:
+            db.execute("VACUUM")
+            print("Đã VACUUM")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+Sổ khai cuộc: chỉ mục thế cờ → kết quả (X thắng / O thắng / hòa) dựng từ game_history.db.
+
+- Phát lại từng trận đã lưu (chỉ BOOK_MAX_PLIES nước đầu), mỗi thế cờ lấy mã Zobrist nhỏ nhất
+  trong 8 phép đối xứng của bàn (xoay 90/180/270, lật) → các khai cuộc đối xứng gộp làm 1
+- Database lớn: đếm trong RAM tới BOOK_RUN_ENTRIES thế cờ thì xả ra 1 file tạm đã sắp xếp,
+  cuối cùng trộn các file tạm (heapq.merge) → bộ nhớ không phụ thuộc số trận
+- File kết quả: header 16 byte + các bản ghi 20 byte (hash, x_wins, o_wins, draws) sắp theo hash
+  → server mmap file và tìm nhị phân, chỉ những trang được chạm tới mới nằm trong RAM
+- Ghi ra file tạm rồi os.replace → server đang mở file cũ không bao giờ đọc phải file dở dang;
+  chạy được khi server đang chạy (database mở chỉ-đọc), server mở lại sổ khi khởi động lại
+
+Chạy: python opening_book.py --db game_history.db --out opening_book.bin
+"""
+import argparse
+import heapq
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import time
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from common import BOARD_SIZE, Board, move_cells, zobrist_keys
+from logs import get_logger
+from persistence import load_moves
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình sổ khai cuộc
+# ============================================
+BOOK_FILE = "opening_book.bin"    # Server tự mở file này lúc khởi động nếu có
+BOOK_MAX_PLIES = 30               # Chỉ lập chỉ mục 30 nước đầu (sâu hơn thì thế cờ gần như không lặp lại)
+BOOK_MIN_GAMES = 2                # Bỏ thế cờ chỉ xuất hiện trong ít hơn 2 trận (chiếm phần lớn file)
+BOOK_RUN_ENTRIES = 2_000_000      # Số thế cờ đếm trong RAM trước khi xả ra 1 file tạm
+
+BOOK_MAGIC = b"CBK1"
+_HEADER = struct.Struct("<4sBBxxQ")   # magic, cỡ bàn, số nước tối đa, số bản ghi
+_RECORD = struct.Struct("<QIII")      # hash, x_wins, o_wins, draws
+_KEY = struct.Struct("<Q")
+_COUNT_MAX = 0xFFFFFFFF
+
+X_WIN, O_WIN, DRAW = 0, 1, 2
+
+log = get_logger("opening_book")
+
+
+# ============================================
+# MÃ THẾ CỜ CHUẨN HÓA THEO 8 PHÉP ĐỐI XỨNG
+# ============================================
+
+@lru_cache(maxsize=None)
+def symmetry_keys(size: int) -> Tuple[Tuple[Tuple[int, ...], ...], ...]:
+    """
+    keys[bên][ô] = 8 khóa Zobrist của ô (y * size + x) sau 8 phép đối xứng (bên 0 = X, 1 = O)
+    Phép thứ 0 là đồng nhất → khớp với Board.zobrist
+    """
+    x_keys, o_keys = zobrist_keys(size)
+    n, stride = size - 1, size + 1
+    out = []
+    for keys in (x_keys, o_keys):
+        per_cell = []
+        for cell in range(size * size):
+            y, x = divmod(cell, size)
+            images = ((x, y), (n - x, y), (x, n - y), (n - x, n - y),
+                      (y, x), (n - y, x), (y, n - x), (n - y, n - x))
+            per_cell.append(tuple(keys[iy * stride + ix] for ix, iy in images))
+        out.append(tuple(per_cell))
+    return tuple(out)
+
+
+def canonical_hashes(size: int, cells: bytes) -> List[int]:
+    """Mã chuẩn hóa sau từng nước của nhật ký nước đi (cells từ common.move_cells, X đi trước)"""
+    x_keys, o_keys = symmetry_keys(size)
+    h0 = h1 = h2 = h3 = h4 = h5 = h6 = h7 = 0
+    out = []
+    for i, cell in enumerate(cells):
+        # Viết thẳng 8 biến thay cho vòng lặp/zip: nhanh gấp ~2.5 lần khi phát lại hàng loạt
+        k0, k1, k2, k3, k4, k5, k6, k7 = (x_keys if i % 2 == 0 else o_keys)[cell]
+        h0, h1, h2, h3 = h0 ^ k0, h1 ^ k1, h2 ^ k2, h3 ^ k3
+        h4, h5, h6, h7 = h4 ^ k4, h5 ^ k5, h6 ^ k6, h7 ^ k7
+        out.append(min(h0, h1, h2, h3, h4, h5, h6, h7))
+    return out
+
+
+def canonical_hash(board: Board) -> int:
+    """Mã chuẩn hóa của 1 Board (duyệt các quân đang có, không cần biết thứ tự đi)"""
+    keys = symmetry_keys(board.size)
+    hs = [0] * 8
+    for side, bits in enumerate((board.x_bits, board.o_bits)):
+        table = keys[side]
+        while bits:
+            low = bits & -bits
+            y, x = divmod(low.bit_length() - 1, board.stride)
+            for t, k in enumerate(table[y * board.size + x]):
+                hs[t] ^= k
+            bits ^= low
+    return min(hs)
+
+
+# ============================================
+# DỰNG SỔ TỪ LỊCH SỬ (offline)
+# ============================================
+
+def iter_games(db: sqlite3.Connection, size: int = BOARD_SIZE) -> Iterator[Tuple[bytes, int]]:
+    """(chỉ số ô theo thứ tự đi, kết quả X_WIN/O_WIN/DRAW) của mọi trận đã lưu trên bàn `size`"""
+    for moves, winner, player_x, player_o in db.execute(
+            "SELECT moves, winner, player_x, player_o FROM matches ORDER BY rowid"):
+        if winner in (None, "draw"):
+            result = DRAW
+        elif winner == player_x:
+            result = X_WIN
+        elif winner == player_o:
+            result = O_WIN
+        else:
+            continue
+        try:
+            if isinstance(moves, (bytes, memoryview)):
+                game_size, cells = move_cells(bytes(moves))
+            else:
+                game_size = BOARD_SIZE
+                cells = bytes(mv["y"] * game_size + mv["x"] for mv in load_moves(moves))
+        except (ValueError, KeyError, TypeError):
+            continue
+        if game_size == size:
+            yield cells, result
+
+
+def _write_run(counts: Dict[int, List[int]], directory: str) -> str:
+    fd, path = tempfile.mkstemp(prefix="book-run-", dir=directory)
+    with os.fdopen(fd, "wb", buffering=1 << 20) as f:
+        for h in sorted(counts):
+            c = counts[h]
+            f.write(_RECORD.pack(h, min(c[0], _COUNT_MAX), min(c[1], _COUNT_MAX), min(c[2], _COUNT_MAX)))
+    return path
+
+
+def _read_run(path: str) -> Iterator[Tuple[int, int, int, int]]:
+    with open(path, "rb", buffering=1 << 20) as f:
+        while True:
+            chunk = f.read(_RECORD.size * 4096)
+            if not chunk:
+                return
+            yield from _RECORD.iter_unpack(chunk)
+
+
+def build_book(db_path: str, out_path: str = BOOK_FILE, size: int = BOARD_SIZE,
+               max_plies: int = BOOK_MAX_PLIES, min_games: int = BOOK_MIN_GAMES,
+               run_entries: int = BOOK_RUN_ENTRIES) -> Dict[str, int]:
+    """Dựng file sổ khai cuộc; trả về số liệu (trận, thế cờ, file tạm, bản ghi đã ghi)"""
+    if not 1 <= max_plies <= 255:
+        raise ValueError("max_plies phải trong khoảng 1..255")
+    directory = os.path.dirname(os.path.abspath(out_path))
+    stats = {"games": 0, "positions": 0, "runs": 0, "records": 0}
+    counts: Dict[int, List[int]] = {}
+    runs: List[str] = []
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        for cells, result in iter_games(db, size):
+            stats["games"] += 1
+            # Thế cờ trống (hash 0) = thống kê chung của mọi trận
+            for h in [0] + canonical_hashes(size, cells[:max_plies]):
+                c = counts.get(h)
+                if c is None:
+                    c = counts[h] = [0, 0, 0]
+                c[result] += 1
+            if len(counts) >= run_entries:
+                runs.append(_write_run(counts, directory))
+                counts = {}
+    finally:
+        db.close()
+
+    try:
+        if runs:
+            runs.append(_write_run(counts, directory))
+            counts = {}
+            merged = heapq.merge(*(_read_run(p) for p in runs))
+        else:
+            merged = ((h, *counts[h]) for h in sorted(counts))
+        stats["runs"] = len(runs)
+
+        fd, tmp = tempfile.mkstemp(prefix="book-", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, "wb", buffering=1 << 20) as f:
+                f.write(_HEADER.pack(BOOK_MAGIC, size, max_plies, 0))
+                n = unique = 0
+                current: Optional[List[int]] = None
+                for h, xw, ow, d in merged:
+                    if current is not None and current[0] == h:
+                        current[1] += xw
+                        current[2] += ow
+                        current[3] += d
+                        continue
+                    unique += 1
+                    if current is not None and sum(current[1:]) >= min_games:
+                        f.write(_RECORD.pack(current[0], *(min(v, _COUNT_MAX) for v in current[1:])))
+                        n += 1
+                    current = [h, xw, ow, d]
+                if current is not None and sum(current[1:]) >= min_games:
+                    f.write(_RECORD.pack(current[0], *(min(v, _COUNT_MAX) for v in current[1:])))
+                    n += 1
+                f.seek(0)
+                f.write(_HEADER.pack(BOOK_MAGIC, size, max_plies, n))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, out_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        stats["records"] = n
+        stats["positions"] = unique
+    finally:
+        for p in runs:
+            os.unlink(p)
+    return stats
+
+
+# ============================================
+# TRA CỨU (server) - mmap + tìm nhị phân, không nạp cả file
+# ============================================
+
+class PositionBook:
+    """
+    Sổ khai cuộc đã dựng, mở dạng mmap chỉ-đọc
+    - lookup(): tìm nhị phân trực tiếp trên mmap (~log2(số bản ghi) lần đọc 8 byte), không cấp phát
+    - Các trang của file chỉ được hệ điều hành nạp khi chạm tới và dùng chung giữa các tiến trình
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.size, self.max_plies, self.count = _HEADER.unpack_from(self.mm)
+            if magic != BOOK_MAGIC:
+                raise ValueError(f"Không phải file sổ khai cuộc: {magic!r}")
+            if len(self.mm) != _HEADER.size + self.count * _RECORD.size:
+                raise ValueError("File sổ khai cuộc sai kích thước")
+        except (ValueError, struct.error):
+            self.mm.close()
+            raise
+        self.path = path
+
+    def lookup(self, position: int) -> Optional[Tuple[int, int, int]]:
+        """(x_wins, o_wins, draws) của thế cờ có mã chuẩn hóa `position`; None nếu không có trong sổ"""
+        mm, base, rec = self.mm, _HEADER.size, _RECORD.size
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            key = _KEY.unpack_from(mm, base + mid * rec)[0]
+            if key < position:
+                lo = mid + 1
+            elif key > position:
+                hi = mid
+            else:
+                return _RECORD.unpack_from(mm, base + mid * rec)[1:]
+        return None
+
+    def stats(self, position: int) -> Dict:
+        found = self.lookup(position)
+        xw, ow, d = found or (0, 0, 0)
+        return {"position": f"{position:016x}", "games": xw + ow + d, "x_wins": xw, "o_wins": ow, "draws": d}
+
+    def close(self) -> None:
+        self.mm.close()
+
+
+def open_book(path: str = BOOK_FILE, size: int = BOARD_SIZE) -> Optional[PositionBook]:
+    """Mở sổ khai cuộc nếu đã dựng; chưa có / hỏng / khác cỡ bàn thì trả về None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        book = PositionBook(path)
+    except (OSError, ValueError) as e:
+        log.warning("opening_book_invalid", path=path, error=str(e))
+        return None
+    if book.size != size:
+        log.warning("opening_book_invalid", path=path, error=f"board size {book.size} != {size}")
+        book.close()
+        return None
+    log.info("opening_book_loaded", path=path, positions=book.count, max_plies=book.max_plies)
+    return book
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dựng sổ khai cuộc (thế cờ → kết quả) từ lịch sử trận đấu")
+    parser.add_argument("--db", default="game_history.db", help="file SQLite lưu lịch sử")
+    parser.add_argument("--out", default=BOOK_FILE, help="file sổ khai cuộc cần ghi")
+    parser.add_argument("--max-plies", type=int, default=BOOK_MAX_PLIES, help="số nước đầu được lập chỉ mục")
+    parser.add_argument("--min-games", type=int, default=BOOK_MIN_GAMES, help="bỏ thế cờ xuất hiện ít hơn N trận")
+    parser.add_argument("--run-entries", type=int, default=BOOK_RUN_ENTRIES,
+                        help="số thế cờ đếm trong RAM trước khi xả ra file tạm")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    stats = build_book(args.db, args.out, max_plies=args.max_plies, min_games=args.min_games,
+                       run_entries=args.run_entries)
+    elapsed = time.perf_counter() - t0
+    print(f"Đã phát lại {stats['games']} trận trong {elapsed:.1f}s "
+          f"({stats['games'] / max(elapsed, 1e-9):.0f} trận/s, {stats['runs']} file tạm)")
+    print(f"{stats['records']:,} thế cờ ghi vào {args.out} "
+          f"({os.path.getsize(args.out):,} byte, bỏ {stats['positions'] - stats['records']:,} thế cờ hiếm)")
+
+
+if __name__ == "__main__":
+    main()
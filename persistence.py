@@ -0,0 +1,464 @@
+import asyncio
+import collections
+import functools
+import json
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from common import decode_moves
+from logs import get_logger
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình ghi lịch sử
+# ============================================
+HISTORY_QUEUE_SIZE = 10000   # Tối đa 10000 bản ghi chờ ghi (bounded queue)
+HISTORY_OVERFLOW_SIZE = 10000  # Tối đa 10000 bản ghi tràn khi hàng đợi đầy - quá nữa thì bỏ
+HISTORY_BATCH_SIZE = 500     # Gom tối đa 500 bản ghi / 1 transaction
+HISTORY_BATCH_WAIT = 0.05    # Đợi thêm 50ms để gom batch trước khi commit
+HISTORY_READERS = 4          # Số kết nối chỉ-đọc (= số thread truy vấn)
+HISTORY_PAGE_SIZE = 20       # Số trận mỗi trang mặc định
+HISTORY_PAGE_MAX = 100       # Trang lớn nhất cho phép
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS matches (
+        id TEXT PRIMARY KEY,
+        player_x TEXT,
+        player_o TEXT,
+        winner TEXT,
+        started_at TEXT,
+        finished_at TEXT,
+        moves BLOB
+    )
+    """,
+    # Index cho truy vấn lịch sử: lọc theo cột đầu, sắp xếp/phân trang theo (finished_at, id)
+    # ngay trên index → không phải sort, dừng đọc khi đủ 1 trang
+    "CREATE INDEX IF NOT EXISTS idx_matches_player_x ON matches (player_x, finished_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_matches_player_o ON matches (player_o, finished_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_matches_winner ON matches (winner, finished_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_matches_finished_at ON matches (finished_at, id)",
+    # Thành tích + Elo từng người chơi (ratings.py cập nhật dần sau mỗi trận)
+    """
+    CREATE TABLE IF NOT EXISTS players (
+        name TEXT PRIMARY KEY,
+        rating REAL NOT NULL,
+        wins INTEGER NOT NULL DEFAULT 0,
+        losses INTEGER NOT NULL DEFAULT 0,
+        draws INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_players_rating ON players (rating DESC, name)",
+)
+
+SUMMARY_COLUMNS = ("id", "player_x", "player_o", "winner", "started_at", "finished_at")
+
+INSERT_MATCH_SQL = (
+    "INSERT OR REPLACE INTO matches (id, player_x, player_o, winner, started_at, finished_at, moves) "
+    "VALUES (?,?,?,?,?,?,?)"
+)
+
+_STOP = object()  # Sentinel báo thread ghi dừng lại
+_WAKE = object()  # Sentinel đánh thức thread ghi đang đợi hàng đợi khi có bản ghi mới trong overflow
+
+log = get_logger("persistence")
+
+
+def open_db(db_path: str) -> sqlite3.Connection:
+    """
+    Mở kết nối ghi tới database ở chế độ WAL
+    - WAL: người đọc không chặn người ghi và ngược lại
+    - synchronous=NORMAL: ở chế độ WAL chỉ fsync khi checkpoint → commit nhanh hơn nhiều
+    """
+    db = sqlite3.connect(db_path)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    for stmt in SCHEMA:
+        db.execute(stmt)
+    db.commit()
+    return db
+
+
+class HistoryWriter:
+    """
+    Thread ghi lịch sử trận đấu - tách SQLite ra khỏi event loop
+    - Server chỉ việc submit() bản ghi vào hàng đợi (gần như tức thì)
+    - Thread nền gom nhiều bản ghi thành 1 transaction (group commit) → 1 lần fsync cho cả batch
+    - Hàng đợi đầy (đĩa chậm) → bản ghi tràn sang overflow (cũng có giới hạn) thay vì bắt
+      event loop đợi; thread ghi lấy hết hàng đợi rồi mới lấy overflow nên thứ tự ghi giữ nguyên.
+      Overflow cũng đầy thì bỏ bản ghi + đếm dropped; flush()/stop() thì không bao giờ bị bỏ
+    - Thread ghi chỉ đợi trên hàng đợi: mỗi lần xếp vào overflow đều đẩy kèm _WAKE (nếu hàng
+      đợi còn chỗ) để thread đang đợi tỉnh dậy lấy overflow
+    - stop() ghi nốt mọi thứ còn trong hàng đợi rồi mới đóng database
+    """
+
+    def __init__(self, db_path: str, queue_size: int = HISTORY_QUEUE_SIZE,
+                 batch_size: int = HISTORY_BATCH_SIZE, batch_wait: float = HISTORY_BATCH_WAIT,
+                 overflow_size: int = HISTORY_OVERFLOW_SIZE):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.overflow_size = overflow_size
+        self.queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self.overflow: "collections.deque[Any]" = collections.deque()
+        self.thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._stopped = False
+
+        # Số liệu thống kê (chỉ thread ghi cập nhật, đọc từ thread khác là an toàn với int/float)
+        self.submitted = 0
+        self.committed = 0
+        self.batches = 0
+        self.failed = 0
+        self.stalls = 0              # Số bản ghi tràn sang overflow vì hàng đợi đầy
+        self.dropped = 0             # Số bản ghi bị bỏ vì cả hàng đợi lẫn overflow đều đầy
+        self.last_commit_ms = 0.0
+        self.max_commit_ms = 0.0
+        self.total_commit_ms = 0.0
+
+    # ---------- API cho server ----------
+
+    def start(self) -> None:
+        """Khởi động thread ghi, đợi database mở xong (để lỗi mở DB báo ngay cho người gọi)"""
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+        self._ready.wait()
+        if self._error:
+            raise self._error
+
+    def submit(self, sql: str, params: Tuple) -> None:
+        """
+        Đưa 1 câu lệnh ghi vào hàng đợi - không bao giờ chặn người gọi (event loop)
+        Hàng đợi đầy (đĩa không theo kịp) → xếp vào overflow, thread ghi sẽ lấy sau;
+        overflow cũng đầy → bỏ bản ghi (đếm dropped)
+        """
+        if self._stopped:
+            raise RuntimeError("HistoryWriter đã dừng")
+        if self._put((sql, params)):
+            self.submitted += 1
+
+    def _put(self, item: Any, control: bool = False) -> bool:
+        """
+        Còn bản ghi trong overflow thì xếp tiếp vào đó (giữ thứ tự), không thì vào hàng đợi
+        control=True (flush/stop): luôn nhận, kể cả khi overflow đã đầy
+        Trả về False nếu bản ghi bị bỏ
+        """
+        if not self.overflow:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                pass
+        if not control and len(self.overflow) >= self.overflow_size:
+            self.dropped += 1
+            if self.dropped & (self.dropped - 1) == 0:  # Log ở lần 1, 2, 4, 8... để không ngập log
+                log.warning("history_record_dropped", dropped=self.dropped, overflow=len(self.overflow))
+            return False
+        self.overflow.append(item)
+        self.stalls += 1
+        if self.stalls & (self.stalls - 1) == 0:
+            log.warning("history_queue_overflow", stalls=self.stalls, overflow=len(self.overflow))
+        # Thread ghi có thể vừa thấy cả 2 đều rỗng và đang đợi hàng đợi → đánh thức nó.
+        # Hàng đợi đầy thì khỏi cần: thread ghi còn việc, lấy hết hàng đợi sẽ tới overflow
+        try:
+            self.queue.put_nowait(_WAKE)
+        except queue.Full:
+            pass
+        return True
+
+    def _next(self, timeout: Optional[float] = None) -> Any:
+        """
+        Thread ghi lấy bản ghi tiếp theo: hàng đợi trước (cũ hơn), hết thì tới overflow
+        timeout=None: đợi đến khi có; timeout<=0: không đợi (raise queue.Empty)
+        """
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self.overflow.popleft()
+        except IndexError:
+            pass
+        if timeout is not None and timeout <= 0:
+            raise queue.Empty
+        return self.queue.get(timeout=timeout)
+
+    def pending(self) -> int:
+        """Số bản ghi chưa commit: hàng đợi + overflow"""
+        return self.queue.qsize() + len(self.overflow)
+
+    def save_match(self, record: Tuple) -> None:
+        """Lưu 1 trận: (id, player_x, player_o, winner, started_at, finished_at, moves)"""
+        self.submit(INSERT_MATCH_SQL, record)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Đợi đến khi mọi bản ghi đã submit trước đó được commit"""
+        if not self.thread or not self.thread.is_alive():
+            return True
+        done = threading.Event()
+        self._put(done, control=True)
+        return done.wait(timeout)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Ghi nốt hàng đợi rồi dừng thread (gọi nhiều lần không sao)"""
+        if self._stopped:
+            return
+        self._stopped = True
+        if self.thread and self.thread.is_alive():
+            self._put(_STOP, control=True)
+            self.thread.join(timeout)
+        log.info("history_writer_stopped", committed=self.committed, failed=self.failed,
+                 dropped=self.dropped)
+
+    def stats(self) -> Dict[str, float]:
+        """Số liệu cho giám sát: độ sâu hàng đợi, độ trễ commit..."""
+        return {
+            "queue_depth": self.pending(),
+            "submitted": self.submitted,
+            "committed": self.committed,
+            "batches": self.batches,
+            "failed": self.failed,
+            "stalls": self.stalls,
+            "dropped": self.dropped,
+            "last_commit_ms": round(self.last_commit_ms, 3),
+            "max_commit_ms": round(self.max_commit_ms, 3),
+            "avg_commit_ms": round(self.total_commit_ms / self.batches, 3) if self.batches else 0.0,
+        }
+
+    # ---------- Thread ghi ----------
+
+    def _run(self) -> None:
+        try:
+            db = open_db(self.db_path)
+        except BaseException as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        try:
+            running = True
+            while running:
+                item = self._next()
+                if item is _WAKE:
+                    continue
+                batch, waiters, running = self._collect(item)
+                if batch:
+                    self._commit(db, batch)
+                for ev in waiters:
+                    ev.set()
+            # Sau _STOP chỉ có thể còn vài _WAKE thừa trong hàng đợi - dọn cho pending() về 0
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+        finally:
+            db.close()
+
+    def _collect(self, first: Any) -> Tuple[List[Tuple[str, Tuple]], List[threading.Event], bool]:
+        """Gom batch: lấy thêm bản ghi cho đến khi đủ batch_size hoặc hết batch_wait"""
+        batch: List[Tuple[str, Tuple]] = []
+        waiters: List[threading.Event] = []
+        item = first
+        deadline = time.monotonic() + self.batch_wait
+        while True:
+            if item is _STOP:
+                return batch, waiters, False
+            if isinstance(item, threading.Event):
+                # flush(): commit ngay những gì đã gom, không đợi thêm
+                waiters.append(item)
+                return batch, waiters, True
+            if item is not _WAKE:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    return batch, waiters, True
+            try:
+                item = self._next(max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return batch, waiters, True
+
+    def _commit(self, db: sqlite3.Connection, batch: List[Tuple[str, Tuple]]) -> None:
+        t0 = time.perf_counter()
+        try:
+            with db:  # 1 transaction cho cả batch
+                for sql, params in batch:
+                    db.execute(sql, params)
+        except Exception as e:
+            self.failed += len(batch)
+            log.error("history_commit_failed", records=len(batch), error=str(e))
+            return
+        ms = (time.perf_counter() - t0) * 1000
+        self.committed += len(batch)
+        self.batches += 1
+        self.last_commit_ms = ms
+        self.max_commit_ms = max(self.max_commit_ms, ms)
+        self.total_commit_ms += ms
+
+
+# ============================================
+# ĐỌC LỊCH SỬ - kết nối chỉ-đọc, chạy ngoài event loop
+# ============================================
+
+def _normalize_time(value: Any) -> Optional[str]:
+    """Chuẩn hóa mốc thời gian ISO về đúng dạng lưu trong bảng (so sánh chuỗi được)"""
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError("Thời gian phải là chuỗi ISO 8601")
+    return datetime.fromisoformat(value).isoformat(timespec="seconds")
+
+
+class HistoryReader:
+    """
+    Truy vấn lịch sử trận đấu cho server
+    - Pool kết nối chỉ-đọc (mode=ro): ở chế độ WAL người đọc không tranh khóa với HistoryWriter
+    - Truy vấn chạy trên thread pool riêng, event loop chỉ await kết quả
+    - Phân trang kiểu keyset: con trỏ = (finished_at, id) của dòng cuối trang trước,
+      nên trang sau cũng nhanh như trang đầu (không OFFSET)
+    """
+
+    def __init__(self, db_path: str, pool_size: int = HISTORY_READERS):
+        self.db_path = db_path
+        self.pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self.connections: List[sqlite3.Connection] = []
+        self.pool_size = pool_size
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="history-reader")
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        db.execute("PRAGMA query_only=1")
+        db.row_factory = sqlite3.Row
+        return db
+
+    def _acquire(self) -> sqlite3.Connection:
+        """Lấy 1 kết nối rảnh; mở thêm (lười) nếu pool chưa đủ pool_size"""
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self.connections) < self.pool_size:
+                db = self._connect()
+                self.connections.append(db)
+                return db
+        return self.pool.get()
+
+    def _run(self, fn, *args) -> Any:
+        if self._closed:
+            raise RuntimeError("HistoryReader đã đóng")
+        db = self._acquire()
+        try:
+            return fn(db, *args)
+        finally:
+            self.pool.put(db)
+
+    async def query(self, fn, *args) -> Any:
+        """Chạy fn(db, *args) trên thread đọc, không chặn event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(self._run, fn, *args))
+
+    async def find_matches(self, **filters: Any) -> Dict[str, Any]:
+        return await self.query(query_matches, filters)
+
+    async def get_match(self, match_id: str) -> Optional[Dict[str, Any]]:
+        return await self.query(load_match, match_id)
+
+    def close(self) -> None:
+        self._closed = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for db in self.connections:
+            db.close()
+        self.connections.clear()
+
+
+def query_matches(db: sqlite3.Connection, filters: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    1 trang lịch sử, mới nhất trước
+    filters: player, winner, since, until (ISO 8601, theo finished_at), cursor, limit
+    Trả về {"matches": [...], "next": con trỏ trang sau hoặc None}
+
+    Raises:
+        ValueError: tham số sai kiểu / sai định dạng
+    """
+    player = filters.get("player")
+    winner = filters.get("winner")
+    for value in (player, winner):
+        if value is not None and not isinstance(value, str):
+            raise ValueError("player/winner phải là chuỗi")
+    since = _normalize_time(filters.get("since"))
+    until = _normalize_time(filters.get("until"))
+    limit = filters.get("limit", HISTORY_PAGE_SIZE)
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+        raise ValueError("limit phải là số nguyên dương")
+    limit = min(limit, HISTORY_PAGE_MAX)
+    cursor = filters.get("cursor")
+    if cursor is not None and (not isinstance(cursor, (list, tuple)) or len(cursor) != 2
+                               or not all(isinstance(v, str) for v in cursor)):
+        raise ValueError("cursor không hợp lệ")
+
+    conds: List[str] = []
+    params: List[Any] = []
+    if winner is not None:
+        conds.append("winner = ?")
+        params.append(winner)
+    if since is not None:
+        conds.append("finished_at >= ?")
+        params.append(since)
+    if until is not None:
+        conds.append("finished_at < ?")
+        params.append(until)
+    if cursor is not None:
+        conds.append("(finished_at, id) < (?, ?)")
+        params.extend(cursor)
+
+    cols = ", ".join(SUMMARY_COLUMNS)
+    order = "ORDER BY finished_at DESC, id DESC LIMIT ?"
+    if player is None:
+        where = f"WHERE {' AND '.join(conds)}" if conds else ""
+        sql = f"SELECT {cols} FROM matches {where} {order}"
+        args: Sequence[Any] = (*params, limit + 1)
+    else:
+        # 2 nhánh, mỗi nhánh đi đúng 1 index (player_x / player_o) và dừng sau limit dòng,
+        # rồi trộn lại - nhanh hơn OR vì không phải đọc hết mọi trận của người chơi rồi sort
+        rest = "".join(f" AND {c}" for c in conds)
+        sql = (f"SELECT * FROM (SELECT {cols} FROM matches WHERE player_x = ?{rest} {order}) "
+               f"UNION ALL "
+               f"SELECT * FROM (SELECT {cols} FROM matches WHERE player_o = ?{rest} {order}) "
+               f"ORDER BY finished_at DESC, id DESC LIMIT ?")
+        args = (player, *params, limit + 1, player, *params, limit + 1, limit + 1)
+
+    rows = [dict(r) for r in db.execute(sql, args)]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = [rows[-1]["finished_at"], rows[-1]["id"]]
+    return {"matches": rows, "next": next_cursor}
+
+
+def load_match(db: sqlite3.Connection, match_id: str) -> Optional[Dict[str, Any]]:
+    """1 trận kèm danh sách nước đi (None nếu không có)"""
+    row = db.execute(f"SELECT {', '.join(SUMMARY_COLUMNS)}, moves FROM matches WHERE id = ?",
+                     (match_id,)).fetchone()
+    if row is None:
+        return None
+    match = dict(row)
+    match["moves"] = load_moves(match["moves"])
+    return match
+
+
+def load_moves(value: Any) -> List[Dict[str, Any]]:
+    """Đọc cột moves: bytes (common.encode_moves) hoặc JSON của bản ghi cũ chưa chuyển đổi"""
+    if not value:
+        return []
+    if isinstance(value, (bytes, memoryview)):
+        return decode_moves(bytes(value))
+    return json.loads(value)
@@ -0,0 +1,108 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình chống spam/DoS
+# ============================================
+CLIENT_RATE = 10.0        # Mỗi kết nối: trung bình 10 tin/giây
+CLIENT_BURST = 20.0       # ... dồn tối đa 20 tin 1 lúc (như giới hạn cũ 20 tin / 2 giây)
+# Giới hạn riêng theo loại tin (tin/giây, dồn tối đa) - loại không có ở đây chỉ chịu giới hạn chung
+TYPE_LIMITS: Dict[str, Tuple[float, float]] = {
+    "chat": (1.0, 5.0),
+    "challenge": (1.0, 5.0),
+    "user_sync": (1.0, 3.0),
+    "spectate": (2.0, 5.0),
+    "history": (2.0, 5.0),
+    "history_match": (2.0, 5.0),
+    "position_stats": (2.0, 5.0),
+    "leaderboard": (2.0, 5.0),
+    "stats": (2.0, 5.0),
+    "queue_join": (1.0, 3.0),
+    "ping": (1.0, 3.0),
+    "pong": (1.0, 3.0),
+}
+CONNECT_RATE = 1000.0     # Cả server: tối đa 1000 kết nối mới/giây
+CONNECT_BURST = 5000.0    # ... dồn tối đa 5000 (cả phòng vào cùng lúc sau khi server khởi động lại)
+
+# Leo thang: mỗi tin bị chặn +1 điểm phạt, điểm phạt giảm dần theo thời gian
+PENALTY_DECAY = 2.0       # Điểm phạt giảm 2/giây (vượt giới hạn nhẹ thì không bao giờ bị ngắt)
+WARN_AT = 5.0             # Đủ 5 điểm → báo lỗi 1 lần (trước đó bỏ qua lặng lẽ)
+KICK_AT = 100.0           # Đủ 100 điểm (đang xả tin liên tục) → ngắt kết nối
+
+# Kết quả check()
+ALLOW = "allow"
+DROP = "drop"             # Bỏ tin, không trả lời gì
+WARN = "error"            # Bỏ tin, gửi 1 tin lỗi
+DISCONNECT = "disconnect" # Ngắt kết nối
+
+
+@dataclass(slots=True)
+class TokenBucket:
+    """
+    Thùng token: nạp rate token/giây, chứa tối đa burst token; mỗi tin lấy 1 token
+    Không cần task/timer - lượng token được tính bù lúc lấy → O(1), vài chục byte mỗi thùng
+    """
+    rate: float
+    burst: float
+    tokens: float
+    stamp: float  # time.monotonic lần nạp cuối
+
+    @classmethod
+    def full(cls, rate: float, burst: float, now: Optional[float] = None) -> "TokenBucket":
+        return cls(rate, burst, burst, time.monotonic() if now is None else now)
+
+    def take(self, now: float) -> bool:
+        """Lấy 1 token; False nếu thùng rỗng"""
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if tokens >= 1.0:
+            self.tokens = tokens - 1.0
+            return True
+        self.tokens = tokens
+        return False
+
+
+@dataclass(slots=True)
+class ClientLimiter:
+    """
+    Rate limit của 1 kết nối - gọi TRƯỚC khi giải mã JSON (loại tin đoán từ bytes thô)
+    - bucket: giới hạn chung mọi tin của kết nối
+    - types: thùng riêng theo loại, chỉ tạo khi gặp loại có trong TYPE_LIMITS
+      → client gửi loại lạ tùy ý cũng không làm dict phình ra
+    - penalty/warned: leo thang bỏ lặng lẽ → báo lỗi (1 lần) → ngắt kết nối
+    """
+    bucket: TokenBucket = field(default_factory=lambda: TokenBucket.full(CLIENT_RATE, CLIENT_BURST))
+    types: Dict[str, TokenBucket] = field(default_factory=dict)
+    penalty: float = 0.0
+    penalty_at: float = 0.0
+    warned: bool = False
+
+    def check(self, msg_type: Optional[str], now: Optional[float] = None) -> str:
+        """Tin loại msg_type vừa tới: ALLOW, hoặc cách xử lý tin bị chặn (DROP/WARN/DISCONNECT)"""
+        now = time.monotonic() if now is None else now
+        if not self.bucket.take(now):
+            return self.violation(now)
+        limit = TYPE_LIMITS.get(msg_type)
+        if limit is not None:
+            bucket = self.types.get(msg_type)
+            if bucket is None:
+                bucket = self.types[msg_type] = TokenBucket.full(*limit, now)
+            if not bucket.take(now):
+                return self.violation(now)
+        return ALLOW
+
+    def violation(self, now: Optional[float] = None) -> str:
+        """Ghi 1 lần vi phạm, trả về mức xử lý theo điểm phạt hiện tại"""
+        now = time.monotonic() if now is None else now
+        penalty = max(0.0, self.penalty - (now - self.penalty_at) * PENALTY_DECAY)
+        if penalty == 0.0:
+            self.warned = False  # Đã ngoan trở lại đủ lâu → lần sau lại được nhắc trước
+        self.penalty = penalty + 1.0
+        self.penalty_at = now
+        if self.penalty >= KICK_AT:
+            return DISCONNECT
+        if self.penalty >= WARN_AT and not self.warned:
+            self.warned = True
+            return WARN
+        return DROP
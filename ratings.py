@@ -0,0 +1,177 @@
+import argparse
+import sqlite3
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from logs import get_logger
+from persistence import open_db
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình xếp hạng Elo
+# ============================================
+INITIAL_RATING = 1200.0   # Điểm khởi đầu của người chơi mới
+ELO_K = 32.0              # Hệ số K: mỗi trận thay đổi tối đa 32 điểm
+LEADERBOARD_MAX = 100     # Số dòng tối đa mỗi lần xem bảng xếp hạng
+
+# Ghi kiểu cộng dồn (+delta) thay vì ghi đè giá trị tuyệt đối: nhiều tiến trình
+# (sharding.py) cùng ghi 1 người chơi thì database vẫn đúng
+UPSERT_PLAYER_SQL = (
+    "INSERT INTO players (name, rating, wins, losses, draws, updated_at) VALUES (?,?,?,?,?,?) "
+    "ON CONFLICT(name) DO UPDATE SET rating = players.rating + ?, "
+    "wins = players.wins + excluded.wins, losses = players.losses + excluded.losses, "
+    "draws = players.draws + excluded.draws, updated_at = excluded.updated_at"
+)
+
+log = get_logger("ratings")
+
+
+@dataclass(slots=True)
+class PlayerStats:
+    """Thành tích 1 người chơi (bản trong bộ nhớ, khớp với 1 dòng bảng players)"""
+    name: str
+    rating: float = INITIAL_RATING
+    wins: int = 0
+    losses: int = 0
+    draws: int = 0
+
+    @property
+    def games(self) -> int:
+        return self.wins + self.losses + self.draws
+
+
+def expected_score(rating: float, opponent: float) -> float:
+    """Xác suất thắng kỳ vọng theo Elo"""
+    return 1.0 / (1.0 + 10.0 ** ((opponent - rating) / 400.0))
+
+
+def elo_delta(rating_x: float, rating_o: float, score_x: float, k: float = ELO_K) -> float:
+    """Điểm X nhận được (O mất đúng chừng đó); score_x: 1 thắng, 0.5 hòa, 0 thua"""
+    return k * (score_x - expected_score(rating_x, rating_o))
+
+
+class Ratings:
+    """
+    Bảng xếp hạng Elo cập nhật dần theo từng trận - không bao giờ quét lại bảng matches
+    - Toàn bộ người chơi nằm trong bộ nhớ; ranking là danh sách (-rating, tên) đã sắp xếp
+      → top N là 1 lát cắt, thứ hạng 1 người là 1 lần bisect
+    - Ghi xuyên (write-through): mỗi trận đẩy 2 câu UPSERT vào HistoryWriter,
+      đi chung batch với bản ghi trận đấu
+    - Chạy nhiều tiến trình: mỗi tiến trình giữ cache riêng (thấy thay đổi của tiến trình
+      khác sau khi khởi động lại), database thì luôn đúng nhờ ghi cộng dồn
+    """
+
+    def __init__(self, history=None):
+        self.history = history      # HistoryWriter (None = chỉ giữ trong bộ nhớ)
+        self.players: Dict[str, PlayerStats] = {}
+        self.ranking: List[Tuple[float, str]] = []
+
+    def load(self, db_path: str) -> None:
+        """Nạp bảng players vào bộ nhớ (gọi 1 lần lúc khởi động, sau khi bảng đã được tạo)"""
+        db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            rows = db.execute("SELECT name, rating, wins, losses, draws FROM players").fetchall()
+        finally:
+            db.close()
+        self.players = {r[0]: PlayerStats(*r) for r in rows}
+        self.ranking = sorted((-p.rating, p.name) for p in self.players.values())
+        log.info("ratings_loaded", players=len(self.players))
+
+    def get(self, name: str) -> PlayerStats:
+        p = self.players.get(name)
+        if p is None:
+            p = self.players[name] = PlayerStats(name)
+            insort(self.ranking, (-p.rating, name))
+        return p
+
+    def _set_rating(self, p: PlayerStats, rating: float) -> None:
+        """Đổi điểm + dời vị trí trong ranking (2 lần memmove, ~1ms với 1 triệu người chơi)"""
+        i = bisect_left(self.ranking, (-p.rating, p.name))
+        del self.ranking[i]
+        p.rating = rating
+        insort(self.ranking, (-rating, p.name))
+
+    def record(self, player_x: str, player_o: str, winner: Optional[str]) -> float:
+        """Cập nhật sau 1 trận (winner=None: hòa); trả về số điểm X nhận được"""
+        px, po = self.get(player_x), self.get(player_o)
+        score_x = 0.5 if winner is None else 1.0 if winner == player_x else 0.0
+        delta = elo_delta(px.rating, po.rating, score_x)
+        self._set_rating(px, px.rating + delta)
+        self._set_rating(po, po.rating - delta)
+
+        result_x = (1, 0, 0) if score_x == 1.0 else (0, 1, 0) if score_x == 0.0 else (0, 0, 1)
+        result_o = (result_x[1], result_x[0], result_x[2])
+        for p, (w, l, d), change in ((px, result_x, delta), (po, result_o, -delta)):
+            p.wins += w
+            p.losses += l
+            p.draws += d
+            if self.history is not None:
+                now = datetime.now().isoformat(timespec="seconds")
+                self.history.submit(UPSERT_PLAYER_SQL, (p.name, INITIAL_RATING + change, w, l, d, now, change))
+        return delta
+
+    def rating_of(self, name: str) -> float:
+        """Điểm hiện tại (người chưa đánh trận nào: INITIAL_RATING), không tạo bản ghi mới"""
+        p = self.players.get(name)
+        return p.rating if p is not None else INITIAL_RATING
+
+    def rank(self, name: str) -> Optional[int]:
+        """Thứ hạng (1 = cao nhất), None nếu chưa đánh trận nào"""
+        p = self.players.get(name)
+        if p is None:
+            return None
+        return bisect_left(self.ranking, (-p.rating, p.name)) + 1
+
+    def stats(self, name: str) -> Dict[str, Any]:
+        p = self.players.get(name) or PlayerStats(name)
+        return {"name": p.name, "rating": round(p.rating, 1), "rank": self.rank(name),
+                "wins": p.wins, "losses": p.losses, "draws": p.draws, "games": p.games}
+
+    def leaderboard(self, limit: int = 10, offset: int = 0) -> List[Dict[str, Any]]:
+        rows = []
+        for i, (_, name) in enumerate(self.ranking[offset:offset + limit], start=offset + 1):
+            p = self.players[name]
+            rows.append({"rank": i, "name": name, "rating": round(p.rating, 1),
+                         "wins": p.wins, "losses": p.losses, "draws": p.draws})
+        return rows
+
+
+# ============================================
+# DỰNG LẠI BẢNG players TỪ LỊCH SỬ (chạy 1 lần cho database cũ)
+# ============================================
+
+def rebuild(db_path: str) -> int:
+    """
+    Tính lại toàn bộ Elo bằng cách phát lại bảng matches theo thứ tự kết thúc
+    Ghi đè bảng players → chạy khi server đã dừng
+    """
+    db = open_db(db_path)
+    try:
+        ratings = Ratings()
+        n = 0
+        for x, o, winner in db.execute(
+                "SELECT player_x, player_o, winner FROM matches ORDER BY finished_at, id"):
+            ratings.record(x, o, None if winner in (None, "draw") else winner)
+            n += 1
+        now = datetime.now().isoformat(timespec="seconds")
+        with db:
+            db.execute("DELETE FROM players")
+            db.executemany(
+                "INSERT INTO players (name, rating, wins, losses, draws, updated_at) VALUES (?,?,?,?,?,?)",
+                [(p.name, p.rating, p.wins, p.losses, p.draws, now) for p in ratings.players.values()])
+        return n
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dựng lại bảng xếp hạng Elo từ lịch sử trận đấu")
+    parser.add_argument("--db", default="game_history.db", help="file SQLite lưu lịch sử")
+    args = parser.parse_args()
+    n = rebuild(args.db)
+    print(f"Đã tính lại xếp hạng từ {n} trận")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,101 @@
 import asyncio
-import sqlite3
-import json
+import multiprocessing
+import secrets
 import time
-import threading
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime
 import socket
-from typing import Dict, Optional, List
-from collections import deque
+from typing import Any, Callable, Dict, Optional, List, Tuple
 
-from common import BOARD_SIZE, THINK_TIME_SECONDS, send_json, recv_json, find_win_line
+from common import (BOARD_SIZE, THINK_TIME_SECONDS, PROTO_BINARY, PROTO_JSON, SUPPORTED_PROTOS,
+                    Board, ConnectionClosed, send_json, recv_json, recv_raw, peek_type, decode_frame, encode_message,
+                    encode_moves)
+from persistence import HistoryReader, HistoryWriter
+from journal import MatchJournal, RecoveredMatch, journal_path_for
+from ratings import LEADERBOARD_MAX, Ratings
+from matchmaking import SWEEP_INTERVAL, MatchQueue
+from ratelimit import ALLOW, CONNECT_BURST, CONNECT_RATE, DISCONNECT, WARN, ClientLimiter, TokenBucket
+from ai import AI_THINK_SECONDS, AI_WORKERS, BOT_NAMES, search_move
+from opening_book import BOOK_FILE, canonical_hash, canonical_hashes, open_book
+from timers import TimerWheel
+from metrics import REGISTRY, METRICS_PORT, start_metrics_server
+from logs import configure_logging, get_logger
 
 # ============================================
 # CÁC HẰNG SỐ - Kiểu như settings của game
 # ============================================
 HIGHLIGHT_DELAY = 3.0  # Đợi 3 giây để người chơi ngắm line thắng trước khi kết thúc
-RATE_LIMIT_REQUESTS = 20  # Tối đa 20 requests
-RATE_LIMIT_WINDOW = 2.0   # Trong 2 giây (chống spam/DoS)
 BROADCAST_DEBOUNCE = 0.1  # Debounce 100ms cho broadcast user list
+STATE_FEED_INTERVAL = 0.25  # Gom thay đổi clients/matches 250ms rồi mới đẩy cho bảng điều khiển
+OUTBOX_LIMIT = 256 * 1024  # Client đọc chậm để dồn quá 256KB chưa gửi được → ngắt kết nối
+MAX_SPECTATORS = 500       # Số người xem tối đa mỗi trận
+SPECTATOR_LAG_BYTES = 32 * 1024  # Người xem còn dồn quá 32KB chưa gửi → bỏ qua nước đi, bù bằng snapshot
+IDLE_SWEEP_INTERVAL = 5.0  # Chu kỳ quét kết nối im lặng (1 task cho cả server)
+PING_AFTER = 20.0          # Im lặng quá 20 giây → server gửi ping
+IDLE_TIMEOUT = 60.0        # Im lặng quá 60 giây (không cả pong) → coi như chết, ngắt kết nối
+RESUME_GRACE = 30.0        # Rớt mạng giữa trận: giữ trận + đồng hồ 30 giây chờ resume rồi mới xử thua
+STOP_FLUSH_TIMEOUT = 2.0   # Khi tắt server: chờ tối đa 2 giây để gửi nốt outbox (match_end...) cho mọi client
+RESTORE_MIN_TURN = 10.0    # Trận dựng lại sau khi khởi động lại: lượt đang dở còn ít nhất 10 giây
+
+# Trạng thái trận: đang đánh → (có người thắng) đang hiện line thắng → đã kết thúc
+MATCH_PLAYING = "playing"
+MATCH_HIGHLIGHTING = "highlighting"
+MATCH_FINISHED = "finished"
+
+log = get_logger("server")
+
+# ============================================
+# METRICS - chỉ cộng số ở hot path, xuất qua HTTP khi có người scrape (metrics.py)
+# ============================================
+MSG_TYPES = ("challenge", "accept", "move", "chat", "timeout", "user_sync", "spectate", "unspectate",
+             "history", "history_match", "leaderboard", "stats", "queue_join", "queue_leave",
+             "position_stats", "ping", "pong")
+MESSAGES_RECEIVED = REGISTRY.counter("caro_messages_received_total", "Tin nhắn nhận từ client theo loại", ("type",))
+HANDLER_SECONDS = REGISTRY.histogram("caro_handler_seconds", "Thời gian xử lý 1 tin nhắn theo loại", ("type",))
+# Nhãn cố định sẵn: loại lạ gom vào "unknown" để client xấu không tạo ra vô số chuỗi nhãn
+HANDLER_METRICS = {t: (MESSAGES_RECEIVED.labels(t), HANDLER_SECONDS.labels(t)) for t in MSG_TYPES + ("unknown",)}
+RATE_LIMITED = REGISTRY.counter("caro_rate_limited_total", "Tin nhắn bị chặn vì rate limit theo cách xử lý", ("action",))
+CONNECTIONS_REJECTED = REGISTRY.counter("caro_connections_rejected_total", "Kết nối mới bị từ chối vì quá nhiều kết nối/giây")
+MESSAGES_SENT = REGISTRY.counter("caro_messages_sent_total", "Tin nhắn xếp vào outbox")
+BYTES_SENT = REGISTRY.counter("caro_bytes_sent_total", "Số byte xếp vào outbox")
+SOCKET_WRITES = REGISTRY.counter("caro_socket_writes_total", "Số lần write() xuống socket (sau khi gom outbox)")
+SLOW_CLIENT_DROPS = REGISTRY.counter("caro_slow_client_drops_total", "Kết nối bị ngắt vì đọc quá chậm")
+IDLE_EVICTIONS = REGISTRY.counter("caro_idle_evictions_total", "Kết nối bị ngắt vì im lặng quá IDLE_TIMEOUT")
+PINGS_SENT = REGISTRY.counter("caro_pings_sent_total", "Số ping server gửi cho kết nối im lặng")
+SESSIONS_DETACHED = REGISTRY.counter("caro_sessions_detached_total", "Người chơi rớt mạng giữa trận, trận được giữ chờ resume")
+SESSIONS_RESUMED = REGISTRY.counter("caro_sessions_resumed_total", "Số lần resume phiên thành công")
+SESSIONS_EXPIRED = REGISTRY.counter("caro_sessions_expired_total", "Phiên hết RESUME_GRACE mà không quay lại")
+MATCHES_RESTORED = REGISTRY.counter("caro_matches_restored_total", "Trận đang đánh dở được dựng lại từ nhật ký lúc khởi động")
+LOGINS = REGISTRY.counter("caro_logins_total", "Số lần đăng nhập thành công")
+MATCHES_STARTED = REGISTRY.counter("caro_matches_started_total", "Số trận đã bắt đầu")
+QUEUE_PAIRED = REGISTRY.counter("caro_matchmaking_pairs_total", "Số cặp được hàng chờ ghép tự động")
+QUEUE_WAIT_SECONDS = REGISTRY.histogram("caro_matchmaking_wait_seconds", "Thời gian chờ trong hàng đến khi được ghép",
+                                        buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 20, 40, 60))
+MATCHES_FINISHED = REGISTRY.counter("caro_matches_finished_total", "Số trận đã kết thúc theo lý do", ("reason",))
+FINISH_SECONDS = REGISTRY.histogram("caro_finish_match_seconds", "Thời gian finish_match")
+AI_SEARCH_SECONDS = REGISTRY.histogram("caro_ai_search_seconds", "Thời gian bot tìm 1 nước (tính cả chờ process pool)",
+                                       buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10))
+SPECTATOR_SKIPPED = REGISTRY.counter("caro_spectator_events_skipped_total", "Sự kiện bỏ qua vì người xem đọc chậm")
+HISTORY_SAVE_ERRORS = REGISTRY.counter("caro_history_save_errors_total", "Lỗi khi đẩy lịch sử vào hàng đợi ghi")
+CLIENTS_ONLINE = REGISTRY.gauge("caro_clients_online", "Số người đang online ở tiến trình này")
+MATCHES_LIVE = REGISTRY.gauge("caro_matches_live", "Số trận đang diễn ra")
+SPECTATORS = REGISTRY.gauge("caro_spectators", "Số client đang xem trận qua mạng")
+TIMERS_PENDING = REGISTRY.gauge("caro_timers_pending", "Số lượt đang được đếm giờ trên bánh xe hẹn giờ")
+INVITES_PENDING = REGISTRY.gauge("caro_invites_pending", "Số lời mời đang chờ")
+QUEUE_WAITING = REGISTRY.gauge("caro_matchmaking_waiting", "Số người đang chờ ghép trận")
+OUTBOX_BYTES = REGISTRY.gauge("caro_outbox_bytes", "Tổng số byte đang chờ gửi trong outbox của mọi client")
+HISTORY_QUEUE_DEPTH = REGISTRY.gauge("caro_history_queue_depth", "Số bản ghi lịch sử đang chờ ghi")
+HISTORY_COMMITTED = REGISTRY.gauge("caro_history_committed_records", "Số bản ghi lịch sử đã commit")
+HISTORY_COMMIT_MS = REGISTRY.gauge("caro_history_last_commit_ms", "Thời gian commit batch gần nhất (ms)")
+JOURNAL_QUEUE_DEPTH = REGISTRY.gauge("caro_journal_queue_depth", "Số sự kiện trận đang chờ fsync vào nhật ký")
+JOURNAL_BYTES = REGISTRY.gauge("caro_journal_bytes", "Kích thước file nhật ký trận (byte)")
+JOURNAL_DROPPED = REGISTRY.gauge("caro_journal_dropped_events", "Sự kiện trận bị bỏ vì hàng đợi nhật ký đầy / thread ghi hỏng")
+JOURNAL_FAILED = REGISTRY.gauge("caro_journal_failed", "1 nếu thread ghi nhật ký trận đã dừng vì lỗi đĩa")
+
+class ClientMigrated(Exception):
+    """Báo cho serve_client: kết nối đã được chuyển sang shard khác, không xử lý như disconnect"""
+
 
 # ============================================
 # DATACLASS - Cấu trúc dữ liệu dễ hiểu
@@ -30,48 +108,195 @@ class Client:
     - name: tên hiển thị
     - reader/writer: ống dẫn để gửi/nhận tin nhắn
     - in_match: đang ở trận nào? (None = đang rảnh)
-    - request_times: lịch sử request để rate limiting
+    - limiter: thùng token chung + theo loại tin, điểm phạt leo thang (ratelimit.py)
+    - binary: đã thỏa thuận giao thức nhị phân lúc login chưa (mặc định JSON)
+    - outbox: hàng đợi gửi đi; writer_task gom mọi tin sinh ra trong cùng 1 vòng
+      event loop thành 1 lần write() duy nhất
+    - spectating: đang xem trận nào (None = không xem); spectate_stale: đã bị bỏ
+      qua sự kiện vì đọc chậm, lần gửi tới phải là snapshot
+    - last_seen: lần cuối nhận được gì từ client (time.monotonic); pinged_at: lần cuối
+      server gửi ping - idle_reaper dùng để phát hiện kết nối chết (half-open)
+    - session: mã phiên gửi kèm login_ok, dùng để resume khi rớt mạng giữa trận
+    - detached: đã rớt kết nối, đang chờ resume; deadline/timer_slot: hẹn giờ hết hạn
+      chờ trên bánh xe session_timers
+    - evicted: idle_reaper vừa ngắt vì im lặng quá lâu (mất mạng, không phải tự thoát)
     """
     name: str
     reader: asyncio.StreamReader
     writer: asyncio.StreamWriter
     in_match: Optional[str] = None
-    request_times: deque = field(default_factory=lambda: deque(maxlen=RATE_LIMIT_REQUESTS))
+    binary: bool = False
+    limiter: ClientLimiter = field(default_factory=ClientLimiter)
+    outbox: List[bytes] = field(default_factory=list)
+    outbox_bytes: int = 0
+    outbox_ready: asyncio.Event = field(default_factory=asyncio.Event)
+    writer_task: Optional[asyncio.Task] = None
+    spectating: Optional[str] = None
+    spectate_stale: bool = False
+    last_seen: float = field(default_factory=time.monotonic)
+    pinged_at: float = 0.0
+    session: Optional[str] = None
+    detached: bool = False
+    evicted: bool = False
+    deadline: float = 0.0
+    timer_slot: int = -1
 
-@dataclass
+    def backlog(self) -> int:
+        """Số byte chưa gửi được: outbox + bộ đệm ghi của transport"""
+        return self.outbox_bytes + self.writer.transport.get_write_buffer_size()
+
+    def send(self, obj: Dict) -> None:
+        """Xếp message vào hàng đợi gửi (không chờ mạng) theo giao thức của client"""
+        self.send_bytes(encode_message(obj, self.binary))
+
+    def send_bytes(self, data: bytes) -> None:
+        """
+        Xếp dữ liệu đã mã hóa vào hàng đợi gửi
+        Backpressure: client không đọc kịp, dữ liệu dồn quá OUTBOX_LIMIT → ngắt kết nối
+        luôn, thay vì để coroutine của người khác phải đợi client chậm này
+        """
+        if self.writer is None or self.writer.is_closing():
+            return  # Chưa có kết nối (trận dựng lại từ nhật ký, chờ resume) hoặc đang đóng
+        self.outbox.append(data)
+        self.outbox_bytes += len(data)
+        MESSAGES_SENT.inc()
+        BYTES_SENT.inc(len(data))
+        if self.backlog() > OUTBOX_LIMIT:
+            log.warning("slow_client_dropped", name=self.name, pending_bytes=self.outbox_bytes)
+            SLOW_CLIENT_DROPS.inc()
+            self.outbox.clear()
+            self.outbox_bytes = 0
+            self.writer.transport.abort()
+            return
+        self.outbox_ready.set()
+
+    def start_writer(self) -> None:
+        self.writer_task = asyncio.create_task(self._writer_loop())
+
+    def stop_writer(self) -> None:
+        if self.writer_task and not self.writer_task.done():
+            self.writer_task.cancel()
+        self.writer_task = None
+
+    async def flush_outbox(self) -> None:
+        """Dừng task gửi, ghi thẳng phần outbox còn lại xuống socket rồi chờ drain"""
+        self.stop_writer()
+        if self.outbox:
+            self.writer.write(b"".join(self.outbox))
+            self.outbox.clear()
+            self.outbox_bytes = 0
+        await self.writer.drain()
+
+    async def _writer_loop(self) -> None:
+        """Task gửi: mỗi lần thức dậy gộp hết outbox thành 1 lần write + drain"""
+        try:
+            while True:
+                await self.outbox_ready.wait()
+                self.outbox_ready.clear()
+                if not self.outbox:
+                    continue
+                data = self.outbox[0] if len(self.outbox) == 1 else b"".join(self.outbox)
+                self.outbox.clear()
+                self.outbox_bytes = 0
+                self.writer.write(data)
+                SOCKET_WRITES.inc()
+                await self.writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except (ConnectionError, RuntimeError) as e:
+            log.info("send_stopped", name=self.name, error=str(e))
+
+class BotClient(Client):
+    """
+    Người chơi ảo do máy (ai.py) điều khiển - không có socket
+    - Nằm trong server.clients như mọi người khác → thách đấu, xem trận, lịch sử, Elo dùng chung code
+    - send() nhận thẳng dict thay vì mã hóa: lời mời thì tự chấp nhận, your_turn thì
+      nhờ server tìm nước (CaroServer.bot_move, chạy trong process pool)
+    - Tin đã mã hóa sẵn (danh sách online...) bot không cần nên bỏ qua
+    """
+
+    def __init__(self, name: str, server: "CaroServer"):
+        super().__init__(name, None, None)
+        self.server = server
+        self.tasks: set = set()
+
+    def backlog(self) -> int:
+        return 0
+
+    def send_bytes(self, data: bytes) -> None:
+        pass
+
+    def send(self, obj: Dict) -> None:
+        t = obj.get("type")
+        if t == "invite":
+            self.spawn(self.server.handle_accept(self, obj["from"]))
+        elif t == "your_turn":
+            self.spawn(self.server.bot_move(self))
+        elif t == "error":
+            log.debug("bot_error", name=self.name, msg=obj.get("msg"))
+
+    def spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def start_writer(self) -> None:
+        pass
+
+    def stop_writer(self) -> None:
+        for task in list(self.tasks):
+            task.cancel()
+        self.tasks.clear()
+
+@dataclass(slots=True)
 class Match:
     """
     Một trận đấu đang diễn ra
     - id: mã trận (M + timestamp)
     - player_x/player_o: ai cầm X, ai cầm O
-    - board: bàn cờ 15x15, "." = ô trống
+    - board: bàn cờ 15x15 dạng bitboard (xem common.Board)
     - turn: lượt của ai ("X" hoặc "O")
     - moves: lịch sử các nước đi (để lưu database sau)
-    - deadline: hết giờ lúc nào?
-    - timer_task: cái đồng hồ đếm ngược đang chạy
-    - is_finishing: flag để tránh race condition khi finish_match được gọi nhiều lần
+    - deadline: hết giờ lúc nào? (time.monotonic) - hết lượt khi đang đánh, hết giờ
+      hiện line thắng khi đang highlight
+    - timer_slot: ô đang chiếm trên bánh xe hẹn giờ của server (-1 = không đếm giờ)
+    - state: MATCH_PLAYING → MATCH_HIGHLIGHTING (đã có người thắng, chờ HIGHLIGHT_DELAY)
+      → MATCH_FINISHED; finish_match chỉ chạy 1 lần nhờ state
+    - winner/end_reason: kết quả đã chốt, chờ bánh xe hẹn giờ kết thúc trận
+    - watchers: callback của những người đang xem trận (xem CaroServer.watch_match)
+    - spectators: client xem trận qua mạng, tên → Client (xem CaroServer.handle_spectate)
     """
     id: str
     player_x: str
     player_o: str
-    board: List[List[str]] = field(default_factory=lambda: [["." for _ in range(BOARD_SIZE)] for _ in range(BOARD_SIZE)])
+    board: Board = field(default_factory=Board)
     turn: str = "X"
     started_at: float = field(default_factory=time.time)
     moves: List[Dict] = field(default_factory=list)
     deadline: Optional[float] = None
-    timer_task: Optional[asyncio.Task] = None
-    is_finishing: bool = False  # Cờ để tránh race condition
+    timer_slot: int = -1
+    state: str = MATCH_PLAYING
+    winner: Optional[str] = None
+    end_reason: Optional[str] = None
+    watchers: List[Callable[[Dict], None]] = field(default_factory=list)
+    spectators: Dict[str, "Client"] = field(default_factory=dict)
+
+    @property
+    def is_finishing(self) -> bool:
+        """Đã (hoặc đang) chạy finish_match - tránh race condition khi nhiều nơi cùng kết thúc trận"""
+        return self.state == MATCH_FINISHED
 
 # ============================================
 # SERVER CHÍNH
 # ============================================
 
 class CaroServer:
-    def __init__(self, host="0.0.0.0", port=7777, db_path="game_history.db"):
+    def __init__(self, host="0.0.0.0", port=7777, db_path="game_history.db",
+                 journal_path: Optional[str] = None):
         """
         Khởi tạo server - như mở cửa hàng cờ
-        - Kết nối database để lưu lịch sử (thread-safe với lock)
-        - Tạo bảng matches nếu chưa có
+        - Bật thread ghi lịch sử (SQLite chạy ở thread riêng, không chặn event loop)
+        - Mở nhật ký trận đang đánh (journal.py), giữ lại các trận đánh dở để start() dựng lại
         - Chuẩn bị 3 dictionary để quản lý:
           + clients: danh sách người online
           + matches: các trận đang đấu
@@ -79,47 +304,95 @@ class CaroServer:
         """
         self.host = host
         self.port = port
-        print(f"[INFO] Connecting to database: {db_path}")
-        
-        # Kết nối database với thread safety
-        self.db = sqlite3.connect(db_path, check_same_thread=False)
-        self.db_lock = threading.Lock()  # Lock để đảm bảo thread-safe
-        print("[INFO] Database connected successfully")
-        
-        # Tạo bảng lưu lịch sử nếu chưa có
-        with self.db_lock:
-            self.db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS matches (
-                    id TEXT PRIMARY KEY,
-                    player_x TEXT,
-                    player_o TEXT,
-                    winner TEXT,
-                    started_at TEXT,
-                    finished_at TEXT,
-                    moves TEXT
-                )
-                """
-            )
-            self.db.commit()
+        self.server = None
+        self.reuse_port = False  # Bật khi nhiều tiến trình cùng nghe 1 port (sharding.py)
+        configure_logging()  # Log qua hàng đợi + thread ghi (không làm gì nếu đã cấu hình)
+        log.info("db_connecting", path=db_path)
+        
+        # Thread ghi lịch sử: tự tạo bảng, bật WAL, group commit
+        self.history = HistoryWriter(db_path)
+        self.history.start()
+        # Truy vấn lịch sử: pool kết nối chỉ-đọc trên thread riêng, không tranh với thread ghi
+        self.history_reader = HistoryReader(db_path)
+        # Bảng xếp hạng Elo: nạp 1 lần vào bộ nhớ, sau đó cập nhật dần + ghi xuyên qua self.history
+        self.ratings = Ratings(self.history)
+        self.ratings.load(db_path)
+        log.info("db_connected", path=db_path)
+        # Nhật ký trận đang đánh: thread riêng gom sự kiện + fsync theo batch, tự nén file
+        self.journal = MatchJournal(journal_path or journal_path_for(db_path))
+        self.recovered, self.journal_last_ts = self.journal.open()
+        self.stopping = False  # stop() đang chạy: kết nối bị đóng không tính là bỏ trận
+        # Sổ khai cuộc (opening_book.py dựng offline): mmap chỉ-đọc, chưa dựng thì None
+        self.book = open_book(BOOK_FILE)
+        
+        # 1 bánh xe hẹn giờ chung cho mọi trận (thay vì mỗi lượt 1 task): hết lượt + hết giờ highlight
+        self.timers = TimerWheel(self.on_match_timer)
+        
+        # HTTP endpoint metrics (None = tắt); các gauge chỉ được tính khi có người scrape
+        self.metrics_port: Optional[int] = METRICS_PORT
+        self.metrics_server = None
         
         # 3 bộ não của server
         self.clients: Dict[str, Client] = {}  # Ai đang online?
         self.matches: Dict[str, Match] = {}   # Trận nào đang đấu?
         self.pending_invites: Dict[tuple, bool] = {}  # Lời mời nào đang chờ?
         
-        # Cache để tối ưu broadcast
-        self.last_user_list: List[str] = []
+        # Giới hạn số kết nối mới/giây của cả server (kiểm tra trước cả login)
+        self.connect_limiter = TokenBucket.full(CONNECT_RATE, CONNECT_BURST)
+        
+        # Hàng chờ ghép trận tự động theo Elo (queue_join / queue_leave)
+        self.matchmaking = MatchQueue()
+        self.matchmaking_task: Optional[asyncio.Task] = None
+        
+        # Dọn kết nối chết: 1 task quét tất cả (None = tắt hẳn); sharding.py cho chỉnh qua tham số
+        self.idle_sweep = IDLE_SWEEP_INTERVAL
+        self.ping_after: Optional[float] = PING_AFTER
+        self.idle_timeout: Optional[float] = IDLE_TIMEOUT
+        self.reaper_task: Optional[asyncio.Task] = None
+        
+        # Resume phiên: mã phiên → tên; người rớt mạng giữa trận nằm trên bánh xe riêng,
+        # hết resume_grace mà chưa quay lại thì dọn như disconnect thường (None = xử thua ngay như cũ)
+        self.sessions: Dict[str, str] = {}
+        self.resume_grace: Optional[float] = RESUME_GRACE
+        self.session_timers = TimerWheel(self.on_session_expired)
+        
+        # Bot (ai.py): tìm nước trong tiến trình con, tạo lúc có nước đầu tiên cần tìm
+        self.bot_names = BOT_NAMES
+        self.ai_pool: Optional[ProcessPoolExecutor] = None
+        
+        # Danh sách online theo kiểu phiên bản: client nhận snapshot 1 lần lúc login,
+        # sau đó chỉ nhận phần thay đổi (user_delta) đánh số thứ tự presence_seq
+        self.presence: Dict[str, None] = {}             # Những người đã thông báo là online
+        self.presence_pending: Dict[str, bool] = {}     # Thay đổi chưa gửi: tên → online?
+        self.presence_seq = 0
         self.broadcast_task: Optional[asyncio.Task] = None
+        
+        # Luồng thay đổi cho bảng điều khiển (gui_server.py) ở thread khác:
+        # thread đó không đọc thẳng clients/matches mà nhận snapshot + các gói thay đổi
+        self.state_subscribers: List[Callable[[Dict], None]] = []
+        self.state_pending: Dict[Tuple[str, str], Any] = {}  # (loại, khóa) → dòng mới (None = đã xóa)
+        self.state_seq = 0
+        self.state_flush: Optional[asyncio.TimerHandle] = None
         self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.register_metrics()
+
+    def register_metrics(self):
+        """Gắn các gauge vào trạng thái của server này (tính lúc scrape, không tốn gì ở hot path)"""
+        CLIENTS_ONLINE.set_function(lambda: len(self.clients))
+        MATCHES_LIVE.set_function(lambda: len(self.matches))
+        SPECTATORS.set_function(lambda: sum(len(m.spectators) for m in list(self.matches.values())))
+        TIMERS_PENDING.set_function(lambda: self.timers.count)
+        INVITES_PENDING.set_function(lambda: len(self.pending_invites))
+        QUEUE_WAITING.set_function(lambda: len(self.matchmaking))
+        OUTBOX_BYTES.set_function(lambda: sum(c.outbox_bytes for c in list(self.clients.values())))
+        HISTORY_QUEUE_DEPTH.set_function(self.history.pending)
+        HISTORY_COMMITTED.set_function(lambda: self.history.committed)
+        HISTORY_COMMIT_MS.set_function(lambda: self.history.last_commit_ms)
+        JOURNAL_QUEUE_DEPTH.set_function(lambda: self.journal.queue.qsize())
+        JOURNAL_BYTES.set_function(lambda: self.journal.size)
+        JOURNAL_DROPPED.set_function(lambda: self.journal.dropped)
+        JOURNAL_FAILED.set_function(lambda: int(self.journal.failed))
 
-    def __del__(self):
-        """Dọn dẹp khi tắt server - đóng database cho sạch"""
-        if hasattr(self, 'db'):
-            with self.db_lock:
-                self.db.close()
-            print("[INFO] Database connection closed")
-            
     def get_local_ip(self):
         """Lấy IP nội bộ của máy (LAN IP)"""
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -139,32 +412,75 @@ class CaroServer:
         Lắng nghe ở port 7777 (mặc định) hoặc port do người dùng nhập, mỗi người vào sẽ gọi handle_client
         """
         self.loop = asyncio.get_event_loop()
-        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        await self.start_metrics()
+        await self.start_bots()
+        await self.restore_matches()
+        if self.idle_timeout and (not self.reaper_task or self.reaper_task.done()):
+            self.reaper_task = asyncio.create_task(self.idle_reaper())
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                                 reuse_port=self.reuse_port)
         
         # Lấy IP thật của máy để hiển thị
         local_ip = self.get_local_ip()
-        print(f"[INFO] Server listening on {self.host}:{self.port}")
-        print(f"[INFO] LAN IP address: {local_ip}:{self.port}")
+        log.info("listening", host=self.host, port=self.port, lan_address=f"{local_ip}:{self.port}")
         async with self.server:
             await self.server.serve_forever()
 
+    async def start_metrics(self):
+        """Mở endpoint metrics; không mở được (trùng port...) thì server vẫn chạy bình thường"""
+        if self.metrics_port is None or self.metrics_server:
+            return
+        try:
+            self.metrics_server = await start_metrics_server(port=self.metrics_port)
+            log.info("metrics_listening", url=f"http://127.0.0.1:{self.metrics_port}/metrics")
+        except OSError as e:
+            log.warning("metrics_disabled", error=str(e))
+
+    async def start_bots(self):
+        """Đăng ký các bot như người chơi online (tên đã có người dùng thì bỏ qua)"""
+        for name in self.bot_names:
+            if name in self.clients or not await self.claim_name(name):
+                log.info("bot_skipped", name=name)
+                continue
+            self.clients[name] = BotClient(name, self)
+            self.state_changed("client", name, name)
+            self.presence_changed(name, True)
+            log.info("bot_online", name=name)
+
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """
         Xử lý 1 người chơi từ khi vào đến khi thoát
         Flow: Login -> Chơi game -> Disconnect -> Cleanup
         """
+        if not self.connect_limiter.take(time.monotonic()):
+            # Quá nhiều kết nối mới cùng lúc → đóng luôn, không tốn công đọc login
+            CONNECTIONS_REJECTED.inc()
+            writer.transport.abort()
+            return
+        client = await self.login(reader, writer)
+        if client:
+            await self.serve_client(client)
+
+    async def login(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[Client]:
+        """
+        BƯỚC 1-2: Đợi người chơi login, kiểm tra tên, đăng ký vào danh sách online
+        Trả về Client nếu thành công, None nếu thất bại (kết nối đã được đóng)
+        """
         addr = writer.get_extra_info('peername')
-        client_name = None
         try:
             # BƯỚC 1: Đợi người chơi login
             msg = await recv_json(reader)
             
+            # Kết nối lại sau khi rớt mạng: gắn vào Client cũ thay vì đăng nhập mới
+            if msg.get("type") == "resume":
+                return await self.resume_session(msg, reader, writer)
+            
             # Bắt buộc phải login trước
             if msg.get("type") != "login" or not msg.get("name"):
                 await send_json(writer, {"type": "error", "msg": "Must login first"})
                 writer.close()
                 await writer.wait_closed()
-                return
+                return None
             
             # Kiểm tra tên hợp lệ (1-50 ký tự, không rỗng)
             name = msg["name"].strip()
@@ -172,113 +488,404 @@ class CaroServer:
                 await send_json(writer, {"type": "error", "msg": "Invalid name (1-50 characters)"})
                 writer.close()
                 await writer.wait_closed()
-                return
+                return None
             
             # Kiểm tra tên có bị trùng không
-            if name in self.clients:
+            if not await self.claim_name(name):
                 await send_json(writer, {"type": "error", "msg": "Name already in use"})
                 writer.close()
                 await writer.wait_closed()
-                return
-            
-            # BƯỚC 2: ĐĂNG KÝ THÀNH CÔNG!
-            client_name = name
-            self.clients[name] = Client(name, reader, writer)
-            print(f"[INFO] {name} connected from {addr}")
-            
-            # Gửi danh sách người online cho người mới
-            await send_json(writer, {"type": "login_ok", "users": list(self.clients.keys())})
-            # Thông báo cho tất cả người khác: có người vừa vào
-            await self.broadcast_user_list()
-            
+                return None
+        except asyncio.CancelledError:
+            log.info("login_cancelled", addr=addr)
+            writer.close()
+            return None
+        except Exception as e:
+            log.info("login_failed", addr=addr, error=str(e))
+            writer.close()
+            return None
+        
+        # Giao thức: client cũ không gửi "proto" → JSON như trước
+        proto = msg.get("proto", PROTO_JSON)
+        if proto not in SUPPORTED_PROTOS:
+            proto = PROTO_JSON
+        
+        # BƯỚC 2: ĐĂNG KÝ THÀNH CÔNG!
+        client = Client(name, reader, writer, binary=(proto == PROTO_BINARY))
+        client.start_writer()
+        self.clients[name] = client
+        self.state_changed("client", name, name)
+        LOGINS.inc()
+        log.info("client_connected", name=name, addr=addr, proto=proto)
+        
+        # Gửi snapshot danh sách người online cho người mới (kèm số thứ tự hiện tại)
+        # login_ok luôn là JSON; client nhị phân chuyển giao thức ngay sau tin này
+        client.session = self.new_session(name)
+        login_ok = {"type": "login_ok", "users": self.online_users(), "seq": self.presence_seq,
+                    "session": client.session}
+        if proto != PROTO_JSON:
+            login_ok["proto"] = proto
+        client.send_bytes(encode_message(login_ok))
+        # Thông báo cho tất cả người khác: có người vừa vào
+        self.presence_changed(name, True)
+        return client
+
+    async def serve_client(self, client: Client):
+        """
+        BƯỚC 3-4: Vòng lặp chính cho người chơi đã đăng ký, dọn dẹp khi disconnect
+        Dùng chung cho kết nối mới login và kết nối được chuyển từ shard khác (xem sharding.py)
+        """
+        client_name = client.name
+        writer = client.writer
+        migrated = False
+        dropped = False  # Rớt mạng (có thể resume), khác với tự thoát/bị ngắt vì vi phạm
+        cancelled = False  # Task bị hủy = server đang tắt (GUI stop, SIGTERM)
+        try:
             # BƯỚC 3: Vào vòng lặp chính - đợi lệnh từ client
-            await self.client_loop(self.clients[name])
+            await self.client_loop(client)
             
+        except ClientMigrated:
+            # Kết nối đã được chuyển sang tiến trình khác → không phải disconnect
+            migrated = True
         except asyncio.CancelledError:
-            print(f"[INFO] Client connection cancelled: {client_name}")
+            cancelled = True
+            log.info("client_cancelled", name=client_name)
+        except ConnectionClosed:
+            # Đóng đàng hoàng = tự thoát → xử thua ngay; trừ khi chính server ngắt vì im lặng quá lâu
+            dropped = client.evicted
+            log.info("connection_closed", name=client_name, evicted=client.evicted)
         except ConnectionError as e:
-            print(f"[INFO] Connection error for {client_name}: {e}")
+            # Reset / đứt giữa tin nhắn = rớt mạng → có thể resume
+            dropped = True
+            log.info("connection_error", name=client_name, error=str(e))
         except Exception as e:
-            print(f"[ERROR] Error handling client {client_name}: {e}")
+            log.exception("client_error", name=client_name, error=str(e))
         finally:
+            if migrated:
+                client.stop_writer()
+                self.stop_spectating(client)
+                self.matchmaking.leave(client_name)
+                if self.clients.get(client_name) is client:
+                    del self.clients[client_name]
+                    self.state_changed("client", client_name, None)
+                self.forget_session(client.session)
+                log.info("client_moved_out", name=client_name)
+            
+            # Server đang tắt: không xử thua trận đang đánh, để nguyên trong nhật ký cho lần start() sau
+            elif self.stopping or cancelled:
+                client.stop_writer()
+            
             # BƯỚC 4: Cleanup - dọn dẹp khi disconnect
-            if client_name and client_name in self.clients:
-                client = self.clients[client_name]
-                
-                # Nếu đang đánh giữa chừng thì đối thủ thắng luôn
-                if client.in_match:
-                    match = self.matches.get(client.in_match)
-                    if match:
-                        # Tắt đồng hồ đếm ngược
-                        if match.timer_task and not match.timer_task.done():
-                            match.timer_task.cancel()
-                            match.timer_task = None
-                        
-                        # Người còn lại tự động thắng
-                        opponent_name = self.opponent_of(match, client_name)
-                        print(f"[INFO] {client_name} disconnected during match, {opponent_name} wins")
-                        await self.finish_match(match, winner=opponent_name, reason="disconnect")
-                
-                # Xóa các lời mời đang chờ liên quan đến người này
-                keys_to_remove = [key for key in self.pending_invites.keys() if client_name in key]
-                for key in keys_to_remove:
-                    del self.pending_invites[key]
-                
-                # Xóa khỏi danh sách online
-                del self.clients[client_name]
-                print(f"[INFO] {client_name} disconnected")
+            # (client.writer đã khác writer → kết nối này vừa bị 1 lần resume thay thế, không dọn gì)
+            elif self.clients.get(client_name) is client and client.writer is writer:
+                match = self.matches.get(client.in_match) if client.in_match else None
+                if dropped and self.resume_grace and match and match.state == MATCH_PLAYING:
+                    # Rớt mạng giữa trận → giữ trận + đồng hồ, chờ resume trong resume_grace
+                    self.detach_client(client, match)
+                else:
+                    await self.drop_client(client)
             
-            # Đóng kết nối
+            # Đóng kết nối (nếu đã chuyển shard thì chỉ đóng fd của tiến trình này)
             try:
                 writer.close()
                 await writer.wait_closed()
             except:
                 pass
-            
-            # Cập nhật danh sách cho người khác
-            await self.broadcast_user_list()
 
-    async def broadcast_user_list(self):
+    async def drop_client(self, client: Client):
         """
-        Gửi danh sách người online cho TẤT CẢ mọi người
-        Như kiểu cập nhật bảng xếp hạng real-time
+        Dọn 1 người chơi khỏi server (thoát hẳn, hoặc hết hạn chờ resume)
+        Đang đánh giữa chừng thì đối thủ thắng luôn
+        """
+        client_name = client.name
+        self.session_timers.cancel(client)
+        client.detached = False
+        if client.in_match:
+            match = self.matches.get(client.in_match)
+            if match and match.state == MATCH_HIGHLIGHTING:
+                # Đã phân thắng thua, chỉ đang hiện line thắng → kết thúc luôn với kết quả đó
+                await self.finish_match(match, winner=match.winner, reason=match.end_reason)
+            elif match:
+                # Tắt đồng hồ đếm ngược
+                self.timers.cancel(match)
+                
+                # Người còn lại tự động thắng
+                opponent_name = self.opponent_of(match, client_name)
+                log.info("disconnected_in_match", name=client_name, match=match.id, winner=opponent_name)
+                await self.finish_match(match, winner=opponent_name, reason="disconnect")
+        
+        # Xóa các lời mời đang chờ liên quan đến người này
+        keys_to_remove = [key for key in self.pending_invites.keys() if client_name in key]
+        for key in keys_to_remove:
+            del self.pending_invites[key]
         
-        Tối ưu:
-        - Debounce: chỉ gửi 1 lần trong 100ms
-        - Chỉ gửi khi có thay đổi
-        - Gửi song song (gather) thay vì tuần tự
+        # Xóa khỏi danh sách online, dừng task gửi
+        self.stop_spectating(client)
+        self.matchmaking.leave(client_name)
+        client.stop_writer()
+        self.forget_session(client.session)
+        if self.clients.get(client_name) is client:
+            del self.clients[client_name]
+            self.state_changed("client", client_name, None)
+            self.release_name(client_name)
+            self.presence_changed(client_name, False)
+        log.info("client_disconnected", name=client_name)
+
+    # ---------- Resume phiên khi rớt mạng giữa trận ----------
+
+    def new_session(self, name: str) -> str:
+        """Cấp mã phiên mới (ngẫu nhiên, không đoán được) cho người chơi"""
+        token = secrets.token_urlsafe(16)
+        self.keep_session(token, name)
+        return token
+
+    def detach_client(self, client: Client, match: Match) -> None:
+        """
+        Người chơi rớt mạng giữa trận: vẫn giữ Client (tên, trận, đồng hồ lượt) nhưng không
+        còn socket - tin gửi tới bị bỏ qua. Hẹn hết hạn trên session_timers → không bao giờ
+        giữ mãi người không quay lại
         """
-        # Cancel broadcast task cũ nếu có
-        if self.broadcast_task and not self.broadcast_task.done():
-            self.broadcast_task.cancel()
+        client.stop_writer()
+        client.outbox.clear()
+        client.outbox_bytes = 0
+        client.detached = True
+        self.session_timers.schedule(client, self.session_timers.now() + self.resume_grace)
+        # Lời mời/hàng chờ/xem trận không chờ được → bỏ luôn như khi thoát
+        for key in [key for key in self.pending_invites if client.name in key]:
+            del self.pending_invites[key]
+        self.stop_spectating(client)
+        self.matchmaking.leave(client.name)
+        SESSIONS_DETACHED.inc()
+        log.info("session_detached", name=client.name, match=match.id, grace=self.resume_grace)
+        opp = self.clients.get(self.opponent_of(match, client.name))
+        if opp:
+            opp.send({"type": "opponent_disconnected", "grace": self.resume_grace})
+
+    async def on_session_expired(self, client: Client):
+        """session_timers gọi khi hết hạn chờ resume: dọn như disconnect thường (xử thua nếu còn trận)"""
+        if self.clients.get(client.name) is not client or not client.detached:
+            return
+        SESSIONS_EXPIRED.inc()
+        log.info("session_expired", name=client.name, match=client.in_match)
+        await self.drop_client(client)
+
+    async def resume_session(self, msg: Dict, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> Optional[Client]:
+        """
+        Gắn kết nối mới vào Client cũ theo mã phiên: giữ nguyên trận + đồng hồ, gửi lại trạng thái
+        Kết nối cũ còn mở (chưa ai phát hiện là chết) thì bị thay thế luôn
+        Mã phiên chỉ dùng được 1 lần - resume_ok mang mã mới
+        """
+        token = msg.get("session")
+        name = self.sessions.get(token) if isinstance(token, str) else None
+        client = self.clients.get(name) if name else None
+        if client is None or isinstance(client, BotClient):  # Không có/đã hết hạn, hoặc là bot
+            await send_json(writer, {"type": "error", "msg": "Session expired"})
+            writer.close()
+            await writer.wait_closed()
+            return None
+        
+        self.forget_session(token)
+        self.session_timers.cancel(client)
+        client.stop_writer()
+        client.outbox.clear()
+        client.outbox_bytes = 0
+        old_writer = client.writer
+        proto = msg.get("proto", PROTO_JSON)
+        if proto not in SUPPORTED_PROTOS:
+            proto = PROTO_JSON
+        client.reader, client.writer, client.binary = reader, writer, proto == PROTO_BINARY
+        client.detached = False
+        client.evicted = False
+        client.last_seen = time.monotonic()
+        client.pinged_at = 0.0
+        if old_writer is not None and not old_writer.is_closing():
+            old_writer.transport.abort()
+        client.start_writer()
+        client.session = self.new_session(name)
+        if client.in_match:
+            self.journal.session(client.in_match, name, client.session)
+        SESSIONS_RESUMED.inc()
+        log.info("session_resumed", name=name, match=client.in_match, proto=proto)
         
-        async def _do_broadcast():
+        resume_ok = {"type": "resume_ok", "users": self.online_users(), "seq": self.presence_seq,
+                     "session": client.session}
+        if proto != PROTO_JSON:
+            resume_ok["proto"] = proto
+        client.send_bytes(encode_message(resume_ok))
+        m = self.matches.get(client.in_match) if client.in_match else None
+        if m is not None and not m.is_finishing:
+            self.replay_match(client, m)
+        return client
+
+    def replay_match(self, client: Client, m: Match) -> None:
+        """
+        Gửi lại trạng thái trận gọn như spectate_snapshot (chỉ số ô theo thứ tự đi, X đi trước)
+        kèm số giây còn lại của lượt; đang đến lượt mình thì gửi lại your_turn
+        """
+        symbol = "X" if client.name == m.player_x else "O"
+        remaining = max(0.0, m.deadline - self.timers.now()) if m.deadline else THINK_TIME_SECONDS
+        client.send({
+            "type": "match_state",
+            "match": m.id,
+            "you": symbol,
+            "opponent": self.opponent_of(m, client.name),
+            "turn": m.turn,
+            "state": m.state,
+            "size": BOARD_SIZE,
+            "moves": [mv["y"] * BOARD_SIZE + mv["x"] for mv in m.moves],
+        })
+        opp = self.clients.get(self.opponent_of(m, client.name))
+        if opp:
+            opp.send({"type": "opponent_reconnected"})
+            if opp.detached:  # Đối thủ cũng đang chờ resume (vd. cả 2 vừa mất kết nối vì server khởi động lại)
+                client.send({"type": "opponent_disconnected",
+                             "grace": round(max(0.0, opp.deadline - self.session_timers.now()), 1)})
+        if m.state == MATCH_PLAYING and m.turn == symbol:
+            client.send({"type": "your_turn", "deadline": round(remaining, 1)})
+
+    # ---------- Khởi động lại: dựng các trận đánh dở từ nhật ký ----------
+
+    async def restore_matches(self):
+        """
+        Dựng lại các trận MatchJournal.open() tìm thấy (server trước dừng/chết giữa trận)
+        - Đi lại từng nước lên bàn cờ mới; nước cuối đã thắng/bàn đầy thì kết thúc luôn như thường
+        - Người chơi chưa kết nối lại: Client không có socket, ở trạng thái chờ resume với mã phiên
+          cũ trong nhật ký (cùng đường resume_session như rớt mạng); hết hạn thì xử thua như cũ
+        - Lượt đang dở: thời gian đã dùng tính đến sự kiện cuối nhật ký trước khi dừng (không tính
+          thời gian server tắt), còn lại ít nhất RESTORE_MIN_TURN
+        """
+        recovered, self.recovered = self.recovered, []
+        grace = self.resume_grace or RESUME_GRACE
+        for rm in recovered:
             try:
-                # Debounce: đợi 100ms để gộp nhiều thay đổi
-                await asyncio.sleep(BROADCAST_DEBOUNCE)
-                
-                users = list(self.clients.keys())
-                
-                # Chỉ gửi khi có thay đổi
-                if users == self.last_user_list:
-                    return
-                
-                self.last_user_list = users.copy()
-                
-                # Gửi song song cho tất cả client (nhanh hơn vòng for)
-                tasks = []
-                for c in self.clients.values():
-                    tasks.append(send_json(c.writer, {"type": "user_list", "users": users}))
-                
-                # Chờ tất cả gửi xong, bỏ qua lỗi
-                await asyncio.gather(*tasks, return_exceptions=True)
-                
-            except asyncio.CancelledError:
-                pass
+                await self.restore_match(rm, grace)
             except Exception as e:
-                print(f"[ERROR] Broadcast error: {e}")
+                log.exception("match_restore_failed", match=rm.id, error=str(e))
+                self.journal.match_finished(rm.id)
+
+    async def restore_match(self, rm: RecoveredMatch, grace: float):
+        m = Match(rm.id, rm.player_x, rm.player_o, started_at=rm.started_at)
+        last = None
+        for cell, ts in rm.moves:
+            x, y = cell % BOARD_SIZE, cell // BOARD_SIZE
+            if not (0 <= cell < BOARD_SIZE * BOARD_SIZE) or not m.board.is_empty(x, y):
+                raise ValueError(f"invalid move {cell}")
+            m.board.place(x, y, m.turn)
+            m.moves.append({"x": x, "y": y, "symbol": m.turn, "ts": int(ts)})
+            last = (x, y, m.turn)
+            m.turn = "O" if m.turn == "X" else "X"
+        self.matches[m.id] = m
+        
+        for name in (m.player_x, m.player_o):
+            c = self.clients.get(name)
+            if c is None and await self.claim_name(name):
+                c = self.clients[name] = Client(name, None, None, detached=True)
+                token = rm.sessions.get(name)
+                if token:
+                    c.session = token
+                    self.keep_session(token, name)
+                self.session_timers.schedule(c, self.session_timers.now() + grace)
+                self.state_changed("client", name, name)
+                self.presence_changed(name, True)
+            if c is not None and not c.in_match:
+                c.in_match = m.id
+        self.state_changed("match", m.id, self.match_row(m))
+        MATCHES_RESTORED.inc()
+        log.info("match_restored", match=m.id, x=m.player_x, o=m.player_o, moves=len(m.moves))
+        
+        # Trận đã phân thắng bại / hòa trước khi dừng (chưa kịp ghi finish) → kết thúc luôn
+        if last and m.board.check_win(*last):
+            return await self.finish_match(m, winner=m.player_x if last[2] == "X" else m.player_o, reason="win")
+        if m.board.is_full():
+            return await self.finish_match(m, winner=None, reason="draw")
         
-        self.broadcast_task = asyncio.create_task(_do_broadcast())
+        used = max(0.0, self.journal_last_ts - rm.turn_started)
+        remaining = min(THINK_TIME_SECONDS, max(RESTORE_MIN_TURN, THINK_TIME_SECONDS - used))
+        self.timers.schedule(m, self.timers.now() + remaining)
+        cur = self.clients.get(m.player_x if m.turn == "X" else m.player_o)
+        if cur and cur.in_match == m.id:
+            cur.send({"type": "your_turn", "deadline": round(remaining, 1)})  # Bot sẽ đi tiếp
+
+    # ---------- Các điểm mở rộng (sharding.py ghi đè) ----------
+
+    async def claim_name(self, name: str) -> bool:
+        """Giữ chỗ tên đăng nhập; False nếu tên đang được dùng"""
+        return name not in self.clients
+
+    def release_name(self, name: str) -> None:
+        """Trả lại tên khi người chơi thoát"""
+
+    def keep_session(self, token: str, name: str) -> None:
+        """Ghi nhận mã phiên của người chơi (cấp mới hoặc dựng lại từ nhật ký)"""
+        self.sessions[token] = name
+
+    def forget_session(self, token: Optional[str]) -> None:
+        """Mã phiên hết hiệu lực (đã dùng để resume, người chơi thoát hẳn...)"""
+        self.sessions.pop(token, None)
+
+    def online_users(self) -> List[str]:
+        """Danh sách tên người đang online (snapshot gửi kèm login_ok và user_list)"""
+        return list(self.clients.keys())
+
+    def new_match_id(self) -> str:
+        """Mã trận duy nhất: M + timestamp (ms), thêm hậu tố nếu trùng trong cùng 1 ms"""
+        base = f"M{int(time.time()*1000)}"
+        match_id, n = base, 1
+        while match_id in self.matches:
+            match_id = f"{base}-{n}"
+            n += 1
+        return match_id
+
+    def presence_changed(self, name: str, online: bool) -> None:
+        """
+        Ghi nhận 1 người vừa vào/ra - chưa gửi ngay mà gộp lại trong broadcast_user_list
+        Vào rồi ra trong cùng 1 lượt gộp thì triệt tiêu, không ai phải nhận gì
+        """
+        self.presence_pending[name] = online
+        if not self.broadcast_task or self.broadcast_task.done():
+            self.broadcast_task = asyncio.create_task(self.broadcast_user_list())
+
+    async def broadcast_user_list(self):
+        """
+        Gửi phần THAY ĐỔI của danh sách online cho TẤT CẢ mọi người
+        
+        Cải tiến: Không gửi lại cả danh sách (O(N) byte x N người) sau mỗi lần vào/ra
+        - Gộp thay đổi trong 100ms thành 1 tin user_delta {seq, joined, left}
+        - seq tăng 1 sau mỗi tin; client thấy nhảy số → gửi user_sync để lấy lại snapshot
+        - Mã hóa 1 lần cho mỗi giao thức, rồi xếp cùng bytes vào outbox của từng client
+        """
+        try:
+            # Debounce: đợi 100ms để gộp nhiều thay đổi (cửa sổ cố định, không bị đẩy lùi mãi)
+            await asyncio.sleep(BROADCAST_DEBOUNCE)
+            
+            pending, self.presence_pending = self.presence_pending, {}
+            joined = [n for n, online in pending.items() if online and n not in self.presence]
+            left = [n for n, online in pending.items() if not online and n in self.presence]
+            
+            # Chỉ gửi khi có thay đổi
+            if not joined and not left:
+                return
+            
+            for n in joined:
+                self.presence[n] = None
+            for n in left:
+                del self.presence[n]
+            self.presence_seq += 1
+            
+            msg = {"type": "user_delta", "seq": self.presence_seq, "joined": joined, "left": left}
+            encoded = {False: encode_message(msg, False), True: encode_message(msg, True)}
+            for c in self.clients.values():
+                c.send_bytes(encoded[c.binary])
+            
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.exception("broadcast_error", error=str(e))
+
+    def send_user_snapshot(self, client: Client) -> None:
+        """Gửi lại toàn bộ danh sách online (client yêu cầu user_sync khi thấy mất tin)"""
+        client.send({"type": "user_list", "users": self.online_users(), "seq": self.presence_seq})
 
     async def client_loop(self, client: Client):
         """
@@ -286,48 +893,100 @@ class CaroServer:
         Như receptionist nghe điện thoại và điều phối
         
         Bổ sung: Rate limiting để chống DoS attack
+        - Kiểm tra trên bytes thô, TRƯỚC khi giải mã JSON: tin vượt giới hạn bị bỏ
+          mà không tốn công parse, vòng lặp không bao giờ phải ngủ
+        - Vi phạm leo thang: bỏ lặng lẽ → báo lỗi 1 lần → ngắt kết nối (ratelimit.py)
         """
-        reader, writer = client.reader, client.writer
+        reader = client.reader
+        limiter = client.limiter
         
         while True:
-            msg = await recv_json(reader)
+            kind, payload = await recv_raw(reader, client.binary)
+            now = client.last_seen = time.monotonic()  # Nhận được bất cứ gì = còn sống
             
             # RATE LIMITING: Chống spam/DoS
-            now = time.time()
-            client.request_times.append(now)
-            
-            # Nếu gửi quá 20 request trong 2 giây → từ chối
-            if len(client.request_times) >= RATE_LIMIT_REQUESTS:
-                if now - client.request_times[0] < RATE_LIMIT_WINDOW:
-                    await send_json(writer, {
+            peeked = peek_type(kind, payload)
+            verdict = limiter.check(peeked, now)
+            if verdict == ALLOW:
+                msg = decode_frame(kind, payload)
+                t = msg.get("type")
+                if t != peeked:
+                    # Loại đoán từ bytes khác loại thật (cố tình lách giới hạn theo loại) → tính là vi phạm
+                    verdict = limiter.violation()
+            if verdict != ALLOW:
+                RATE_LIMITED.labels(verdict).inc()
+                if verdict == DISCONNECT:
+                    log.warning("rate_limit_disconnect", name=client.name, penalty=round(limiter.penalty, 1))
+                    return
+                if verdict == WARN:
+                    client.send({
                         "type": "error", 
                         "msg": "Rate limit exceeded. Please slow down."
                     })
-                    await asyncio.sleep(1.0)  # Phạt đợi 1 giây
-                    continue
+                continue
             
-            t = msg.get("type")
+            received, latency = HANDLER_METRICS.get(t if isinstance(t, str) else "unknown") or HANDLER_METRICS["unknown"]
+            received.inc()
+            t0 = time.perf_counter()
             
             # Xử lý từng loại lệnh
-            if t == "challenge":
-                # "Tôi muốn thách đấu người X"
-                await self.handle_challenge(client, msg.get("opponent"))
-            elif t == "accept":
-                # "Tôi chấp nhận lời thách đấu từ Y"
-                await self.handle_accept(client, msg.get("opponent"))
-            elif t == "move":
-                # "Tôi đánh vào ô (x, y)"
-                await self.handle_move(client, msg)
-            elif t == "chat":
-                # "Tôi muốn chat với đối thủ"
-                text = msg.get("text", "").strip()
-                if text and len(text) <= 500:  # Max 500 ký tự
-                    await self.relay_chat(client, text)
-            elif t == "timeout":
-                # Client tự báo: "Tôi hết giờ rồi"
-                await self.handle_client_timeout(client)
-            else:
-                await send_json(writer, {"type": "error", "msg": "unknown type"})
+            try:
+                if t == "challenge":
+                    # "Tôi muốn thách đấu người X"
+                    await self.handle_challenge(client, msg.get("opponent"))
+                elif t == "accept":
+                    # "Tôi chấp nhận lời thách đấu từ Y"
+                    await self.handle_accept(client, msg.get("opponent"))
+                elif t == "move":
+                    # "Tôi đánh vào ô (x, y)"
+                    await self.handle_move(client, msg)
+                elif t == "chat":
+                    # "Tôi muốn chat với đối thủ"
+                    text = msg.get("text", "").strip()
+                    if text and len(text) <= 500:  # Max 500 ký tự
+                        await self.relay_chat(client, text)
+                elif t == "timeout":
+                    # Client tự báo: "Tôi hết giờ rồi"
+                    await self.handle_client_timeout(client)
+                elif t == "user_sync":
+                    # Client thấy seq bị nhảy → gửi lại snapshot
+                    self.send_user_snapshot(client)
+                elif t == "spectate":
+                    # "Tôi muốn xem trận X" (hoặc trận người chơi Y đang đánh)
+                    self.handle_spectate(client, msg)
+                elif t == "unspectate":
+                    self.stop_spectating(client)
+                elif t == "history":
+                    # "Cho tôi xem lịch sử trận (lọc + phân trang)"
+                    await self.handle_history(client, msg)
+                elif t == "history_match":
+                    # "Cho tôi xem lại toàn bộ nước đi của trận X"
+                    await self.handle_history_match(client, msg.get("id"))
+                elif t == "queue_join":
+                    # "Tìm đối thủ ngang sức cho tôi"
+                    await self.handle_queue_join(client)
+                elif t == "queue_leave":
+                    if self.matchmaking.leave(client.name):
+                        client.send({"type": "queue_left"})
+                elif t == "position_stats":
+                    # "Thế cờ này (trận đang chơi/đang xem, hoặc dãy nước gửi kèm) thường kết thúc ra sao?"
+                    self.handle_position_stats(client, msg)
+                elif t == "ping":
+                    client.send({"type": "pong"})
+                elif t == "pong":
+                    pass  # Trả lời ping của idle_reaper - last_seen đã được cập nhật ở trên
+                elif t == "leaderboard":
+                    # "Cho tôi xem bảng xếp hạng"
+                    self.handle_leaderboard(client, msg)
+                elif t == "stats":
+                    # "Cho tôi xem thành tích của tôi (hoặc của người chơi Y)"
+                    player = msg.get("player")
+                    client.send({"type": "stats",
+                                 "player": self.ratings.stats(player if isinstance(player, str) else client.name)})
+                else:
+                    client.send({"type": "error", "msg": "unknown type"})
+            finally:
+                latency.observe(time.perf_counter() - t0)
 
     async def handle_challenge(self, client: Client, opponent: str | None):
         """
@@ -336,32 +995,32 @@ class CaroServer:
         """
         # Validate: đối thủ có tồn tại không?
         if not opponent or opponent not in self.clients:
-            return await send_json(client.writer, {"type": "error", "msg": "Opponent not found"})
+            return client.send({"type": "error", "msg": "Opponent not found"})
         
         # Không tự thách bản thân
         if opponent == client.name:
-            return await send_json(client.writer, {"type": "error", "msg": "Cannot challenge yourself"})
+            return client.send({"type": "error", "msg": "Cannot challenge yourself"})
         
         # Bạn đang đấu rồi
         if client.in_match:
-            return await send_json(client.writer, {"type": "error", "msg": "You are already in a match"})
+            return client.send({"type": "error", "msg": "You are already in a match"})
         
         # Đối thủ đang đấu với người khác
         if self.clients[opponent].in_match:
-            return await send_json(client.writer, {"type": "error", "msg": "Opponent is already in a match"})
+            return client.send({"type": "error", "msg": "Opponent is already in a match"})
         
         # Đã gửi lời mời rồi
         if (client.name, opponent) in self.pending_invites:
-            return await send_json(client.writer, {"type": "error", "msg": "Challenge already sent"})
+            return client.send({"type": "error", "msg": "Challenge already sent"})
         
         # OK! Lưu lời mời vào hàng đợi
         self.pending_invites[(client.name, opponent)] = True
-        print(f"[INFO] {client.name} challenged {opponent}")
+        log.info("challenge", **{"from": client.name, "to": opponent})
         
         # Gửi thông báo cho đối thủ: "X muốn thách bạn"
-        await send_json(self.clients[opponent].writer, {"type": "invite", "from": client.name})
+        self.clients[opponent].send({"type": "invite", "from": client.name})
         # Thông báo lại cho người gửi: "Đã gửi lời mời"
-        await send_json(client.writer, {"type": "challenge_sent", "to": opponent})
+        client.send({"type": "challenge_sent", "to": opponent})
 
     async def handle_accept(self, client: Client, opponent: str | None):
         """
@@ -369,52 +1028,186 @@ class CaroServer:
         """
         # Kiểm tra có lời mời nào không
         if not opponent or (opponent, client.name) not in self.pending_invites:
-            return await send_json(client.writer, {"type": "error", "msg": "No invite found"})
+            return client.send({"type": "error", "msg": "No invite found"})
         
         # Người thách còn online không?
         if opponent not in self.clients:
-            return await send_json(client.writer, {"type": "error", "msg": "Challenger is offline"})
+            return client.send({"type": "error", "msg": "Challenger is offline"})
         
         # Cả 2 đều đang rảnh chứ?
         if client.in_match or self.clients[opponent].in_match:
-            return await send_json(client.writer, {"type": "error", "msg": "Someone is already in a match"})
+            return client.send({"type": "error", "msg": "Someone is already in a match"})
         
         # Xóa lời mời khỏi hàng đợi
         del self.pending_invites[(opponent, client.name)]
         
-        # TẠO TRẬN ĐẤU MỚI!
-        match_id = f"M{int(time.time()*1000)}"  # ID duy nhất
-        player_x = opponent  # Người thách cầm X
-        player_o = client.name  # Người chấp nhận cầm O
+        # Người thách cầm X, người chấp nhận cầm O
+        await self.start_match(player_x=opponent, player_o=client.name)
+
+    # ---------- Ghép trận tự động (matchmaking.py) ----------
+
+    async def handle_queue_join(self, client: Client):
+        """
+        Vào hàng chờ ghép trận: có người ngang Elo đang chờ thì vào trận luôn,
+        không thì chờ; task quét sẽ nới dần ngưỡng chênh lệch theo thời gian chờ
+        """
+        if client.in_match:
+            return client.send({"type": "error", "msg": "You are already in a match"})
+        if client.name in self.matchmaking:
+            return client.send({"type": "queue_joined", "waiting": len(self.matchmaking)})
+        
+        pair = self.matchmaking.join(client.name, self.ratings.rating_of(client.name), self.timers.now())
+        if pair is None:
+            client.send({"type": "queue_joined", "waiting": len(self.matchmaking)})
+            if not self.matchmaking_task or self.matchmaking_task.done():
+                self.matchmaking_task = asyncio.create_task(self.matchmaking_loop())
+            return
+        await self.start_queued_match(*pair)
+
+    async def idle_reaper(self):
+        """
+        1 task duy nhất quét mọi kết nối mỗi idle_sweep giây (thay vì mỗi client 1 task/timeout)
+        - Im lặng quá ping_after → gửi ping (1 lần mỗi đợt im lặng), client còn sống sẽ trả pong
+        - Im lặng quá idle_timeout → abort socket: client_loop nhận ConnectionError và đi đúng
+          đường disconnect cũ trong serve_client (xử thua trận đang đánh, trả tên, báo mọi người)
+        """
+        try:
+            while True:
+                await asyncio.sleep(self.idle_sweep)
+                now = time.monotonic()
+                ping_before = now - self.ping_after if self.ping_after else None
+                evict_before = now - self.idle_timeout
+                for client in list(self.clients.values()):
+                    if client.writer is None or client.writer.is_closing():
+                        continue  # Bot (không có socket) hoặc đang đóng
+                    if client.last_seen < evict_before:
+                        log.info("idle_evicted", name=client.name, idle=round(now - client.last_seen, 1))
+                        IDLE_EVICTIONS.inc()
+                        client.evicted = True
+                        client.writer.transport.abort()
+                    elif ping_before is not None and client.last_seen < ping_before \
+                            and client.pinged_at < client.last_seen:
+                        client.pinged_at = now
+                        PINGS_SENT.inc()
+                        client.send({"type": "ping"})
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.exception("idle_reaper_error", error=str(e))
+
+    async def matchmaking_loop(self):
+        """Quét hàng chờ mỗi SWEEP_INTERVAL cho đến khi không còn ai chờ"""
+        try:
+            while len(self.matchmaking):
+                await asyncio.sleep(SWEEP_INTERVAL)
+                for first, second in self.matchmaking.sweep(self.timers.now()):
+                    await self.start_queued_match(first, second)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.exception("matchmaking_error", error=str(e))
+
+    async def start_queued_match(self, first, second):
+        """Mở trận cho 1 cặp hàng chờ vừa ghép (người chờ lâu hơn cầm X) qua start_match như thường"""
+        a, b = self.clients.get(first.name), self.clients.get(second.name)
+        if not a or not b or a.in_match or b.in_match:
+            # Hiếm: 1 người vừa rời đi/vào trận khác → người còn lại quay lại hàng
+            for entry, c in ((first, a), (second, b)):
+                if c and not c.in_match:
+                    pair = self.matchmaking.join(entry.name, entry.rating, entry.joined_at)
+                    if pair:
+                        await self.start_queued_match(*pair)
+            return
+        now = self.timers.now()
+        QUEUE_PAIRED.inc()
+        QUEUE_WAIT_SECONDS.observe(now - first.joined_at)
+        QUEUE_WAIT_SECONDS.observe(now - second.joined_at)
+        log.info("queue_paired", x=first.name, o=second.name,
+                 rating_x=round(first.rating), rating_o=round(second.rating))
+        await self.start_match(player_x=first.name, player_o=second.name)
+
+    # ---------- Bot (ai.py) ----------
+
+    async def bot_move(self, bot: BotClient):
+        """
+        Đến lượt bot: tìm nước trong process pool (event loop không bị chặn), rồi đi qua
+        handle_move như người chơi thật. Trận đã đổi trong lúc bot nghĩ thì bỏ kết quả
+        """
+        m = self.matches.get(bot.in_match)
+        if m is None or m.state != MATCH_PLAYING:
+            return
+        symbol = "X" if bot.name == m.player_x else "O"
+        if m.turn != symbol:
+            return
+        moves = len(m.moves)
+        if self.ai_pool is None:
+            # spawn: tiến trình con không kế thừa thread/socket của server
+            self.ai_pool = ProcessPoolExecutor(AI_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        t0 = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.ai_pool, search_move, m.board.size, m.board.x_bits, m.board.o_bits, symbol,
+                min(AI_THINK_SECONDS, THINK_TIME_SECONDS / 2))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception("bot_search_failed", name=bot.name, match=m.id, error=str(e))
+            return
+        AI_SEARCH_SECONDS.observe(time.perf_counter() - t0)
+        if self.matches.get(m.id) is not m or m.state != MATCH_PLAYING or len(m.moves) != moves:
+            return
+        log.info("bot_move", name=bot.name, match=m.id, x=result["x"], y=result["y"], depth=result["depth"],
+                 nodes=result["nodes"], ms=result["ms"], reason=result["reason"])
+        await self.handle_move(bot, {"type": "move", "x": result["x"], "y": result["y"]})
+
+    async def start_match(self, player_x: str, player_o: str) -> Match:
+        """
+        TẠO TRẬN ĐẤU MỚI giữa 2 người chơi đang rảnh (đã kiểm tra từ trước)
+        """
+        match_id = self.new_match_id()
         m = Match(match_id, player_x, player_o)
         self.matches[match_id] = m
+        self.state_changed("match", match_id, self.match_row(m))
         
         # Đánh dấu cả 2 đang trong trận
         self.clients[player_x].in_match = match_id
         self.clients[player_o].in_match = match_id
+        # Đang xem trận khác / đang chờ ghép thì thôi
+        self.stop_spectating(self.clients[player_x])
+        self.stop_spectating(self.clients[player_o])
+        self.matchmaking.leave(player_x)
+        self.matchmaking.leave(player_o)
         
-        print(f"[INFO] Match started: {match_id} - {player_x} vs {player_o}")
+        MATCHES_STARTED.inc()
+        log.info("match_started", match=match_id, x=player_x, o=player_o)
+        # Ghi nhật ký (kèm mã phiên để resume được cả sau khi server khởi động lại)
+        self.journal.match_started(match_id, player_x, player_o, m.started_at)
+        for name in (player_x, player_o):
+            if self.clients[name].session:
+                self.journal.session(match_id, name, self.clients[name].session)
         
         # Thông báo cho cả 2: "Trận đấu bắt đầu!"
-        await send_json(self.clients[player_x].writer, {
+        self.clients[player_x].send({
             "type": "match_start", "you": "X", "opponent": player_o, "size": BOARD_SIZE
         })
-        await send_json(self.clients[player_o].writer, {
+        self.clients[player_o].send({
             "type": "match_start", "you": "O", "opponent": player_x, "size": BOARD_SIZE
         })
         
         # Khởi động đồng hồ đếm ngược cho X (đi trước)
         await self.start_turn_timer(m)
+        return m
 
     async def start_turn_timer(self, m: Match):
         """
         Bật đồng hồ đếm ngược cho lượt hiện tại
         Hết giờ -> tự động thua
+
+        Cải tiến: Không tạo task mới mỗi lượt nữa - chỉ đặt trận vào 1 ô của
+        bánh xe hẹn giờ (O(1)), task quay bánh xe sẽ gọi on_match_timer
         """
         # Hủy timer cũ nếu có (phòng trường hợp bug)
-        if m.timer_task and not m.timer_task.done():
-            m.timer_task.cancel()
-            m.timer_task = None
+        self.timers.cancel(m)
         
         # Tìm người đang đến lượt
         cur_name = m.player_x if m.turn == "X" else m.player_o
@@ -422,48 +1215,36 @@ class CaroServer:
         if not cur_client:
             return
         
-        # Tính deadline = giờ hiện tại + 30 giây
-        m.deadline = time.time() + THINK_TIME_SECONDS
-        
         # Thông báo: "Đến lượt bạn, hết giờ lúc..."
         try:
-            await send_json(cur_client.writer, {
+            cur_client.send({
                 "type": "your_turn",
                 "deadline": THINK_TIME_SECONDS
             })
         except Exception as e:
-            print(f"[ERROR] Failed to send your_turn to {cur_name}: {e}")
+            log.error("your_turn_send_failed", name=cur_name, error=str(e))
             return
         
-        # Tạo task đếm ngược
-        async def timer_task():
-            try:
-                await asyncio.sleep(THINK_TIME_SECONDS)  # Đợi 30 giây
-                
-                # Kiểm tra trận còn tồn tại không
-                if m.id not in self.matches:
-                    return
-                
-                current_match = self.matches[m.id]
-                
-                # Kiểm tra đúng người, đúng lượt (tránh race condition)
-                if (current_match.deadline and 
-                    abs(current_match.deadline - m.deadline) < 0.1 and
-                    current_match.turn == m.turn and
-                    not current_match.is_finishing):
-                    
-                    # HẾT GIỜ! Đối thủ thắng
-                    print(f"[INFO] Timeout: {m.turn} in match {m.id}")
-                    winner = m.player_o if m.turn == "X" else m.player_x
-                    await self.finish_match(current_match, winner=winner, reason="timeout")
-                    
-            except asyncio.CancelledError:
-                pass  # Timer bị hủy - bình thường thôi
-            except Exception as e:
-                print(f"[ERROR] Timer task error: {e}")
+        # Hẹn giờ: deadline = giờ hiện tại + 30 giây
+        self.timers.schedule(m, self.timers.now() + THINK_TIME_SECONDS)
+
+    async def on_match_timer(self, m: Match):
+        """
+        Bánh xe hẹn giờ gọi khi hẹn giờ của trận m tới hạn:
+        - đang hiện line thắng → hết HIGHLIGHT_DELAY, kết thúc trận với kết quả đã chốt
+        - đang đánh → lượt hiện tại hết giờ
+        """
+        # Trận phải còn tồn tại và chưa kết thúc (tránh race condition)
+        if self.matches.get(m.id) is not m or m.is_finishing:
+            return
+        if m.state == MATCH_HIGHLIGHTING:
+            await self.finish_match(m, winner=m.winner, reason=m.end_reason)
+            return
         
-        # Lưu task để có thể hủy sau
-        m.timer_task = asyncio.create_task(timer_task())
+        # HẾT GIỜ! Đối thủ thắng
+        log.info("turn_timeout", match=m.id, symbol=m.turn)
+        winner = m.player_o if m.turn == "X" else m.player_x
+        await self.finish_match(m, winner=winner, reason="timeout")
 
     def opponent_of(self, m: Match, name: str) -> str:
         """Helper: Tìm đối thủ của name trong trận m"""
@@ -479,14 +1260,18 @@ class CaroServer:
         # Kiểm tra đang trong trận không
         match_id = client.in_match
         if not match_id or match_id not in self.matches:
-            return await send_json(client.writer, {"type": "error", "msg": "Not in a match"})
+            return client.send({"type": "error", "msg": "Not in a match"})
         
         m = self.matches[match_id]
         symbol = "X" if client.name == m.player_x else "O"
         
+        # Đã có người thắng (đang hiện line thắng) thì không đánh tiếp
+        if m.state != MATCH_PLAYING:
+            return client.send({"type": "error", "msg": "Match is over"})
+        
         # Đến lượt bạn chưa?
         if symbol != m.turn:
-            return await send_json(client.writer, {"type": "error", "msg": "Not your turn"})
+            return client.send({"type": "error", "msg": "Not your turn"})
         
         # VALIDATE INPUT NGHIÊM NGẶT (chống malicious client)
         try:
@@ -495,58 +1280,67 @@ class CaroServer:
             if not (0 <= x < BOARD_SIZE and 0 <= y < BOARD_SIZE):
                 raise ValueError("Out of range")
         except (TypeError, ValueError) as e:
-            return await send_json(client.writer, {
+            return client.send({
                 "type": "error", 
                 "msg": f"Invalid coordinates: {e}"
             })
         
         # Ô đó trống không?
-        if m.board[y][x] != ".":
-            return await send_json(client.writer, {"type": "error", "msg": "Cell occupied"})
+        if not m.board.is_empty(x, y):
+            return client.send({"type": "error", "msg": "Cell occupied"})
         
         # HỦY TIMER - đã đi rồi!
-        if m.timer_task and not m.timer_task.done():
-            m.timer_task.cancel()
-            m.timer_task = None
+        self.timers.cancel(m)
         
-        # CẬP NHẬT BÀN CỜ
-        m.board[y][x] = symbol
-        m.moves.append({"x": x, "y": y, "symbol": symbol, "ts": int(time.time())})
+        # CẬP NHẬT BÀN CỜ (+ nhật ký, fsync theo batch ở thread riêng)
+        now = time.time()
+        m.board.place(x, y, symbol)
+        m.moves.append({"x": x, "y": y, "symbol": symbol, "ts": int(now)})
         m.deadline = None
+        self.journal.move(m.id, y * BOARD_SIZE + x, now)
         
-        print(f"[INFO] Move: {client.name} ({symbol}) -> ({x}, {y})")
+        log.info("move", match=m.id, player=client.name, symbol=symbol, x=x, y=y)
         
         # Gửi xác nhận cho người đánh
-        await send_json(client.writer, {"type": "move_ok", "x": x, "y": y, "symbol": symbol})
+        client.send({"type": "move_ok", "x": x, "y": y, "symbol": symbol})
+        if m.watchers or m.spectators:
+            self.publish(m, {"type": "move", "x": x, "y": y, "symbol": symbol})
         
         # Thông báo cho đối thủ
         opp = self.clients.get(self.opponent_of(m, client.name))
         if opp:
-            await send_json(opp.writer, {"type": "opponent_move", "x": x, "y": y, "symbol": symbol})
+            opp.send({"type": "opponent_move", "x": x, "y": y, "symbol": symbol})
         
-        # KIỂM TRA THẮNG
-        win_cells = find_win_line(m.board, x, y, symbol)
-        if win_cells:
+        # KIỂM TRA THẮNG (bitboard: vài phép dịch bit, chỉ dò đường thắng khi đã thắng)
+        if m.board.check_win(x, y, symbol):
+            win_cells = m.board.win_line(x, y, symbol)
             # Highlight line thắng cho cả 2 người
             for player_name in [m.player_x, m.player_o]:
                 c = self.clients.get(player_name)
                 if c:
-                    await send_json(c.writer, {
+                    c.send({
                         "type": "highlight",
                         "cells": win_cells,
                         "winner": client.name
                     })
+            if m.watchers or m.spectators:
+                self.publish(m, {"type": "highlight", "cells": win_cells, "winner": client.name})
             
-            # Đợi 3 giây cho họ ngắm
-            await asyncio.sleep(HIGHLIGHT_DELAY)
-            return await self.finish_match(m, winner=client.name, reason="win")
+            # Cho họ ngắm 3 giây: chỉ hẹn giờ trên bánh xe rồi trả lại vòng lặp của client ngay,
+            # on_match_timer sẽ gửi match_end + lưu lịch sử
+            m.state = MATCH_HIGHLIGHTING
+            m.winner, m.end_reason = client.name, "win"
+            self.state_changed("match", m.id, self.match_row(m))
+            self.timers.schedule(m, self.timers.now() + HIGHLIGHT_DELAY)
+            return
         
-        # KIỂM TRA HÒA (bàn cờ đầy)
-        if all(cell != "." for row in m.board for cell in row):
+        # KIỂM TRA HÒA (bàn cờ đầy) - O(1) nhờ bộ đếm quân
+        if m.board.is_full():
             return await self.finish_match(m, winner=None, reason="draw")
         
         # CHUYỂN LƯỢT
         m.turn = "O" if m.turn == "X" else "X"
+        self.state_changed("match", m.id, self.match_row(m))
         await self.start_turn_timer(m)
 
     async def handle_client_timeout(self, client: Client):
@@ -558,10 +1352,10 @@ class CaroServer:
         m = self.matches[match_id]
         symbol = "X" if client.name == m.player_x else "O"
         
-        if symbol == m.turn and not m.is_finishing:
+        if symbol == m.turn and m.state == MATCH_PLAYING:
             # Đúng là lượt của họ -> đối thủ thắng
             opponent_name = self.opponent_of(m, client.name)
-            print(f"[INFO] {client.name} self-reported timeout")
+            log.info("self_reported_timeout", match=m.id, name=client.name)
             await self.finish_match(m, winner=opponent_name, reason="timeout")
 
     async def finish_match(self, m: Match, winner: Optional[str], reason: str):
@@ -569,19 +1363,22 @@ class CaroServer:
         KẾT THÚC TRẬN ĐẤU
         Gửi thông báo -> Lưu database -> Dọn dẹp
         
-        Cải tiến: Dùng flag is_finishing để tránh race condition
+        Cải tiến: Dùng state (MATCH_FINISHED) để tránh race condition
         """
         # CRITICAL: Tránh race condition - chỉ cho phép finish 1 lần
         if m.is_finishing:
             return
-        m.is_finishing = True
+        m.state = MATCH_FINISHED
+        m.winner, m.end_reason = winner, reason
+        t0 = time.perf_counter()
+        MATCHES_FINISHED.labels(reason).inc()
         
-        # Tắt timer
-        if m.timer_task and not m.timer_task.done():
-            m.timer_task.cancel()
-            m.timer_task = None
+        # Tắt timer, trận không cần dựng lại nữa
+        self.timers.cancel(m)
+        self.journal.match_finished(m.id)
         
-        print(f"[INFO] Match finished: {m.id} - Winner: {winner or 'draw'} ({reason})")
+        log.info("match_finished", match=m.id, winner=winner or "draw", reason=reason, moves=len(m.moves),
+                 position=f"{m.board.zobrist:016x}")
         
         # Gửi kết quả cho cả 2 người
         for name in [m.player_x, m.player_o]:
@@ -592,7 +1389,7 @@ class CaroServer:
             try:
                 if winner is None:
                     # HÒA
-                    await send_json(c.writer, {
+                    c.send({
                         "type": "match_end",
                         "result": "draw",
                         "reason": reason,
@@ -601,56 +1398,329 @@ class CaroServer:
                 else:
                     # THẮNG hoặc THUA
                     if name == winner:
-                        await send_json(c.writer, {
+                        c.send({
                             "type": "match_end",
                             "result": "win",
                             "reason": reason,
                             "winner": "you"
                         })
                     else:
-                        await send_json(c.writer, {
+                        c.send({
                             "type": "match_end",
                             "result": "lose",
                             "reason": reason,
                             "winner": "opponent"
                         })
             except Exception as e:
-                print(f"[ERROR] Failed to send match_end to {name}: {e}")
+                log.error("match_end_send_failed", name=name, error=str(e))
             
             # Đánh dấu không còn trong trận
             c.in_match = None
         
-        # Lưu vào database (thread-safe)
+        # Báo cho người xem rồi hủy đăng ký
+        if m.watchers or m.spectators:
+            self.publish(m, {"type": "match_end", "winner": winner, "reason": reason})
+            m.watchers.clear()
+            for c in m.spectators.values():
+                c.spectating = None
+            m.spectators.clear()
+        
+        # Lưu vào database (đẩy vào hàng đợi, thread nền sẽ ghi) rồi cập nhật Elo
         self.save_history(m, winner)
+        try:
+            self.ratings.record(m.player_x, m.player_o, winner)
+        except Exception as e:
+            log.error("ratings_update_failed", match=m.id, error=str(e))
         
         # Xóa trận khỏi bộ nhớ
         if m.id in self.matches:
             del self.matches[m.id]
+            self.state_changed("match", m.id, None)
+        FINISH_SECONDS.observe(time.perf_counter() - t0)
 
     def save_history(self, m: Match, winner: Optional[str]):
         """
         Lưu lịch sử trận đấu vào SQLite
         
-        Cải tiến: Dùng lock để đảm bảo thread-safe
+        Cải tiến: Không ghi trực tiếp trên event loop nữa - chỉ đẩy bản ghi
+        vào hàng đợi của HistoryWriter, thread nền sẽ gom batch và commit
+        Nước đi lưu dạng nhị phân gọn (common.encode_moves), ~3 byte/nước thay vì ~40 byte JSON
         """
         try:
-            with self.db_lock:  # Thread-safe database access
-                self.db.execute(
-                    "INSERT OR REPLACE INTO matches (id, player_x, player_o, winner, started_at, finished_at, moves) VALUES (?,?,?,?,?,?,?)",
-                    (
-                        m.id,
-                        m.player_x,
-                        m.player_o,
-                        winner or "draw",
-                        datetime.fromtimestamp(m.started_at).isoformat(timespec="seconds"),
-                        datetime.now().isoformat(timespec="seconds"),
-                        json.dumps(m.moves, ensure_ascii=False),
-                    ),
-                )
-                self.db.commit()
-            print(f"[INFO] Match saved: {m.id}")
+            self.history.save_match((
+                m.id,
+                m.player_x,
+                m.player_o,
+                winner or "draw",
+                datetime.fromtimestamp(m.started_at).isoformat(timespec="seconds"),
+                datetime.now().isoformat(timespec="seconds"),
+                encode_moves(m.moves),
+            ))
+            log.debug("match_queued", match=m.id)
         except Exception as e:
-            print(f"[ERROR] Failed to save match history: {e}")
+            HISTORY_SAVE_ERRORS.inc()
+            log.error("history_enqueue_failed", match=m.id, error=str(e))
+
+    async def handle_history(self, client: Client, msg: Dict):
+        """
+        Tra lịch sử: {"type": "history", "player", "winner", "since", "until", "cursor", "limit"}
+        Trả về history_page {matches, next}; gửi lại next làm cursor để lấy trang sau
+        """
+        filters = {k: msg[k] for k in ("player", "winner", "since", "until", "cursor", "limit") if k in msg}
+        try:
+            page = await self.history_reader.find_matches(**filters)
+        except ValueError as e:
+            client.send({"type": "error", "msg": f"Invalid history query: {e}"})
+            return
+        except Exception as e:
+            log.error("history_query_failed", name=client.name, error=str(e))
+            client.send({"type": "error", "msg": "History unavailable"})
+            return
+        client.send({"type": "history_page", **page})
+
+    async def handle_history_match(self, client: Client, match_id: str | None):
+        """Trả về 1 trận đã lưu kèm danh sách nước đi"""
+        if not isinstance(match_id, str):
+            client.send({"type": "error", "msg": "Match not found"})
+            return
+        try:
+            match = await self.history_reader.get_match(match_id)
+        except Exception as e:
+            log.error("history_query_failed", name=client.name, error=str(e))
+            client.send({"type": "error", "msg": "History unavailable"})
+            return
+        if match is None:
+            client.send({"type": "error", "msg": "Match not found"})
+            return
+        client.send({"type": "history_match", "match": match})
+
+    def handle_leaderboard(self, client: Client, msg: Dict):
+        """Bảng xếp hạng từ cache trong bộ nhớ: {"type": "leaderboard", "limit", "offset"}"""
+        limit = msg.get("limit", 10)
+        offset = msg.get("offset", 0)
+        if not all(isinstance(v, int) and not isinstance(v, bool) for v in (limit, offset)):
+            client.send({"type": "error", "msg": "Invalid leaderboard query"})
+            return
+        limit = max(1, min(limit, LEADERBOARD_MAX))
+        offset = max(0, offset)
+        client.send({"type": "leaderboard", "offset": offset,
+                     "players": self.ratings.leaderboard(limit, offset)})
+
+    def handle_position_stats(self, client: Client, msg: Dict):
+        """
+        Tra sổ khai cuộc: {"type": "position_stats", "moves": [ô, ...]} (ô = y * BOARD_SIZE + x,
+        X đi trước như spectate_snapshot) hoặc {"match": id}; không gửi gì thì lấy trận đang
+        chơi/đang xem. Thế cờ đối xứng (xoay/lật) dùng chung 1 dòng thống kê
+        """
+        if self.book is None:
+            client.send({"type": "error", "msg": "Opening book unavailable"})
+            return
+        moves = msg.get("moves")
+        if moves is not None:
+            n = BOARD_SIZE * BOARD_SIZE
+            if (not isinstance(moves, list) or len(moves) > n or len(set(moves)) != len(moves)
+                    or not all(type(c) is int and 0 <= c < n for c in moves)):
+                client.send({"type": "error", "msg": "Invalid moves"})
+                return
+            position = canonical_hashes(BOARD_SIZE, bytes(moves))[-1] if moves else 0
+        else:
+            match_id = msg.get("match") or client.in_match or client.spectating
+            m = self.matches.get(match_id) if isinstance(match_id, str) else None
+            if m is None:
+                client.send({"type": "error", "msg": "Match not found"})
+                return
+            position = canonical_hash(m.board)
+        client.send({"type": "position_stats", **self.book.stats(position)})
+
+    # ---------- Luồng trạng thái cho bảng điều khiển (gui_server.py) ----------
+
+    @staticmethod
+    def match_row(m: Match) -> Tuple[str, str, str, str, str]:
+        """Dòng bất biến mô tả 1 trận: (id, player_x, player_o, turn, state)"""
+        return (m.id, m.player_x, m.player_o, m.turn, m.state)
+
+    def subscribe_state(self, callback: Callable[[Dict], None]) -> None:
+        """
+        Đăng ký nhận trạng thái server: callback nhận ngay 1 state_snapshot, sau đó chỉ
+        nhận state_changes (đã gộp theo STATE_FEED_INTERVAL, đánh số seq liên tục)
+        - Phải gọi trên thread của event loop (từ thread khác: loop.call_soon_threadsafe)
+        - callback chạy trên event loop nên phải thật nhẹ, ví dụ queue.Queue.put
+        - Dữ liệu gửi đi là bản sao (dict mới + tuple), bên nhận đọc thoải mái ở thread khác
+        """
+        # Đẩy nốt thay đổi đang chờ cho người đăng ký cũ → snapshot dưới đây khớp với seq hiện tại
+        self.flush_state_changes()
+        callback({
+            "type": "state_snapshot",
+            "seq": self.state_seq,
+            "clients": {name: name for name in self.clients},
+            "matches": {mid: self.match_row(m) for mid, m in self.matches.items()},
+        })
+        self.state_subscribers.append(callback)
+
+    def unsubscribe_state(self, callback: Callable[[Dict], None]) -> None:
+        if callback in self.state_subscribers:
+            self.state_subscribers.remove(callback)
+
+    def state_changed(self, kind: str, key: str, row: Any) -> None:
+        """
+        Ghi nhận 1 dòng clients/matches vừa đổi (row=None: đã xóa)
+        Không ai đăng ký thì không tốn gì; nhiều lần đổi cùng 1 dòng trong 1 lượt gộp chỉ giữ bản cuối
+        """
+        if not self.state_subscribers:
+            return
+        self.state_pending[(kind, key)] = row
+        if self.state_flush is None:
+            self.state_flush = asyncio.get_running_loop().call_later(STATE_FEED_INTERVAL,
+                                                                     self.flush_state_changes)
+
+    def flush_state_changes(self) -> None:
+        """Gửi gói thay đổi đang chờ (nếu có) cho mọi người đăng ký"""
+        if self.state_flush is not None:
+            self.state_flush.cancel()
+            self.state_flush = None
+        if not self.state_pending:
+            return
+        pending, self.state_pending = self.state_pending, {}
+        self.state_seq += 1
+        event = {
+            "type": "state_changes",
+            "seq": self.state_seq,
+            "changes": tuple((kind, key, row) for (kind, key), row in pending.items()),
+        }
+        for callback in list(self.state_subscribers):
+            try:
+                callback(event)
+            except Exception as e:
+                log.warning("state_subscriber_failed", error=str(e))
+                self.state_subscribers.remove(callback)
+
+    # ---------- Người xem trận (MatchViewer trên GUI server) ----------
+
+    def watch_match(self, match_id: str, callback: Callable[[Dict], None]) -> bool:
+        """
+        Đăng ký xem trận: callback nhận ngay 1 snapshot, sau đó chỉ nhận sự kiện thay đổi
+        (move / highlight / match_end) do handle_move và finish_match phát ra
+        - Phải gọi trên thread của event loop (từ thread khác: loop.call_soon_threadsafe)
+        - callback chạy trên event loop nên phải thật nhẹ, ví dụ queue.Queue.put
+        - Trận không tồn tại → callback nhận match_end và trả về False
+        """
+        m = self.matches.get(match_id)
+        if m is None or m.is_finishing:
+            callback({"type": "match_end", "winner": None, "reason": "not_found"})
+            return False
+        last = m.moves[-1] if m.moves else None
+        callback({
+            "type": "snapshot",
+            "id": m.id,
+            "player_x": m.player_x,
+            "player_o": m.player_o,
+            "turn": m.turn,
+            "cells": [(mv["x"], mv["y"], mv["symbol"]) for mv in m.moves],
+            "last_move": (last["x"], last["y"]) if last else None,
+        })
+        m.watchers.append(callback)
+        return True
+
+    def unwatch_match(self, match_id: str, callback: Callable[[Dict], None]) -> None:
+        """Hủy đăng ký xem trận (trận đã kết thúc thì thôi)"""
+        m = self.matches.get(match_id)
+        if m is not None and callback in m.watchers:
+            m.watchers.remove(callback)
+
+    def publish(self, m: Match, event: Dict) -> None:
+        """Phát 1 sự kiện của trận m cho mọi người xem (trong tiến trình + qua mạng)"""
+        for callback in list(m.watchers):
+            try:
+                callback(event)
+            except Exception as e:
+                log.warning("watcher_failed", match=m.id, error=str(e))
+                m.watchers.remove(callback)
+        if m.spectators:
+            self.fan_out(m, event)
+
+    # ---------- Người xem trận qua mạng (tin nhắn spectate) ----------
+
+    def handle_spectate(self, client: Client, msg: Dict) -> None:
+        """
+        Đăng ký xem trận: {"type": "spectate", "match": id} hoặc {"type": "spectate", "player": tên}
+        Trả ngay 1 snapshot gọn, sau đó nhận spectate_move / spectate_highlight / spectate_match_end
+        Chỉ xem được trận của tiến trình này (chạy sharding thì là trận trên cùng shard)
+        """
+        if client.in_match:
+            client.send({"type": "error", "msg": "You are in a match"})
+            return
+        match_id = msg.get("match")
+        player = msg.get("player")
+        if match_id is None and isinstance(player, str) and player in self.clients:
+            match_id = self.clients[player].in_match
+        m = self.matches.get(match_id) if isinstance(match_id, str) else None
+        if m is None or m.is_finishing:
+            client.send({"type": "error", "msg": "Match not found"})
+            return
+        if client.spectating == m.id:
+            client.send(self.spectate_snapshot(m))
+            return
+        if len(m.spectators) >= MAX_SPECTATORS:
+            client.send({"type": "error", "msg": "Too many spectators"})
+            return
+        
+        self.stop_spectating(client)
+        m.spectators[client.name] = client
+        client.spectating = m.id
+        client.spectate_stale = False
+        client.send(self.spectate_snapshot(m))
+
+    def stop_spectating(self, client: Client) -> None:
+        """Thôi xem trận (không xem thì thôi)"""
+        if client.spectating is None:
+            return
+        m = self.matches.get(client.spectating)
+        if m is not None and m.spectators.get(client.name) is client:
+            del m.spectators[client.name]
+        client.spectating = None
+        client.spectate_stale = False
+
+    @staticmethod
+    def spectate_snapshot(m: Match) -> Dict:
+        """
+        Snapshot gọn của trận: moves là chỉ số ô (y * BOARD_SIZE + x) theo thứ tự đi,
+        X luôn đi trước và 2 bên luân phiên nên quân thứ i là X nếu i chẵn
+        """
+        return {
+            "type": "spectate_snapshot",
+            "match": m.id,
+            "player_x": m.player_x,
+            "player_o": m.player_o,
+            "turn": m.turn,
+            "state": m.state,
+            "size": BOARD_SIZE,
+            "moves": [mv["y"] * BOARD_SIZE + mv["x"] for mv in m.moves],
+        }
+
+    def fan_out(self, m: Match, event: Dict) -> None:
+        """
+        Gửi 1 sự kiện cho mọi người xem: mã hóa 1 lần mỗi giao thức, cùng bytes cho tất cả
+        - Người xem đọc chậm (dồn quá SPECTATOR_LAG_BYTES) bị bỏ qua sự kiện; khi đã đọc kịp
+          thì nhận 1 snapshot thay cho các nước đã lỡ → không bao giờ làm chậm người chơi
+        - Tin kết thúc trận luôn được gửi (người xem quá chậm đã bị send_bytes ngắt kết nối)
+        """
+        msg = dict(event, type="spectate_" + event["type"], match=m.id)
+        final = event["type"] == "match_end"
+        encoded: Dict[bool, bytes] = {}
+        for c in list(m.spectators.values()):
+            if not final:
+                if c.backlog() > SPECTATOR_LAG_BYTES:
+                    c.spectate_stale = True
+                    SPECTATOR_SKIPPED.inc()
+                    continue
+                if c.spectate_stale:
+                    c.spectate_stale = False
+                    c.send(self.spectate_snapshot(m))
+                    continue
+            data = encoded.get(c.binary)
+            if data is None:
+                data = encoded[c.binary] = encode_message(msg, c.binary)
+            c.send_bytes(data)
 
     async def relay_chat(self, client: Client, text: str):
         """Chuyển tin nhắn chat từ A sang B"""
@@ -662,47 +1732,100 @@ class CaroServer:
         opp = self.clients.get(self.opponent_of(m, client.name))
         if opp:
             try:
-                await send_json(opp.writer, {"type": "chat", "from": client.name, "text": text})
+                opp.send({"type": "chat", "from": client.name, "text": text})
             except Exception as e:
-                print(f"[ERROR] Failed to relay chat: {e}")
+                log.error("chat_relay_failed", name=client.name, error=str(e))
 
     async def stop(self):
         """
         Ngừng server, ngắt kết nối tất cả client và dọn dẹp trạng thái.
         Đây là phương thức async, sẽ được gọi từ thread chính của GUI.
         """
-        print("[INFO] Shutting down server and forcing client disconnects...")
+        log.info("server_stopping")
+        self.stopping = True
         
-        # 1. Đóng server listener (ngừng chấp nhận client mới)
+        # 1. Đóng server listener (ngừng chấp nhận client mới) và endpoint metrics
         if self.server:
             self.server.close()
             await self.server.wait_closed()
             self.server = None
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
 
-        # 2. Đóng tất cả client connections
+        # 2. Trận đang hiện line thắng đã có kết quả → kết thúc luôn (gửi match_end + lưu lịch sử)
+        #    Trận đang đánh thì để nguyên trong nhật ký → lần start() sau dựng lại
+        for m in list(self.matches.values()):
+            if m.state == MATCH_HIGHLIGHTING:
+                await self.finish_match(m, winner=m.winner, reason=m.end_reason)
+
+        # 3. Gửi nốt outbox (match_end vừa xếp ở bước 2 chưa kịp qua task gửi) rồi mới đóng
+        #    tất cả client connections; client đọc chậm không được giữ server quá STOP_FLUSH_TIMEOUT
+        flushes = [asyncio.ensure_future(c.flush_outbox()) for c in list(self.clients.values())
+                   if c.writer and not c.writer.is_closing()]
+        if flushes:
+            done, pending = await asyncio.wait(flushes, timeout=STOP_FLUSH_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() is not None:  # Client đã mất kết nối - không còn gì để gửi
+                    log.info("stop_flush_failed", error=str(task.exception()))
         tasks = []
         # Dùng list() để duyệt an toàn vì self.clients có thể bị thay đổi nếu client tự disconnect
         for name, client in list(self.clients.items()): 
+            client.stop_writer()
             if client.writer and not client.writer.is_closing():
                 try:
                     client.writer.close()
                     tasks.append(client.writer.wait_closed())
                 except Exception as e:
-                    print(f"[WARN] Error closing writer for {name}: {e}")
+                    log.warning("writer_close_failed", name=name, error=str(e))
         
         # Chờ tất cả writer đóng (bỏ qua lỗi)
         if tasks:
             await asyncio.gather(*tasks, return_exceptions=True)
             
-        # 3. Dọn dẹp trạng thái
+        # 4. Dọn dẹp trạng thái (dừng luôn bánh xe hẹn giờ)
+        self.timers.stop()
+        self.session_timers.stop()
+        self.sessions.clear()
         self.clients.clear()
+        self.presence.clear()
+        self.presence_pending.clear()
         self.matches.clear()
+        if self.state_flush is not None:
+            self.state_flush.cancel()
+            self.state_flush = None
+        self.state_pending.clear()
+        self.state_subscribers.clear()
         self.pending_invites.clear()
+        if self.matchmaking_task and not self.matchmaking_task.done():
+            self.matchmaking_task.cancel()
+        if self.reaper_task and not self.reaper_task.done():
+            self.reaper_task.cancel()
+            self.reaper_task = None
+        self.matchmaking = MatchQueue()
+        if self.ai_pool is not None:
+            self.ai_pool.shutdown(wait=False, cancel_futures=True)
+            self.ai_pool = None
+        
+        # 5. Ghi nốt lịch sử còn trong hàng đợi (chạy ở executor để không chặn loop)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.history.stop)
+        await loop.run_in_executor(None, self.journal.stop)
+        await loop.run_in_executor(None, self.history_reader.close)
+        if self.book is not None:
+            self.book.close()
+            self.book = None
         
-        print("[INFO] Server fully stopped. All clients disconnected.")
+        log.info("server_stopped")
         
 if __name__ == "__main__":
+    server = CaroServer()
     try:
-        asyncio.run(CaroServer().start())
+        asyncio.run(server.start())
     except KeyboardInterrupt:
-        print("\n[INFO] Server shutting down...")
+        log.info("server_shutdown")
+    finally:
+        server.history.stop()
+        server.journal.stop()
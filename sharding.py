@@ -0,0 +1,666 @@
+"""
+Chế độ chạy nhiều tiến trình (sharding) cho CaroServer - chỉ hỗ trợ Linux/Unix.
+
+Kiến trúc:
+- N tiến trình worker (ShardServer) cùng nghe 1 port TCP (SO_REUSEPORT) → kernel
+  chia đều kết nối mới. Mỗi worker sở hữu riêng các client và trận đấu của nó.
+- 1 tiến trình điều phối (Coordinator) giữ danh bạ toàn cục: ai đang online,
+  ở worker nào, ai đang trong trận. Worker nói chuyện với điều phối qua Unix socket
+  (JSON mỗi dòng, giống giao thức client).
+- challenge/invite giữa 2 worker được điều phối chuyển tiếp. Khi người được mời
+  accept, kết nối TCP của họ được chuyển hẳn sang worker của người thách
+  (gửi file descriptor qua Unix socket) → cả trận đấu chạy trong 1 tiến trình,
+  nước đi không phải đi qua IPC.
+- Mã phiên (resume) chỉ worker cấp ra mới dùng được; kết nối resume rơi vào worker
+  khác thì hỏi điều phối xem mã thuộc worker nào rồi chuyển kết nối sang đó.
+
+Chạy: python sharding.py --workers 4 --port 7777
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from common import send_json, recv_json, encode_message
+from journal import journal_path_for
+from logs import configure_logging, get_logger
+from metrics import METRICS_PORT
+from server import BROADCAST_DEBOUNCE, IDLE_TIMEOUT, PING_AFTER, CaroServer, Client, ClientMigrated, Match
+
+# ============================================
+# CÁC HẰNG SỐ
+# ============================================
+COORDINATOR_SOCK = "coordinator.sock"   # Unix socket của tiến trình điều phối
+HANDOFF_SOCK = "shard-{}.sock"          # Unix socket nhận kết nối chuyển đến của mỗi worker
+IPC_TIMEOUT = 5.0                       # Đợi điều phối trả lời tối đa 5 giây
+HANDOFF_TIMEOUT = 5.0                   # Chuyển 1 kết nối tối đa 5 giây
+
+log = get_logger("sharding")
+
+
+# ============================================
+# TIẾN TRÌNH ĐIỀU PHỐI
+# ============================================
+
+class Coordinator:
+    """
+    Danh bạ toàn cục + định tuyến challenge/accept giữa các worker
+    - directory: tên người chơi → id worker đang giữ kết nối
+    - busy: những ai đang trong trận (để từ chối lời thách từ worker khác)
+    - sessions: mã phiên → id worker đã cấp (để chuyển kết nối resume về đúng worker)
+    - Worker nhận danh bạ đầy đủ 1 lần lúc đăng ký, sau đó chỉ nhận phần thay đổi
+    """
+
+    def __init__(self, run_dir: str):
+        self.path = os.path.join(run_dir, COORDINATOR_SOCK)
+        self.shards: Dict[int, asyncio.StreamWriter] = {}
+        self.handoff_paths: Dict[int, str] = {}
+        self.directory: Dict[str, int] = {}
+        self.busy: Set[str] = set()
+        self.sessions: Dict[str, int] = {}
+        self.pushed: Set[str] = set()                  # Danh bạ mà các worker đã biết
+        self.pending: Dict[str, bool] = {}             # Thay đổi chưa đẩy: tên → online?
+        self.users_push: Optional[asyncio.TimerHandle] = None
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle_shard, self.path)
+        log.info("coordinator_listening", path=self.path)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def handle_shard(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """1 kết nối = 1 worker. Worker chết → xóa hết người chơi của nó khỏi danh bạ"""
+        shard_id = None
+        try:
+            hello = await recv_json(reader)
+            shard_id = int(hello["shard"])
+            self.shards[shard_id] = writer
+            self.handoff_paths[shard_id] = hello["handoff"]
+            log.info("shard_registered", shard=shard_id)
+            self.send(shard_id, {"op": "users", "users": list(self.directory)})
+
+            while True:
+                msg = await recv_json(reader)
+                reply = self.dispatch(shard_id, msg)
+                if reply is not None:
+                    reply["op"] = "reply"
+                    reply["req"] = msg.get("req")
+                    self.send(shard_id, reply)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            log.exception("coordinator_error", shard=shard_id, error=str(e))
+        finally:
+            if shard_id is not None and self.shards.get(shard_id) is writer:
+                del self.shards[shard_id]
+                self.handoff_paths.pop(shard_id, None)
+                for name in [n for n, s in self.directory.items() if s == shard_id]:
+                    del self.directory[name]
+                    self.busy.discard(name)
+                    self.user_changed(name, False)
+                for token in [t for t, s in self.sessions.items() if s == shard_id]:
+                    del self.sessions[token]
+                log.info("shard_disconnected", shard=shard_id)
+            writer.close()
+
+    def send(self, shard_id: int, obj: Dict) -> None:
+        writer = self.shards.get(shard_id)
+        if writer and not writer.is_closing():
+            writer.write(encode_message(obj))
+
+    def dispatch(self, shard_id: int, msg: Dict) -> Optional[Dict]:
+        """Xử lý 1 lệnh từ worker; trả về dict nếu lệnh cần trả lời"""
+        op = msg.get("op")
+        if op == "claim":
+            # Giữ chỗ tên trên toàn cụm (thay cho kiểm tra `name in self.clients`)
+            name = msg["name"]
+            if name in self.directory:
+                return {"ok": False}
+            self.directory[name] = shard_id
+            self.user_changed(name, True)
+            return {"ok": True}
+
+        if op == "release":
+            name = msg["name"]
+            if self.directory.get(name) == shard_id:
+                del self.directory[name]
+                self.busy.discard(name)
+                self.user_changed(name, False)
+            return None
+
+        if op == "moved":
+            # Kết nối đã được worker `shard_id` nhận
+            self.directory[msg["name"]] = shard_id
+            return None
+
+        if op == "busy":
+            for name in msg["names"]:
+                if msg["busy"]:
+                    self.busy.add(name)
+                else:
+                    self.busy.discard(name)
+            return None
+
+        if op == "session":
+            self.sessions[msg["session"]] = shard_id
+            return None
+
+        if op == "session_end":
+            if self.sessions.get(msg["session"]) == shard_id:
+                del self.sessions[msg["session"]]
+            return None
+
+        if op == "resume":
+            # Kết nối resume rơi vào worker khác worker đã cấp mã → chỉ đường tới worker đó
+            owner = self.sessions.get(msg["session"])
+            if owner is None or owner == shard_id or owner not in self.handoff_paths:
+                return {"ok": False, "error": "Session expired"}
+            return {"ok": True, "shard": owner, "handoff": self.handoff_paths[owner]}
+
+        if op == "challenge":
+            target = msg["to"]
+            if target not in self.directory:
+                return {"ok": False, "error": "Opponent not found"}
+            if target in self.busy:
+                return {"ok": False, "error": "Opponent is already in a match"}
+            self.send(self.directory[target], {"op": "invite", "from": msg["from"], "to": target})
+            return {"ok": True}
+
+        if op == "accept":
+            challenger = msg["to"]
+            if challenger not in self.directory:
+                return {"ok": False, "error": "Challenger is offline"}
+            if challenger in self.busy or msg["from"] in self.busy:
+                return {"ok": False, "error": "Someone is already in a match"}
+            target_shard = self.directory[challenger]
+            return {"ok": True, "shard": target_shard, "handoff": self.handoff_paths[target_shard]}
+
+        return {"ok": False, "error": f"unknown op {op}"}
+
+    def user_changed(self, name: str, online: bool) -> None:
+        """Debounce giống CaroServer.presence_changed: gộp các thay đổi trong BROADCAST_DEBOUNCE"""
+        self.pending[name] = online
+        if self.users_push is None:
+            loop = asyncio.get_running_loop()
+            self.users_push = loop.call_later(BROADCAST_DEBOUNCE, self._push_users)
+
+    def _push_users(self) -> None:
+        self.users_push = None
+        pending, self.pending = self.pending, {}
+        joined = [n for n, online in pending.items() if online and n not in self.pushed]
+        left = [n for n, online in pending.items() if not online and n in self.pushed]
+        if not joined and not left:
+            return
+        self.pushed.update(joined)
+        self.pushed.difference_update(left)
+        msg = {"op": "presence", "joined": joined, "left": left}
+        for shard_id in list(self.shards):
+            self.send(shard_id, msg)
+
+
+# ============================================
+# CHUYỂN KẾT NỐI GIỮA CÁC WORKER (blocking, chạy trong executor)
+# ============================================
+
+def _send_handoff(path: str, header: bytes, fd: int) -> None:
+    """Gửi fd của socket client + thông tin phiên sang worker khác, đợi bên kia xác nhận"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(HANDOFF_TIMEOUT)
+        s.connect(path)
+        socket.send_fds(s, [b"F"], [fd])
+        s.sendall(header)
+        if s.recv(1) != b"1":
+            raise ConnectionError("Handoff không được xác nhận")
+
+
+def _recv_handoff(conn: socket.socket) -> Tuple[Dict, int]:
+    """Nhận fd + thông tin phiên (1 dòng JSON), trả lời xác nhận"""
+    conn.setblocking(True)
+    conn.settimeout(HANDOFF_TIMEOUT)
+    _, fds, _, _ = socket.recv_fds(conn, 1, 1)
+    if not fds:
+        raise ConnectionError("Handoff không kèm file descriptor")
+    try:
+        with conn.makefile("rb") as f:
+            info = json.loads(f.readline().decode("utf-8"))
+        conn.sendall(b"1")
+    except Exception:
+        os.close(fds[0])
+        raise
+    return info, fds[0]
+
+
+# ============================================
+# TIẾN TRÌNH WORKER
+# ============================================
+
+class ShardServer(CaroServer):
+    """
+    CaroServer chạy như 1 shard: tên đăng nhập, danh sách online và lời thách
+    giữa các shard đi qua Coordinator; còn lại dùng nguyên logic của CaroServer
+    """
+
+    def __init__(self, shard_id: int, run_dir: str, host="0.0.0.0", port=7777, db_path="game_history.db"):
+        # Mỗi shard 1 file nhật ký riêng (chỉ 1 tiến trình ghi mỗi file)
+        super().__init__(host, port, db_path, journal_path=journal_path_for(db_path, shard_id))
+        self.shard_id = shard_id
+        self.reuse_port = True
+        # Bot không có socket để chuyển sang shard của người thách → không chạy bot khi chia shard
+        self.bot_names = ()
+        self.coordinator_path = os.path.join(run_dir, COORDINATOR_SOCK)
+        self.handoff_path = os.path.join(run_dir, HANDOFF_SOCK.format(shard_id))
+        self.global_users: Dict[str, None] = {}  # Danh bạ toàn cụm (theo thứ tự vào)
+        self.coord_reader: Optional[asyncio.StreamReader] = None
+        self.coord_writer: Optional[asyncio.StreamWriter] = None
+        self.requests: Dict[int, asyncio.Future] = {}
+        self.request_seq = 0
+        self.background: Set[asyncio.Task] = set()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+
+        # 1. Kết nối tới điều phối
+        self.coord_reader, self.coord_writer = await asyncio.open_unix_connection(self.coordinator_path)
+        await send_json(self.coord_writer, {"op": "hello", "shard": self.shard_id, "handoff": self.handoff_path})
+        self._spawn(self.coordinator_loop())
+
+        # 2. Mở Unix socket nhận kết nối chuyển đến
+        if os.path.exists(self.handoff_path):
+            os.unlink(self.handoff_path)
+        handoff = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        handoff.bind(self.handoff_path)
+        handoff.listen(128)
+        handoff.setblocking(False)
+        self._spawn(self.handoff_loop(loop, handoff))
+
+        # 3. Nghe port TCP chung với các worker khác
+        log.info("shard_starting", shard=self.shard_id, pid=os.getpid())
+        await super().start()
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+        return task
+
+    # ---------- IPC với điều phối ----------
+
+    async def request(self, op: str, **fields) -> Dict:
+        """Gửi lệnh cần trả lời tới điều phối"""
+        self.request_seq += 1
+        req = self.request_seq
+        fut = asyncio.get_running_loop().create_future()
+        self.requests[req] = fut
+        self.notify(op, req=req, **fields)
+        try:
+            return await asyncio.wait_for(fut, IPC_TIMEOUT)
+        except asyncio.TimeoutError:
+            return {"ok": False, "error": "Coordinator timeout"}
+        finally:
+            self.requests.pop(req, None)
+
+    def notify(self, op: str, **fields) -> None:
+        """Gửi lệnh 1 chiều tới điều phối"""
+        if self.coord_writer and not self.coord_writer.is_closing():
+            self.coord_writer.write(encode_message({"op": op, **fields}))
+
+    async def coordinator_loop(self):
+        try:
+            while True:
+                msg = await recv_json(self.coord_reader)
+                op = msg.get("op")
+                if op == "reply":
+                    fut = self.requests.get(msg.get("req"))
+                    if fut and not fut.done():
+                        fut.set_result(msg)
+                elif op == "invite":
+                    self.deliver_invite(msg["from"], msg["to"])
+                elif op == "users":
+                    # Snapshot lúc đăng ký với điều phối
+                    self.global_users = dict.fromkeys(msg["users"])
+                    self.presence = dict.fromkeys(msg["users"])
+                elif op == "presence":
+                    self.apply_presence(msg["joined"], msg["left"])
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            log.exception("coordinator_link_error", shard=self.shard_id, error=str(e))
+        log.error("coordinator_lost", shard=self.shard_id)
+        if self.server:
+            self.server.close()
+
+    # ---------- Ghi đè các điểm mở rộng của CaroServer ----------
+
+    async def claim_name(self, name: str) -> bool:
+        if name in self.clients:
+            return False
+        reply = await self.request("claim", name=name)
+        return bool(reply.get("ok"))
+
+    def release_name(self, name: str) -> None:
+        self.notify("release", name=name)
+
+    def keep_session(self, token: str, name: str) -> None:
+        super().keep_session(token, name)
+        self.notify("session", session=token)
+
+    def forget_session(self, token: Optional[str]) -> None:
+        if token in self.sessions:
+            self.notify("session_end", session=token)
+        super().forget_session(token)
+
+    async def resume_session(self, msg: Dict, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> Optional[Client]:
+        """Mã phiên do worker khác cấp (kernel chia kết nối ngẫu nhiên) → chuyển kết nối về worker đó"""
+        token = msg.get("session")
+        if not isinstance(token, str) or token in self.sessions:
+            return await super().resume_session(msg, reader, writer)
+        reply = await self.request("resume", session=token)
+        if not reply.get("ok"):
+            return await super().resume_session(msg, reader, writer)
+        writer.transport.pause_reading()
+        try:
+            await self.hand_off(reader, writer, reply["handoff"], {"resume": msg})
+        except Exception as e:
+            log.error("resume_forward_failed", shard=reply.get("shard"), error=str(e))
+            writer.transport.resume_reading()
+            return await super().resume_session(msg, reader, writer)
+        log.info("resume_forwarded", shard=reply["shard"])
+        writer.close()  # Chỉ đóng fd của tiến trình này, worker kia đã giữ kết nối
+        return None
+
+    def online_users(self) -> List[str]:
+        users = list(self.global_users)
+        users.extend(n for n in self.clients if n not in self.global_users)
+        return users
+
+    def presence_changed(self, name: str, online: bool) -> None:
+        """
+        Trong shard, vào/ra chỉ tính theo danh bạ của điều phối (apply_presence):
+        người thoát ở shard này rồi login lại ngay ở shard khác không bị báo nhầm là đã thoát
+        """
+
+    def apply_presence(self, joined: List[str], left: List[str]) -> None:
+        """Thay đổi danh bạ toàn cụm từ điều phối → cập nhật và báo cho client của shard này"""
+        for name in joined:
+            self.global_users[name] = None
+            super().presence_changed(name, True)
+        for name in left:
+            self.global_users.pop(name, None)
+            super().presence_changed(name, False)
+            # Bỏ lời mời của những người đã thoát ở shard khác
+            for key in [k for k in self.pending_invites if name in k]:
+                del self.pending_invites[key]
+
+    def new_match_id(self) -> str:
+        """Thêm số shard vào mã trận để không trùng giữa các tiến trình"""
+        base = f"M{int(time.time()*1000)}s{self.shard_id}"
+        match_id, n = base, 1
+        while match_id in self.matches:
+            match_id = f"{base}-{n}"
+            n += 1
+        return match_id
+
+    async def start_match(self, player_x: str, player_o: str) -> Match:
+        self.notify("busy", names=[player_x, player_o], busy=True)
+        return await super().start_match(player_x, player_o)
+
+    async def finish_match(self, m: Match, winner: Optional[str], reason: str):
+        first = not m.is_finishing
+        await super().finish_match(m, winner, reason)
+        if first:
+            self.notify("busy", names=[m.player_x, m.player_o], busy=False)
+
+    async def handle_challenge(self, client: Client, opponent: str | None):
+        # Đối thủ cùng shard (hoặc không hợp lệ) → logic cũ
+        if not opponent or opponent in self.clients or opponent == client.name:
+            return await super().handle_challenge(client, opponent)
+
+        if client.in_match:
+            return client.send({"type": "error", "msg": "You are already in a match"})
+        if (client.name, opponent) in self.pending_invites:
+            return client.send({"type": "error", "msg": "Challenge already sent"})
+
+        reply = await self.request("challenge", **{"from": client.name, "to": opponent})
+        if not reply.get("ok"):
+            return client.send({"type": "error", "msg": reply.get("error", "Challenge failed")})
+
+        # Ghi lại lời mời ở cả shard này: khi B được chuyển sang đây, handle_accept cũ dùng được luôn
+        self.pending_invites[(client.name, opponent)] = True
+        log.info("challenge", remote=True, **{"from": client.name, "to": opponent})
+        client.send({"type": "challenge_sent", "to": opponent})
+
+    def deliver_invite(self, challenger: str, target: str) -> None:
+        """Lời mời từ shard khác chuyển tới người chơi ở shard này"""
+        c = self.clients.get(target)
+        if not c:
+            return
+        self.pending_invites[(challenger, target)] = True
+        c.send({"type": "invite", "from": challenger})
+
+    async def handle_accept(self, client: Client, opponent: str | None):
+        # Người thách ở cùng shard (hoặc không có lời mời) → logic cũ
+        if not opponent or opponent in self.clients or (opponent, client.name) not in self.pending_invites:
+            return await super().handle_accept(client, opponent)
+
+        if client.in_match:
+            return client.send({"type": "error", "msg": "Someone is already in a match"})
+
+        reply = await self.request("accept", **{"from": client.name, "to": opponent})
+        if not reply.get("ok"):
+            return client.send({"type": "error", "msg": reply.get("error", "Accept failed")})
+
+        del self.pending_invites[(opponent, client.name)]
+        try:
+            await self.migrate(client, reply["handoff"], accept=opponent)
+        except Exception as e:
+            # Chuyển thất bại → giữ người chơi ở lại shard này
+            log.error("migrate_failed", name=client.name, shard=reply.get("shard"), error=str(e))
+            client.writer.transport.resume_reading()
+            client.start_writer()
+            return client.send({"type": "error", "msg": "Could not start match, please retry"})
+
+        # Thoát client_loop mà không xử lý như disconnect
+        raise ClientMigrated()
+
+    # ---------- Chuyển kết nối ----------
+
+    async def migrate(self, client: Client, handoff_path: str, accept: Optional[str] = None):
+        """
+        Chuyển kết nối TCP của client sang shard khác
+        1. Ngừng đọc socket, gửi nốt outbox
+        2. Gửi fd + tên + giao thức + những byte đã đọc mà chưa xử lý sang shard đích
+        3. Shard đích tiếp tục phiên như thể client vừa login ở đó
+        """
+        client.writer.transport.pause_reading()
+        # Người chơi không đọc socket nữa → drain treo mãi; quá hạn thì coi như chuyển thất bại
+        await asyncio.wait_for(client.flush_outbox(), HANDOFF_TIMEOUT)
+        await self.hand_off(client.reader, client.writer, handoff_path,
+                            {"name": client.name, "binary": client.binary, "accept": accept})
+
+    async def hand_off(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                       handoff_path: str, info: Dict) -> None:
+        """
+        Gửi fd của kết nối (đã pause_reading) + info + những byte đã đọc mà chưa xử lý sang shard khác
+        Raise TimeoutError nếu quá HANDOFF_TIMEOUT mà bên kia vẫn chưa đọc hết dữ liệu đang gửi
+        """
+        # Phải gửi hết bộ đệm ghi trước khi trao fd (không thì byte còn trong transport bị mất)
+        deadline = time.monotonic() + HANDOFF_TIMEOUT
+        while writer.transport.get_write_buffer_size():
+            if time.monotonic() >= deadline:
+                raise TimeoutError("Client không đọc dữ liệu, không chuyển kết nối được")
+            await asyncio.sleep(0.001)
+        # StreamReader không có API công khai để lấy dữ liệu đã đệm - CPython đổi thì báo lỗi rõ ràng
+        buffered = getattr(reader, "_buffer", None)
+        if buffered is None:
+            raise RuntimeError("StreamReader không có _buffer, không lấy được dữ liệu đã đệm")
+        buffered = bytes(buffered)
+        header = json.dumps({**info, "buffered": buffered.hex()}).encode("utf-8") + b"\n"
+        fd = writer.get_extra_info("socket").fileno()
+        await asyncio.get_running_loop().run_in_executor(None, _send_handoff, handoff_path, header, fd)
+
+    async def handoff_loop(self, loop: asyncio.AbstractEventLoop, listener: socket.socket):
+        try:
+            while True:
+                conn, _ = await loop.sock_accept(listener)
+                self._spawn(self.adopt(loop, conn))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            listener.close()
+
+    async def adopt(self, loop: asyncio.AbstractEventLoop, conn: socket.socket):
+        """Nhận 1 kết nối chuyển đến từ shard khác"""
+        try:
+            info, fd = await loop.run_in_executor(None, _recv_handoff, conn)
+        except Exception as e:
+            log.error("handoff_receive_failed", error=str(e))
+            return
+        finally:
+            conn.close()
+
+        # Nạp dữ liệu đã đệm TRƯỚC khi transport bắt đầu đọc socket → giữ đúng thứ tự byte
+        sock = socket.socket(fileno=fd)
+        reader = asyncio.StreamReader()
+        if info.get("buffered"):
+            reader.feed_data(bytes.fromhex(info["buffered"]))
+        protocol = asyncio.StreamReaderProtocol(reader)
+        transport, _ = await loop.create_connection(lambda: protocol, sock=sock)
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+
+        if info.get("resume"):
+            # Kết nối resume do worker khác chuyển về: mã phiên là của shard này
+            client = await self.resume_session(info["resume"], reader, writer)
+            if client:
+                await self.serve_client(client)
+            return
+
+        name = info["name"]
+        client = Client(name, reader, writer, binary=bool(info.get("binary")))
+        client.start_writer()
+        self.clients[name] = client
+        self.state_changed("client", name, name)
+        self.notify("moved", name=name)
+        log.info("client_moved_in", name=name)
+        # Số thứ tự danh sách online ở shard này khác shard cũ → gửi snapshot mới
+        self.send_user_snapshot(client)
+        # Mã phiên của shard cũ không dùng được ở đây → cấp mã mới
+        client.session = self.new_session(name)
+        client.send({"type": "session", "session": client.session})
+
+        if info.get("accept"):
+            try:
+                await self.handle_accept(client, info["accept"])
+            except Exception as e:
+                log.exception("adopt_accept_failed", name=name, error=str(e))
+        await self.serve_client(client)
+
+
+# ============================================
+# LAUNCHER
+# ============================================
+
+async def _serve_until_terminated(coro):
+    """Chạy server, SIGTERM → hủy task để các khối finally được chạy (ghi nốt lịch sử)"""
+    task = asyncio.ensure_future(coro)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def run_coordinator(run_dir: str) -> None:
+    configure_logging()
+    try:
+        asyncio.run(_serve_until_terminated(Coordinator(run_dir).start()))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_shard(shard_id: int, run_dir: str, host: str, port: int, db_path: str,
+              metrics_port: Optional[int] = None, idle_timeout: Optional[float] = IDLE_TIMEOUT,
+              ping_after: Optional[float] = PING_AFTER) -> None:
+    server = ShardServer(shard_id, run_dir, host, port, db_path)
+    server.metrics_port = metrics_port
+    server.idle_timeout = idle_timeout
+    server.ping_after = ping_after
+    try:
+        asyncio.run(_serve_until_terminated(server.start()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.history.stop()
+        server.journal.stop()
+
+
+def _interrupt(*_):
+    raise KeyboardInterrupt
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Chạy CaroServer nhiều tiến trình (sharding)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="số tiến trình worker")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--db", default="game_history.db", help="file SQLite lưu lịch sử")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="worker i mở metrics ở port này + i (0 = tắt)")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="ngắt kết nối im lặng quá số giây này (0 = tắt)")
+    parser.add_argument("--ping-after", type=float, default=PING_AFTER,
+                        help="gửi ping cho kết nối im lặng quá số giây này (0 = không ping)")
+    args = parser.parse_args(argv)
+    configure_logging()
+
+    run_dir = tempfile.mkdtemp(prefix="caro-shards-")
+    procs: List[multiprocessing.Process] = []
+    try:
+        coordinator = multiprocessing.Process(target=run_coordinator, args=(run_dir,), name="coordinator")
+        coordinator.start()
+        procs.append(coordinator)
+
+        # Đợi điều phối sẵn sàng rồi mới bật worker
+        coord_path = os.path.join(run_dir, COORDINATOR_SOCK)
+        deadline = time.monotonic() + 10
+        while not os.path.exists(coord_path):
+            if time.monotonic() > deadline or not coordinator.is_alive():
+                raise RuntimeError("Coordinator failed to start")
+            time.sleep(0.05)
+
+        for i in range(args.workers):
+            p = multiprocessing.Process(target=run_shard, name=f"shard-{i}",
+                                        args=(i, run_dir, args.host, args.port, args.db,
+                                              args.metrics_port + i if args.metrics_port else None,
+                                              args.idle_timeout or None, args.ping_after or None))
+            p.start()
+            procs.append(p)
+        log.info("sharded_server_started", workers=args.workers, host=args.host, port=args.port)
+
+        # SIGTERM cho launcher → dừng cả cụm như Ctrl+C
+        signal.signal(signal.SIGTERM, _interrupt)
+
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        log.info("sharded_server_shutdown")
+    finally:
+        # Dừng worker trước, điều phối sau cùng
+        for p in reversed(procs):
+            if p.is_alive():
+                p.terminate()
+        for p in procs:
+            p.join(5)
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,34 @@
 import asyncio
+import errno
+import os
+import random
+import socket
+import struct
 import sys
+import threading
+import time
 import pytest
 import pytest_asyncio
 from typing import Dict, Any, Optional
 
 # Đảm bảo common.py có trong sys.path
 try:
-    from common import send_json, recv_json, THINK_TIME_SECONDS
+    from common import (BOARD_SIZE, THINK_TIME_SECONDS, Board, GameClient, check_win, find_win_line,
+                        encode_frame, decode_frame, encode_moves, decode_moves, move_cells,
+                        zobrist_hashes, peek_type, MSG_JSON)
+    from timers import TimerWheel
+    from metrics import Registry
+    from persistence import HistoryWriter, HistoryReader, INSERT_MATCH_SQL, open_db
+    from ratings import Ratings
+    from matchmaking import MatchQueue
+    from ratelimit import (ALLOW, CLIENT_BURST, CLIENT_RATE, DISCONNECT, DROP, KICK_AT, WARN,
+                           ClientLimiter, TokenBucket)
+    from ai import best_move
+    from opening_book import PositionBook, build_book, canonical_hash
+    from server import CaroServer
+    from sharding import COORDINATOR_SOCK, Coordinator, ShardServer
+    from journal import MatchJournal, journal_path_for
+    import logs
 except ImportError:
     print("Không tìm thấy file common.py. Hãy chắc chắn nó ở cùng thư mục.")
     sys.exit(1)
@@ -21,6 +43,9 @@ PORT = 7777
 @pytest_asyncio.fixture(scope="module")
 async def server_process():
     print("\nStarting server...")
+    # Lần chạy trước bị terminate giữa trận → bỏ nhật ký cũ, không dựng lại trận của lần trước
+    if os.path.exists(journal_path_for("game_history.db")):
+        os.remove(journal_path_for("game_history.db"))
     process = await asyncio.create_subprocess_exec(
         sys.executable, "server.py",
         stdout=asyncio.subprocess.PIPE,
@@ -41,27 +66,25 @@ async def server_process():
 # HELPER CLASS
 # ==========================
 
-class TestClient:
-    def __init__(self, name: str):
-        self.name = name
-        self.reader: Optional[asyncio.StreamReader] = None
-        self.writer: Optional[asyncio.StreamWriter] = None
+class TestClient(GameClient):
+    def __init__(self, name: str, binary: bool = False):
+        super().__init__(name, binary)
         self.is_connected = False
 
     async def connect(self) -> bool:
         try:
-            self.reader, self.writer = await asyncio.open_connection(HOST, PORT)
-            await send_json(self.writer, {'type': 'login', 'name': self.name})
-            response = await recv_json(self.reader)
-            
-            if response.get('type') == 'login_ok':
-                self.is_connected = True
-                print(f"CLIENT [{self.name}]: Đăng nhập thành công.")
-                return True
-            else:
-                print(f"CLIENT [{self.name}]: Đăng nhập thất bại: {response.get('msg')}")
-                await self.close()
-                return False
+            await self.login(HOST, PORT)
+            self.is_connected = True
+            print(f"CLIENT [{self.name}]: Đăng nhập thành công.")
+            return True
+        except ConnectionRefusedError as e:
+            print(f"CLIENT [{self.name}]: Lỗi khi kết nối: {e}")
+            self.is_connected = False
+            return False
+        except ConnectionError as e:
+            print(f"CLIENT [{self.name}]: Đăng nhập thất bại: {e}")
+            self.is_connected = False
+            return False
         except Exception as e:
             print(f"CLIENT [{self.name}]: Lỗi khi kết nối: {e}")
             self.is_connected = False
@@ -69,11 +92,11 @@ class TestClient:
 
     async def send(self, data: Dict[str, Any]):
         if self.writer:
-            await send_json(self.writer, data)
+            await super().send(data)
 
     async def recv(self) -> Dict[str, Any]:
         if self.reader:
-            return await recv_json(self.reader)
+            return await super().recv()
         return {}
 
     async def async_recv_msg_by_type(self, msg_type: str, timeout: int = 5) -> Optional[Dict[str, Any]]:
@@ -96,19 +119,754 @@ class TestClient:
             return None
 
     async def close(self):
-        if self.writer:
-            self.writer.close()
-            try: await self.writer.wait_closed()
-            except: pass
-        self.reader = None
-        self.writer = None
+        await super().close()
         self.is_connected = False
         print(f"CLIENT [{self.name}]: Đã ngắt kết nối.")
 
+def drop_connection(client: GameClient) -> None:
+    """Giả lập rớt mạng: gửi RST (SO_LINGER 0) thay vì đóng đàng hoàng - server coi là mất kết nối, không phải tự thoát"""
+    sock = client.writer.get_extra_info("socket")
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    client.writer.transport.abort()
+
 # ==========================
 # TEST CASES
 # ==========================
 
+def test_bitboard_matches_list_board():
+    """Test: Board (bitboard) cho kết quả giống hệt các hàm cũ trên ma trận."""
+    import random
+    rng = random.Random(2024)
+    for _ in range(200):
+        rows = [['.'] * 15 for _ in range(15)]
+        board = Board()
+        cells = [(x, y) for x in range(15) for y in range(15)]
+        rng.shuffle(cells)
+        for i, (x, y) in enumerate(cells[:rng.randint(1, 225)]):
+            symbol = 'XO'[i % 2]
+            rows[y][x] = symbol
+            board.place(x, y, symbol)
+            assert board.check_win(x, y, symbol) == check_win(rows, x, y, symbol)
+            assert board.win_line(x, y, symbol) == find_win_line(rows, x, y, symbol)
+        assert board.to_rows() == rows
+        assert board.is_full() == all(c != '.' for row in rows for c in row)
+    # board[y][x] chỉ để đọc: ghi kiểu cũ phải báo lỗi chứ không lặng lẽ mất
+    with pytest.raises(TypeError):
+        board[0][0] = 'X'
+    assert [list(row) for row in board] == board.to_rows()
+
+def test_binary_frame_roundtrip():
+    """Test: Khung nhị phân giải mã ra đúng message ban đầu, message lạ đi qua khung JSON."""
+    messages = [
+        {'type': 'move', 'x': 3, 'y': 14},
+        {'type': 'move_ok', 'x': 0, 'y': 7, 'symbol': 'X'},
+        {'type': 'opponent_move', 'x': 14, 'y': 0, 'symbol': 'O'},
+        {'type': 'your_turn', 'deadline': 30},
+        {'type': 'chat', 'from': 'Bảo', 'text': 'xin chào'},
+        {'type': 'move', 'x': -1, 'y': 'abc'},
+    ]
+    for msg in messages:
+        frame = encode_frame(msg)
+        assert int.from_bytes(frame[:4], 'big') == len(frame) - 4
+        assert decode_frame(frame[4], frame[5:]) == msg
+    assert len(encode_frame(messages[1])) < 10
+
+def test_move_log_roundtrip():
+    """Test: Nhật ký nước đi nhị phân giải mã lại đúng như bản JSON cũ."""
+    moves = [{'x': 7, 'y': 7, 'symbol': 'X', 'ts': 1700000000},
+             {'x': 0, 'y': 14, 'symbol': 'O', 'ts': 1700000029},
+             {'x': 14, 'y': 0, 'symbol': 'X', 'ts': 1700000031}]
+    data = encode_moves(moves)
+    assert len(data) == 8 + 3 * len(moves)
+    assert decode_moves(data) == moves
+    assert move_cells(data) == (15, bytes([7 * 15 + 7, 14 * 15, 14]))
+    assert decode_moves(encode_moves([])) == []
+    with pytest.raises(ValueError):
+        encode_moves([{'x': 1, 'y': 1, 'symbol': 'O', 'ts': 0}])  # O không được đi trước
+    with pytest.raises(ValueError):
+        decode_moves(data[:-1])
+
+def test_zobrist_incremental_and_collisions():
+    """Test: Mã Zobrist cập nhật dần khớp với tính lại từ đầu, không phụ thuộc thứ tự đi, không trùng"""
+    rng = random.Random(7)
+    seen = {}
+    for _ in range(200):
+        board = Board()
+        moves = []
+        for i, cell in enumerate(rng.sample(range(BOARD_SIZE * BOARD_SIZE), rng.randint(1, 100))):
+            y, x = divmod(cell, BOARD_SIZE)
+            symbol = "X" if i % 2 == 0 else "O"
+            board.place(x, y, symbol)
+            moves.append({"x": x, "y": y, "symbol": symbol, "ts": 0})
+            position = (board.x_bits, board.o_bits)
+            assert seen.setdefault(board.zobrist, position) == position, "Trùng mã Zobrist"
+        assert board.zobrist == Board.from_bits(board.x_bits, board.o_bits).zobrist == board.copy().zobrist
+        assert zobrist_hashes(*move_cells(encode_moves(moves)))[-1] == board.zobrist
+
+    # Cùng tập quân, khác thứ tự → cùng mã; đặt rồi bỏ → về mã cũ
+    a, b = Board(), Board()
+    for x, y, s in [(7, 7, "X"), (8, 8, "O"), (6, 6, "X")]:
+        a.place(x, y, s)
+    for x, y, s in [(6, 6, "X"), (8, 8, "O"), (7, 7, "X")]:
+        b.place(x, y, s)
+    assert a.zobrist == b.zobrist != 0
+    before = a.zobrist
+    a.place(0, 0, "O")
+    assert a.zobrist != before
+    a.remove(0, 0)
+    assert a.zobrist == before
+
+def test_metrics_prometheus_text():
+    """Test: Registry xuất đúng định dạng text của Prometheus (counter có nhãn, histogram lũy kế, gauge tính lúc scrape)."""
+    registry = Registry()
+    received = registry.counter('t_messages_total', 'msgs', ('type',))
+    received.labels('move').inc()
+    received.labels('move').inc(2)
+    latency = registry.histogram('t_seconds', 'lat', buckets=(0.001, 0.01))
+    for v in (0.0005, 0.005, 0.5):
+        latency.observe(v)
+    registry.gauge('t_live', 'live').set_function(lambda: 7)
+
+    lines = registry.render().splitlines()
+    assert '# TYPE t_messages_total counter' in lines
+    assert 't_messages_total{type="move"} 3' in lines
+    assert 't_seconds_bucket{le="0.001"} 1' in lines
+    assert 't_seconds_bucket{le="0.01"} 2' in lines
+    assert 't_seconds_bucket{le="+Inf"} 3' in lines
+    assert 't_seconds_count 3' in lines
+    assert 't_live 7' in lines
+
+def test_structured_log_sampling():
+    """Test: Log JSON qua thread nền; sự kiện dày đặc (move) chỉ ghi 1/N, cảnh báo thì luôn ghi."""
+    import io, json
+    buf = io.StringIO()
+    logs.configure_logging(stream=buf, sampling={'move': 5}, force=True)
+    try:
+        log = logs.get_logger('test')
+        for i in range(10):
+            log.info('move', x=i)
+        log.warning('move', x=99)
+    finally:
+        logs.shutdown_logging()  # ghi nốt hàng đợi
+
+    entries = [json.loads(line) for line in buf.getvalue().splitlines()]
+    assert [e['x'] for e in entries] == [4, 9, 99]
+    assert entries[0]['event'] == 'move' and entries[0]['sampled'] == 5 and entries[0]['level'] == 'info'
+    assert 'sampled' not in entries[2]
+
+@pytest.mark.asyncio
+async def test_history_query_paging(tmp_path):
+    """Test: Tra lịch sử theo người chơi, phân trang bằng con trỏ, mới nhất trước."""
+    db = str(tmp_path / "history.db")
+    writer = HistoryWriter(db)
+    writer.start()
+    for i in range(7):
+        x, o = ("Ann", "Bob") if i % 2 else ("Bob", "Cid")
+        t = f"2026-01-01T00:00:{i:02d}"
+        writer.save_match((f"M{i}", x, o, x, t, t, "[]"))
+    writer.flush()
+    reader = HistoryReader(db)
+    try:
+        ids, cursor = [], None
+        while True:
+            page = await reader.find_matches(player="Bob", limit=2, cursor=cursor)
+            ids += [m["id"] for m in page["matches"]]
+            cursor = page["next"]
+            if cursor is None:
+                break
+        assert ids == ["M6", "M5", "M4", "M3", "M2", "M1", "M0"]
+
+        page = await reader.find_matches(winner="Ann", since="2026-01-01T00:00:02")
+        assert [m["id"] for m in page["matches"]] == ["M5", "M3"]
+        assert (await reader.get_match("M3"))["moves"] == []
+        assert await reader.get_match("nope") is None
+    finally:
+        reader.close()
+        writer.stop()
+
+@pytest.mark.asyncio
+async def test_history_writer_never_blocks_loop(tmp_path):
+    """Test: Hàng đợi ghi lịch sử rất nhỏ + đĩa chậm → submit() vẫn tức thì, event loop không bị chặn, không mất/đảo bản ghi."""
+    db = str(tmp_path / "slow.db")
+    writer = HistoryWriter(db, queue_size=2, batch_size=5, batch_wait=0)
+    commit = writer._commit
+    def slow_commit(conn, batch):
+        time.sleep(0.05)  # Đĩa chậm: mỗi batch mất 50ms
+        commit(conn, batch)
+    writer._commit = slow_commit
+    writer.start()
+    
+    # Đo độ trễ event loop trong lúc gửi dồn 200 bản ghi (cùng 1 id, bản sau ghi đè bản trước)
+    lags = []
+    async def ticker():
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - t - 0.01)
+    tick = asyncio.create_task(ticker())
+    try:
+        t0 = time.perf_counter()
+        for i in range(200):
+            writer.save_match(("M1", "Ann", "Bob", f"w{i}", "t", "t", b""))
+            if i % 20 == 0:
+                await asyncio.sleep(0)
+        assert time.perf_counter() - t0 < 0.5
+        assert writer.stalls > 0
+        await asyncio.sleep(0.1)
+        assert max(lags) < 0.2
+    finally:
+        tick.cancel()
+        assert await asyncio.get_running_loop().run_in_executor(None, writer.flush, 30)
+        writer.stop()
+    assert writer.committed == 200 and writer.pending() == 0
+    conn = open_db(db)
+    assert conn.execute("SELECT winner FROM matches WHERE id = 'M1'").fetchone()[0] == "w199"
+    conn.close()
+
+def test_history_writer_overflow_bounded(tmp_path):
+    """Test: Overflow có giới hạn - quá thì bỏ + đếm dropped; flush()/stop() vẫn luôn tới được thread ghi."""
+    db = str(tmp_path / "bounded.db")
+    writer = HistoryWriter(db, queue_size=2, batch_size=5, batch_wait=0, overflow_size=3)
+    gate = threading.Event()
+    commit = writer._commit
+    def stuck_commit(conn, batch):
+        gate.wait()  # Đĩa treo cho tới khi test mở
+        commit(conn, batch)
+    writer._commit = stuck_commit
+    writer.start()
+    try:
+        for i in range(20):
+            writer.save_match((f"M{i}", "Ann", "Bob", None, "t", "t", b""))
+        assert len(writer.overflow) <= 3
+        assert writer.dropped > 0 and writer.stats()["dropped"] == writer.dropped
+        assert writer.submitted + writer.dropped == 20
+    finally:
+        gate.set()
+    assert writer.flush(10)
+
+    # Dồn nhiều đợt nhỏ: thread ghi liên tục vừa rút cạn vừa đi đợi hàng đợi - không bản ghi nào bị kẹt
+    writer._commit = commit
+    writer.overflow_size = 10_000
+    for round_ in range(200):
+        for i in range(7):
+            writer.save_match((f"R{round_}-{i}", "Ann", "Bob", None, "t", "t", b""))
+        if round_ % 20 == 0:
+            assert writer.flush(10)
+    assert writer.flush(10)
+    stopper = threading.Thread(target=writer.stop)
+    stopper.start()
+    stopper.join(10)
+    assert not stopper.is_alive()
+    assert writer.pending() == 0 and writer.committed == writer.submitted
+
+def test_opening_book_symmetry_and_lookup(tmp_path):
+    """Test: Sổ khai cuộc gộp các khai cuộc đối xứng, đếm đúng kết quả và tra được qua mmap"""
+    db_path, book_path = str(tmp_path / "book.db"), str(tmp_path / "book.bin")
+    # 3 trận mở đầu X giữa bàn, O chéo góc - mỗi trận 1 hướng khác nhau (đối xứng của nhau)
+    games = [([(7, 7), (8, 8), (0, 0)], "Ann"), ([(7, 7), (6, 6), (0, 1)], "Bob"), ([(7, 7), (6, 8), (3, 3)], "draw")]
+    db = open_db(db_path)
+    with db:
+        for i, (cells, winner) in enumerate(games):
+            moves = [{"x": x, "y": y, "symbol": "XO"[k % 2], "ts": 0} for k, (x, y) in enumerate(cells)]
+            db.execute(INSERT_MATCH_SQL, (f"M{i}", "Ann", "Bob", winner, "", "", encode_moves(moves)))
+    db.close()
+
+    stats = build_book(db_path, book_path, min_games=2, run_entries=2)
+    assert stats["games"] == 3
+    book = PositionBook(book_path)
+    try:
+        assert book.stats(0)["games"] == 3
+        board = Board()
+        board.place(7, 7, "X")
+        board.place(8, 6, "O")
+        assert book.stats(canonical_hash(board)) == {"position": f"{canonical_hash(board):016x}", "games": 3,
+                                                      "x_wins": 1, "o_wins": 1, "draws": 1}
+        board.place(0, 0, "X")
+        assert book.lookup(canonical_hash(board)) is None  # Chỉ 1 trận → bị bỏ (min_games=2)
+    finally:
+        book.close()
+
+def test_ratings_incremental_and_persisted(tmp_path):
+    """Test: Elo cập nhật sau từng trận, bảng xếp hạng đúng thứ tự và nạp lại từ DB khớp cache."""
+    db = str(tmp_path / "ratings.db")
+    writer = HistoryWriter(db)
+    writer.start()
+    try:
+        ratings = Ratings(writer)
+        ratings.record("Ann", "Bob", "Ann")
+        ratings.record("Ann", "Cid", None)
+        writer.flush()
+
+        board = ratings.leaderboard()
+        assert [p["name"] for p in board] == ["Ann", "Cid", "Bob"]
+        assert board[0]["rating"] == 1215.3 and board[0]["wins"] == 1 and board[0]["draws"] == 1
+        assert ratings.stats("Bob") == {"name": "Bob", "rating": 1184.0, "rank": 3,
+                                        "wins": 0, "losses": 1, "draws": 0, "games": 1}
+        assert ratings.stats("Nobody")["rank"] is None
+
+        reloaded = Ratings()
+        reloaded.load(db)
+        assert reloaded.leaderboard() == board
+    finally:
+        writer.stop()
+
+def test_matchmaking_pairs_by_rating():
+    """Test: Ghép ngay khi Elo gần nhau, người lệch xa được ghép khi ngưỡng nới đủ, rời hàng thì không bị ghép"""
+    q = MatchQueue()
+    assert q.join("A", 1500, now=0.0) is None
+    first, second = q.join("B", 1530, now=1.0)
+    assert (first.name, second.name) == ("A", "B") and len(q) == 0
+
+    assert q.join("C", 2000, now=0.0) is None
+    assert q.join("D", 1800, now=1.0) is None
+    assert q.join("E", 1000, now=1.0) is None
+    assert q.leave("E") and not q.leave("E")
+    assert q.sweep(now=10.0) == []
+    pairs = q.sweep(now=15.0)  # 50 + 10*15 = 200 Elo
+    assert [(a.name, b.name) for a, b in pairs] == [("C", "D")]
+    assert len(q) == 0
+
+def test_rate_limit_peek_and_escalation():
+    """Test: Đoán loại tin từ bytes thô, thùng token nạp lại theo thời gian, vi phạm leo thang tới ngắt kết nối"""
+    assert peek_type(MSG_JSON, b'{"type": "chat", "text": "hi"}\n') == "chat"
+    assert peek_type(MSG_JSON, b'{"text": "\\"type\\": \\"move\\""}\n') is None
+    frame = encode_frame({"type": "move", "x": 1, "y": 2})  # [độ dài 4 byte][loại 1 byte][payload]
+    assert peek_type(frame[4], frame[5:]) == "move"
+
+    lim = ClientLimiter(TokenBucket.full(CLIENT_RATE, CLIENT_BURST, 0.0))
+    assert all(lim.check("move", 0.0) == ALLOW for _ in range(int(CLIENT_BURST)))
+    assert lim.check("move", 0.0) == DROP
+    assert lim.check("move", 1.0) == ALLOW  # 1 giây sau đã nạp lại token
+
+    # Loại có giới hạn riêng: chat cạn trước giới hạn chung; loại lạ không tạo thùng mới
+    lim = ClientLimiter(TokenBucket.full(CLIENT_RATE, CLIENT_BURST, 0.0))
+    verdicts = [lim.check("chat", 0.0) for _ in range(10)]
+    assert verdicts[:5] == [ALLOW] * 5 and DROP in verdicts and WARN in verdicts
+    assert verdicts.count(WARN) == 1
+    lim.check("junk-type", 0.0)
+    assert set(lim.types) == {"chat"}
+
+    # Xả tin liên tục → bị ngắt sau khoảng KICK_AT tin bị chặn
+    verdicts = [lim.check("move", 0.0) for _ in range(int(KICK_AT) + int(CLIENT_BURST))]
+    assert DISCONNECT in verdicts and verdicts.index(DISCONNECT) < KICK_AT + CLIENT_BURST
+
+def test_ai_wins_blocks_and_stays_local():
+    """Test: Bot đi nước thắng ngay, chặn 4 quân của đối thủ, và chỉ đánh gần các quân đã có"""
+    board = Board()
+    for x in range(3, 7):
+        board.place(x, 7, "X")
+    for x in range(3, 6):
+        board.place(x, 9, "O")
+    assert best_move(board, "X", budget=0.5) in ((2, 7), (7, 7))
+    assert best_move(board, "O", budget=0.5) in ((2, 7), (7, 7))
+
+    board = Board()
+    board.place(7, 7, "X")
+    x, y = best_move(board, "O", budget=0.5)
+    assert max(abs(x - 7), abs(y - 7)) <= 2
+    board.place(x, y, "O")
+    board.remove(x, y)
+    assert board.move_count == 1 and board.is_empty(x, y)
+
+@pytest.mark.asyncio
+async def test_timer_wheel_fire_and_cancel():
+    """Test: Bánh xe hẹn giờ - hủy thì không nổ, hẹn lại thì nổ theo hạn mới, hạn xa hơn 1 vòng vẫn đúng"""
+    class Item:
+        deadline = None
+        timer_slot = -1
+
+    fired = []
+    async def on_expire(item):
+        fired.append(item)
+
+    wheel = TimerWheel(on_expire, tick=0.01, slots=8)  # 1 vòng = 80ms
+    a, b, c = Item(), Item(), Item()
+    now = wheel.now()
+    wheel.schedule(a, now + 0.05)
+    wheel.schedule(b, now + 0.2)
+    wheel.schedule(c, now + 0.03)
+    wheel.cancel(c)
+    wheel.schedule(a, now + 0.12)
+
+    await asyncio.sleep(0.1)
+    assert fired == []
+    await asyncio.sleep(0.2)
+    assert fired == [a, b]
+    assert wheel.count == 0 and a.timer_slot == b.timer_slot == c.timer_slot == -1
+    wheel.stop()
+
+@pytest.mark.asyncio
+async def test_idle_reaper_pings_then_evicts(tmp_path):
+    """Test: Kết nối im lặng được ping; ai trả pong thì ở lại, ai không trả thì bị ngắt và xử thua."""
+    server = CaroServer(HOST, 0, str(tmp_path / "idle.db"))
+    server.metrics_port = None
+    server.bot_names = ()
+    server.idle_sweep, server.ping_after, server.idle_timeout = 0.05, 0.2, 0.6
+    server.resume_grace = None  # Bị ngắt là xử thua ngay, không chờ resume
+    serving = asyncio.create_task(server.start())
+    alive, dead = GameClient("Alive"), GameClient("Dead")
+    try:
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        port = server.server.sockets[0].getsockname()[1]
+        await alive.login(HOST, port)
+        await dead.login(HOST, port)
+        await alive.send({"type": "challenge", "opponent": "Dead"})
+        await dead.wait_for("invite")
+        await dead.send({"type": "accept", "opponent": "Alive"})
+        await alive.wait_for("match_start")
+        
+        # Alive vẫn đọc (recv() tự trả pong), Dead treo không đọc gì nữa → không bao giờ trả pong
+        end = await asyncio.wait_for(alive.wait_for("match_end"), timeout=3)
+        assert end["reason"] == "disconnect" and end["winner"] == "you"
+        # Đọc tiếp hơn 1 idle_timeout nữa: Alive vẫn ở lại nhờ pong
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(alive.wait_for("no_such_type"), timeout=0.8)
+        assert "Alive" in server.clients and "Dead" not in server.clients
+    finally:
+        await alive.close()
+        await dead.close()
+        await server.stop()
+        serving.cancel()
+
+@pytest.mark.asyncio
+async def test_session_resume_and_expiry(tmp_path):
+    """Test: Rớt mạng giữa trận → resume bằng mã phiên, nhận lại bàn cờ; không quay lại thì hết hạn, xử thua, không giữ gì."""
+    server = CaroServer(HOST, 0, str(tmp_path / "resume.db"))
+    server.metrics_port = None
+    server.bot_names = ()
+    server.resume_grace = 0.3
+    serving = asyncio.create_task(server.start())
+    px, po = GameClient("Steady"), GameClient("Flaky")
+    try:
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        port = server.server.sockets[0].getsockname()[1]
+        await px.login(HOST, port)
+        await po.login(HOST, port)
+        assert po.session in server.sessions
+        await px.send({"type": "challenge", "opponent": "Flaky"})
+        await po.wait_for("invite")
+        await po.send({"type": "accept", "opponent": "Steady"})
+        await px.wait_for("your_turn")
+        await px.send({"type": "move", "x": 7, "y": 7})
+        await po.wait_for("your_turn")
+        
+        # Rớt mạng rồi resume trong hạn: trận vẫn còn, nhận lại nước đã đi và lượt của mình
+        drop_connection(po)
+        assert (await px.wait_for("opponent_disconnected"))["grace"] == 0.3
+        old_session = po.session
+        await po.resume(HOST, port)
+        assert po.session != old_session and old_session not in server.sessions
+        state = await po.wait_for("match_state")
+        assert state["you"] == "O" and state["moves"] == [7 * BOARD_SIZE + 7]
+        assert (await po.wait_for("your_turn"))["deadline"] > 0
+        await px.wait_for("opponent_reconnected")
+        await po.send({"type": "move", "x": 8, "y": 8})
+        assert (await px.wait_for("opponent_move"))["x"] == 8
+        
+        # Rớt lần nữa và không quay lại: hết hạn thì đối thủ thắng, phiên bị xóa
+        drop_connection(po)
+        end = await asyncio.wait_for(px.wait_for("match_end"), timeout=3)
+        assert end["reason"] == "disconnect" and end["winner"] == "you"
+        assert "Flaky" not in server.clients and po.session not in server.sessions
+        assert server.session_timers.count == 0
+        with pytest.raises(ConnectionError):
+            await po.resume(HOST, port)
+        
+        # Tự thoát đàng hoàng (đóng socket) giữa trận: xử thua ngay, không chờ resume
+        server.resume_grace = 30
+        quitter = GameClient("Quitter")
+        await quitter.login(HOST, port)
+        await px.send({"type": "challenge", "opponent": "Quitter"})
+        await quitter.wait_for("invite")
+        await quitter.send({"type": "accept", "opponent": "Steady"})
+        await px.wait_for("your_turn")
+        await quitter.close()
+        end = await asyncio.wait_for(px.wait_for("match_end"), timeout=2)
+        assert end["reason"] == "disconnect" and end["winner"] == "you"
+        assert "Quitter" not in server.clients and server.session_timers.count == 0
+    finally:
+        await px.close()
+        await po.close()
+        await server.stop()
+        serving.cancel()
+
+@pytest.mark.asyncio
+async def test_stop_delivers_match_end_during_highlight(tmp_path):
+    """Test: Tắt server khi đang hiện line thắng → cả 2 người vẫn nhận được match_end trước khi bị ngắt."""
+    server = CaroServer(HOST, 0, str(tmp_path / "stop.db"))
+    server.metrics_port = None
+    server.bot_names = ()
+    serving = asyncio.create_task(server.start())
+    px, po = GameClient("Closer"), GameClient("Closed")
+    try:
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        port = server.server.sockets[0].getsockname()[1]
+        await px.login(HOST, port)
+        await po.login(HOST, port)
+        await px.send({"type": "challenge", "opponent": "Closed"})
+        await po.wait_for("invite")
+        await po.send({"type": "accept", "opponent": "Closer"})
+        for i in range(4):
+            await px.wait_for("your_turn")
+            await px.send({"type": "move", "x": i, "y": 0})
+            await po.wait_for("your_turn")
+            await po.send({"type": "move", "x": i, "y": 1})
+        await px.wait_for("your_turn")
+        await px.send({"type": "move", "x": 4, "y": 0})
+        await px.wait_for("highlight")
+        await po.wait_for("highlight")
+        
+        await server.stop()
+        end_x = await asyncio.wait_for(px.wait_for("match_end"), timeout=2)
+        end_o = await asyncio.wait_for(po.wait_for("match_end"), timeout=2)
+        assert end_x["result"] == "win" and end_o["result"] == "lose"
+    finally:
+        await px.close()
+        await po.close()
+        await server.stop()
+        serving.cancel()
+
+def test_journal_never_blocks_when_full_or_failed(tmp_path):
+    """Test: Nhật ký đầy hoặc thread ghi chết vì lỗi đĩa → append() bỏ sự kiện ngay, không bao giờ chặn event loop."""
+    release = threading.Event()
+
+    class StuckDisk:
+        """File giả: write() treo đến khi được thả rồi báo hết chỗ trống"""
+        def write(self, data):
+            release.wait(5)
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        def close(self):
+            pass
+
+    journal = MatchJournal(str(tmp_path / "full.journal"), queue_size=2, sync_wait=0)
+    journal.open()
+    journal.file.close()
+    journal.file = StuckDisk()
+    t0 = time.perf_counter()
+    for i in range(1000):
+        journal.move("M1", i % 225, time.time())
+    assert time.perf_counter() - t0 < 0.5
+    assert journal.stalls > 0 and journal.dropped > 0 and not journal.failed
+    
+    release.set()
+    journal.thread.join(5)
+    assert journal.failed and not journal.thread.is_alive()
+    dropped = journal.dropped
+    journal.move("M1", 0, time.time())
+    assert journal.dropped == dropped + 1 and journal.queue.qsize() == 0
+    assert journal.flush(1) is False
+    journal.stop(1)
+
+@pytest.mark.asyncio
+async def test_journal_warm_restart(tmp_path):
+    """Test: Tắt server giữa trận → server mới dựng lại trận từ nhật ký, người chơi resume bằng mã phiên cũ."""
+    db = str(tmp_path / "warm.db")
+    server = CaroServer(HOST, 0, db)
+    server.metrics_port = None
+    server.bot_names = ()
+    serving = asyncio.create_task(server.start())
+    px, po = GameClient("Before"), GameClient("After")
+    try:
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        port = server.server.sockets[0].getsockname()[1]
+        await px.login(HOST, port)
+        await po.login(HOST, port)
+        await px.send({"type": "challenge", "opponent": "After"})
+        await po.wait_for("invite")
+        await po.send({"type": "accept", "opponent": "Before"})
+        await px.wait_for("your_turn")
+        await px.send({"type": "move", "x": 7, "y": 7})
+        await po.wait_for("your_turn")
+        await po.send({"type": "move", "x": 8, "y": 8})
+        await px.wait_for("your_turn")
+    finally:
+        await server.stop()
+        serving.cancel()
+    await px.close()
+    await po.close()
+    # Đuôi hỏng (máy sập giữa lúc ghi) bị cắt bỏ khi mở lại
+    with open(journal_path_for(db), "ab") as f:
+        f.write(b"\x40\x00\x00\x00torn")
+    
+    server = CaroServer(HOST, 0, db)
+    server.metrics_port = None
+    server.bot_names = ()
+    serving = asyncio.create_task(server.start())
+    try:
+        while server.server is None:
+            await asyncio.sleep(0.01)
+        port = server.server.sockets[0].getsockname()[1]
+        assert len(server.matches) == 1 and server.clients["Before"].detached
+        await po.resume(HOST, port)
+        state = await po.wait_for("match_state")
+        assert state["you"] == "O" and state["turn"] == "X"
+        assert state["moves"] == [7 * BOARD_SIZE + 7, 8 * BOARD_SIZE + 8]
+        await px.resume(HOST, port)
+        assert (await px.wait_for("match_state"))["moves"] == state["moves"]
+        assert (await px.wait_for("your_turn"))["deadline"] > 0
+        await px.send({"type": "move", "x": 9, "y": 9})
+        assert (await po.wait_for("opponent_move"))["x"] == 9
+    finally:
+        await px.close()
+        await po.close()
+        await server.stop()
+        serving.cancel()
+
+async def start_cluster(tmp_path, shards: int = 2):
+    """Điều phối + N shard chạy chung 1 event loop trên Unix socket; mỗi shard 1 port riêng để test chọn được shard"""
+    run_dir, db = str(tmp_path), str(tmp_path / "cluster.db")
+    coordinator = Coordinator(run_dir)
+    tasks = [asyncio.create_task(coordinator.start())]
+    while not os.path.exists(os.path.join(run_dir, COORDINATOR_SOCK)):
+        await asyncio.sleep(0.01)
+    servers = []
+    for i in range(shards):
+        server = ShardServer(i, run_dir, HOST, 0, db)
+        server.reuse_port = False
+        server.metrics_port = None
+        servers.append(server)
+        tasks.append(asyncio.create_task(server.start()))
+    for server in servers:
+        while server.server is None:
+            await asyncio.sleep(0.01)
+    ports = [server.server.sockets[0].getsockname()[1] for server in servers]
+    return coordinator, servers, ports, tasks
+
+async def stop_cluster(coordinator, servers, tasks):
+    for server in servers:
+        await server.stop()
+        for task in list(server.background):
+            task.cancel()
+    coordinator.server.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+@pytest.mark.asyncio
+async def test_sharded_cross_shard_match_and_failed_handoff(tmp_path):
+    """Test: 2 shard thật (điều phối + chuyển fd qua Unix socket): thách/nhận/đánh hết trận xuyên shard; chuyển thất bại thì ở lại shard cũ."""
+    coordinator, servers, ports, tasks = await start_cluster(tmp_path)
+    px, po = GameClient("Left"), GameClient("Right")
+    stay, stuck = GameClient("Stay"), GameClient("Stuck")
+    try:
+        await px.login(HOST, ports[0])
+        await po.login(HOST, ports[1])
+        while set(coordinator.directory) != {"Left", "Right"}:
+            await asyncio.sleep(0.01)
+        
+        # Thách xuyên shard: lời mời qua điều phối, người nhận được chuyển fd sang shard 0
+        await px.send({"type": "challenge", "opponent": "Right"})
+        await po.wait_for("invite")
+        await po.send({"type": "accept", "opponent": "Left"})
+        assert (await px.wait_for("match_start"))["you"] == "X"
+        assert (await po.wait_for("match_start"))["you"] == "O"
+        assert "Right" in servers[0].clients and "Right" not in servers[1].clients
+        assert coordinator.directory["Right"] == 0 and coordinator.busy == {"Left", "Right"}
+        for i in range(4):
+            await px.wait_for("your_turn")
+            await px.send({"type": "move", "x": i, "y": 0})
+            await po.wait_for("your_turn")
+            await po.send({"type": "move", "x": i, "y": 1})
+        await px.wait_for("your_turn")
+        await px.send({"type": "move", "x": 4, "y": 0})
+        assert (await asyncio.wait_for(px.wait_for("match_end"), timeout=6))["result"] == "win"
+        assert (await asyncio.wait_for(po.wait_for("match_end"), timeout=2))["result"] == "lose"
+        while coordinator.busy:
+            await asyncio.sleep(0.01)
+        
+        # Chuyển fd thất bại (socket nhận của shard 0 không tồn tại) → người nhận vẫn ở shard 1, vẫn được phục vụ
+        await stay.login(HOST, ports[0])
+        await stuck.login(HOST, ports[1])
+        while "Stuck" not in coordinator.directory:
+            await asyncio.sleep(0.01)
+        handoff, coordinator.handoff_paths[0] = coordinator.handoff_paths[0], str(tmp_path / "missing.sock")
+        await stay.send({"type": "challenge", "opponent": "Stuck"})
+        await stuck.wait_for("invite")
+        await stuck.send({"type": "accept", "opponent": "Stay"})
+        assert "retry" in (await stuck.wait_for("error"))["msg"]
+        assert "Stuck" in servers[1].clients and not servers[0].matches
+        await stuck.send({"type": "user_sync"})
+        assert "Stuck" in (await asyncio.wait_for(stuck.wait_for("user_list"), timeout=2))["users"]
+        coordinator.handoff_paths[0] = handoff
+    finally:
+        for c in (px, po, stay, stuck):
+            await c.close()
+        await stop_cluster(coordinator, servers, tasks)
+
+@pytest.mark.asyncio
+async def test_sharded_handoff_times_out(tmp_path, monkeypatch):
+    """Test: Client ngừng đọc socket → chuyển kết nối bỏ cuộc sau HANDOFF_TIMEOUT thay vì đợi mãi; StreamReader thiếu _buffer thì báo lỗi rõ."""
+    import sharding
+    monkeypatch.setattr(sharding, "HANDOFF_TIMEOUT", 0.2)
+    server = ShardServer(0, str(tmp_path), HOST, 0, str(tmp_path / "unused.db"))
+
+    class StuckTransport:
+        def get_write_buffer_size(self):
+            return 1  # Dữ liệu gửi mãi không hết
+    class Writer:
+        transport = StuckTransport()
+    try:
+        t0 = time.perf_counter()
+        with pytest.raises(TimeoutError):
+            await server.hand_off(asyncio.StreamReader(), Writer(), str(tmp_path / "x.sock"), {})
+        assert time.perf_counter() - t0 < 2
+
+        class DrainedTransport:
+            def get_write_buffer_size(self):
+                return 0
+        Writer.transport = DrainedTransport()
+        with pytest.raises(RuntimeError, match="_buffer"):
+            await server.hand_off(object(), Writer(), str(tmp_path / "x.sock"), {})
+    finally:
+        server.history.stop()
+        server.history_reader.close()
+
+@pytest.mark.asyncio
+async def test_sharded_resume_on_other_shard(tmp_path):
+    """Test: Resume rơi vào shard không cấp mã phiên → hỏi điều phối, chuyển kết nối về đúng shard, trận tiếp tục."""
+    coordinator, servers, ports, tasks = await start_cluster(tmp_path)
+    px, po = GameClient("Home"), GameClient("Away")
+    try:
+        await px.login(HOST, ports[0])
+        await po.login(HOST, ports[1])
+        while set(coordinator.directory) != {"Home", "Away"}:
+            await asyncio.sleep(0.01)
+        await px.send({"type": "challenge", "opponent": "Away"})
+        await po.wait_for("invite")
+        await po.send({"type": "accept", "opponent": "Home"})
+        await px.wait_for("your_turn")
+        await px.send({"type": "move", "x": 7, "y": 7})
+        await po.wait_for("your_turn")
+        # Sau khi chuyển sang shard 0, Away nhận mã phiên mới của shard 0
+        assert coordinator.sessions[po.session] == 0
+        
+        # Rớt mạng, kết nối lại vào shard 1: được chuyển về shard 0 và nhận lại trận
+        drop_connection(po)
+        await px.wait_for("opponent_disconnected")
+        await po.resume(HOST, ports[1])
+        assert coordinator.sessions[po.session] == 0 and "Away" not in servers[1].clients
+        state = await po.wait_for("match_state")
+        assert state["you"] == "O" and state["moves"] == [7 * BOARD_SIZE + 7]
+        await po.wait_for("your_turn")
+        await po.send({"type": "move", "x": 8, "y": 8})
+        assert (await px.wait_for("opponent_move"))["x"] == 8
+        
+        # Mã không ai cấp thì vẫn bị từ chối như cũ
+        ghost = GameClient("Ghost")
+        ghost.session = "not-a-session"
+        with pytest.raises(ConnectionError):
+            await ghost.resume(HOST, ports[1])
+        await ghost.close()
+    finally:
+        await px.close()
+        await po.close()
+        await stop_cluster(coordinator, servers, tasks)
+
 @pytest.mark.asyncio
 async def test_challenge_reject_busy(server_process, check):
     """Test: Thử thách đấu với người đang bận."""
@@ -144,6 +902,36 @@ async def test_challenge_reject_busy(server_process, check):
         await phung.close()
         await bao.close()
 
+@pytest.mark.asyncio
+async def test_user_delta_and_resync(server_process, check):
+    """Test: Danh sách online gửi theo delta có số thứ tự, user_sync trả lại snapshot."""
+    vy = TestClient("Vy")
+    khoa = TestClient("Khoa")
+    
+    try:
+        check.is_true(await vy.connect(), "Vy kết nối thất bại")
+        check.is_not_none(vy.users_seq, "login_ok thiếu seq")
+        check.is_true(await khoa.connect(), "Khoa kết nối thất bại")
+        
+        # Vy nhận delta có Khoa, seq tăng dần
+        delta = await vy.async_recv_msg_by_type('user_delta')
+        while delta and 'Khoa' not in delta.get('joined', []):
+            delta = await vy.async_recv_msg_by_type('user_delta')
+        check.is_not_none(delta, "Vy không nhận được user_delta")
+        if delta:
+            check.greater(delta['seq'], vy.users_seq, "seq không tăng")
+        
+        # Xin lại snapshot: phải có cả 2 người, cùng seq với delta mới nhất
+        await vy.send({'type': 'user_sync'})
+        snapshot = await vy.async_recv_msg_by_type('user_list')
+        check.is_not_none(snapshot, "Vy không nhận được snapshot")
+        if snapshot and delta:
+            check.is_true({'Vy', 'Khoa'} <= set(snapshot['users']), "Snapshot thiếu người")
+            check.greater_equal(snapshot['seq'], delta['seq'], "Snapshot cũ hơn delta")
+    finally:
+        await vy.close()
+        await khoa.close()
+
 @pytest.mark.asyncio
 async def test_game_win_logic(server_process, check):
     """Test: Đánh thắng 5 quân."""
@@ -185,6 +973,129 @@ async def test_game_win_logic(server_process, check):
         await p1.close()
         await p2.close()
 
+@pytest.mark.asyncio
+async def test_highlight_keeps_client_responsive(server_process, check):
+    """Test: Trong lúc hiện line thắng, vòng lặp của người thắng vẫn trả lời ngay; match_end tới sau HIGHLIGHT_DELAY."""
+    p1 = TestClient("Shiner")
+    p2 = TestClient("Shaded")
+    
+    try:
+        await p1.connect()
+        await p2.connect()
+        
+        await p1.send({'type': 'challenge', 'opponent': 'Shaded'})
+        await p2.async_recv_msg_by_type('invite')
+        await p2.send({'type': 'accept', 'opponent': 'Shiner'})
+        
+        await p1.async_recv_msg_by_type('match_start')
+        await p2.async_recv_msg_by_type('match_start')
+        
+        moves = [
+            (p1, 0, 5), (p2, 0, 6),
+            (p1, 1, 5), (p2, 1, 6),
+            (p1, 2, 5), (p2, 2, 6),
+            (p1, 3, 5), (p2, 3, 6),
+            (p1, 4, 5)  # Thắng
+        ]
+        for player, x, y in moves:
+            await player.async_recv_msg_by_type('your_turn')
+            await player.send({'type': 'move', 'x': x, 'y': y})
+        check.is_not_none(await p1.async_recv_msg_by_type('highlight'), "P1 không nhận được highlight")
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        
+        # Đang hiện line thắng: yêu cầu khác được trả lời ngay, nước đi tiếp bị từ chối
+        await p1.send({'type': 'user_sync'})
+        check.is_not_none(await p1.async_recv_msg_by_type('user_list', timeout=1), "Server không trả lời khi đang highlight")
+        await p2.send({'type': 'move', 'x': 9, 'y': 9})
+        error_msg = await p2.async_recv_msg_by_type('error', timeout=1)
+        check.is_not_none(error_msg, "Nước đi sau khi thắng không bị từ chối")
+        
+        end_msg = await p1.async_recv_msg_by_type('match_end', timeout=6)
+        check.is_not_none(end_msg, "P1 không nhận được match_end")
+        if end_msg:
+            check.equal(end_msg['reason'], 'win')
+            check.greater(loop.time() - t0, 2.0, "match_end tới trước khi hết HIGHLIGHT_DELAY")
+        
+    finally:
+        await p1.close()
+        await p2.close()
+
+@pytest.mark.asyncio
+async def test_binary_protocol_game(server_process, check):
+    """Test: Client nhị phân đấu với client JSON cũ."""
+    p1 = TestClient("BinaryX", binary=True)
+    p2 = TestClient("JsonO")
+    
+    try:
+        check.is_true(await p1.connect(), "BinaryX kết nối thất bại")
+        check.is_true(await p2.connect(), "JsonO kết nối thất bại")
+        check.is_true(p1.binary, "Server không chấp nhận giao thức nhị phân")
+        
+        await p1.send({'type': 'challenge', 'opponent': 'JsonO'})
+        await p2.async_recv_msg_by_type('invite')
+        await p2.send({'type': 'accept', 'opponent': 'BinaryX'})
+        
+        await p1.async_recv_msg_by_type('match_start')
+        await p2.async_recv_msg_by_type('match_start')
+        
+        await p1.async_recv_msg_by_type('your_turn')
+        await p1.send({'type': 'move', 'x': 7, 'y': 7})
+        ok = await p1.async_recv_msg_by_type('move_ok')
+        opp = await p2.async_recv_msg_by_type('opponent_move')
+        
+        check.equal(ok, {'type': 'move_ok', 'x': 7, 'y': 7, 'symbol': 'X'})
+        check.equal(opp, {'type': 'opponent_move', 'x': 7, 'y': 7, 'symbol': 'X'})
+        
+    finally:
+        await p1.close()
+        await p2.close()
+
+@pytest.mark.asyncio
+async def test_spectate_mid_game(server_process, check):
+    """Test: Người xem vào giữa trận nhận snapshot gọn rồi nhận từng nước đi."""
+    p1 = TestClient("SpecX")
+    p2 = TestClient("SpecO")
+    viewer = TestClient("Viewer", binary=True)
+    
+    try:
+        await p1.connect()
+        await p2.connect()
+        await viewer.connect()
+        
+        await p1.send({'type': 'challenge', 'opponent': 'SpecO'})
+        await p2.async_recv_msg_by_type('invite')
+        await p2.send({'type': 'accept', 'opponent': 'SpecX'})
+        await p1.async_recv_msg_by_type('match_start')
+        await p2.async_recv_msg_by_type('match_start')
+        
+        await p1.async_recv_msg_by_type('your_turn')
+        await p1.send({'type': 'move', 'x': 7, 'y': 7})
+        await p1.async_recv_msg_by_type('move_ok')
+        
+        await viewer.send({'type': 'spectate', 'player': 'SpecX'})
+        snap = await viewer.async_recv_msg_by_type('spectate_snapshot')
+        check.is_not_none(snap, "Viewer không nhận được snapshot")
+        if snap:
+            check.equal(snap['moves'], [7 * 15 + 7])
+            check.equal(snap['turn'], 'O')
+        
+        await p2.async_recv_msg_by_type('your_turn')
+        await p2.send({'type': 'move', 'x': 8, 'y': 8})
+        move = await viewer.async_recv_msg_by_type('spectate_move')
+        check.is_not_none(move, "Viewer không nhận được nước đi")
+        if move:
+            check.equal((move['x'], move['y'], move['symbol']), (8, 8, 'O'))
+        
+        await p1.close()
+        end = await viewer.async_recv_msg_by_type('spectate_match_end')
+        check.is_not_none(end, "Viewer không nhận được tin kết thúc")
+        
+    finally:
+        await p1.close()
+        await p2.close()
+        await viewer.close()
+
 @pytest.mark.asyncio
 async def test_game_timeout_first_move(server_process, check):
     """
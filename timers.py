@@ -0,0 +1,109 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from logs import get_logger
+
+# ============================================
+# CÁC HẰNG SỐ - Cấu hình bánh xe hẹn giờ
+# ============================================
+TIMER_TICK = 0.1     # Độ phân giải 100ms (hết giờ có thể trễ tối đa 1 tick)
+TIMER_SLOTS = 512    # 512 ô x 100ms = 51.2 giây mỗi vòng quay
+
+log = get_logger("timers")
+
+
+class TimerWheel:
+    """
+    Bánh xe hẹn giờ (hashed timer wheel) - thay cho mỗi lượt đi 1 asyncio.Task
+    - Mỗi đối tượng hẹn giờ cần 2 thuộc tính: deadline (giờ time.monotonic) và
+      timer_slot (ô đang nằm trên bánh xe, -1 = không hẹn giờ)
+    - schedule()/cancel() là O(1): chỉ thêm/xóa khỏi 1 ô, không tạo task mới
+    - Chỉ 1 task quay bánh xe, mỗi tick xét đúng 1 ô; deadline xa hơn 1 vòng
+      thì nằm lại ô đó chờ vòng sau
+    - Không có gì để đếm thì task ngủ hẳn, không thức dậy mỗi tick
+    """
+
+    def __init__(self, on_expire: Callable[[Any], Awaitable[None]],
+                 tick: float = TIMER_TICK, slots: int = TIMER_SLOTS):
+        self.on_expire = on_expire
+        self.tick = tick
+        self.slots: List[Dict[int, Any]] = [{} for _ in range(slots)]
+        self.count = 0
+        self.cursor: Optional[int] = None  # Tick cuối cùng đã xử lý (None = đang ngủ)
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    @staticmethod
+    def now() -> float:
+        return time.monotonic()
+
+    def schedule(self, item: Any, deadline: float) -> None:
+        """Hẹn giờ cho item (hẹn lại thì hủy hẹn cũ)"""
+        self.cancel(item)
+        if self.cursor is None:
+            self.cursor = int(self.now() / self.tick)
+        due = max(-int(-deadline // self.tick), self.cursor + 1)  # làm tròn lên, không rơi vào tick đã qua
+        slot = due % len(self.slots)
+        item.deadline = deadline
+        item.timer_slot = slot
+        self.slots[slot][id(item)] = item
+        self.count += 1
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def cancel(self, item: Any) -> None:
+        """Hủy hẹn giờ (không hẹn thì thôi)"""
+        slot = item.timer_slot
+        if slot < 0:
+            return
+        if self.slots[slot].pop(id(item), None) is not None:
+            self.count -= 1
+        item.timer_slot = -1
+
+    def stop(self) -> None:
+        """Dừng task quay bánh xe và bỏ mọi hẹn giờ"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._task = None
+        for bucket in self.slots:
+            for item in bucket.values():
+                item.timer_slot = -1
+            bucket.clear()
+        self.count = 0
+        self.cursor = None
+        self._wakeup = asyncio.Event()
+
+    async def _run(self) -> None:
+        n = len(self.slots)
+        while True:
+            if not self.count:
+                self.cursor = None
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = self.now()
+            now_tick = int(now / self.tick)
+            if now_tick - self.cursor > n:
+                self.cursor = now_tick - n  # Bị treo lâu hơn 1 vòng: mỗi ô chỉ cần xét 1 lần
+            while self.cursor < now_tick:
+                self.cursor += 1
+                slot = self.cursor % n
+                bucket = self.slots[slot]
+                if not bucket:
+                    continue
+                expired = [item for item in bucket.values() if item.deadline <= now]
+                for item in expired:
+                    # Callback trước có thể đã hủy/hẹn lại item này
+                    if item.timer_slot != slot or item.deadline > now:
+                        continue
+                    self.cancel(item)
+                    try:
+                        await self.on_expire(item)
+                    except Exception as e:
+                        log.exception("timer_callback_error", error=str(e))
+
+            await asyncio.sleep(max(0.0, (now_tick + 1) * self.tick - self.now()))